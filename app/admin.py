@@ -0,0 +1,22 @@
+from .models.bucket_index import USAGE_FIELDS
+
+
+def usage_report(storage, bucket_class, bucket_name=None):
+    report = {}
+    for name, region in storage().buckets.items():
+        if bucket_name and name != bucket_name:
+            continue
+        bucket = bucket_class(name, region)
+        if bucket.exists:
+            report[name] = dict(bucket.usage, region=region)
+    return report
+
+
+def prometheus_metrics(report):
+    lines = []
+    for field in USAGE_FIELDS:
+        metric = "pseudo_s3_bucket_{}".format(field)
+        lines.append("# TYPE {} gauge".format(metric))
+        for name, usage in sorted(report.items()):
+            lines.append('{}{{bucket="{}",region="{}"}} {}'.format(metric, name, usage["region"], usage[field]))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,107 @@
+import asyncio
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from app.compression import FrameReader, FrameWriter
+from app.settings import settings
+
+
+CHUNK_SIZE = 1024 * 1024
+
+_executor = None
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.io_threads, thread_name_prefix="pseudo-s3-io")
+    return _executor
+
+
+async def run(func, *args):
+    """
+    Run a blocking file operation on the I/O pool. Streams only borrow a
+    thread for the duration of one chunk, so the number of open streams is
+    not bounded by the number of threads.
+    """
+    return await asyncio.get_running_loop().run_in_executor(executor(), func, *args)
+
+
+def _write(sink, data, file_hash):
+    file_hash.update(data)
+    sink.write(data)
+
+
+async def read_chunks(path, start=0, end=None, chunk_size=CHUNK_SIZE):
+    """Yield the bytes of path in [start, end) as chunks of at most chunk_size."""
+    fd = await run(os.open, path, os.O_RDONLY)
+    try:
+        offset = start
+        while end is None or offset < end:
+            size = chunk_size if end is None else min(chunk_size, end - offset)
+            data = await run(os.pread, fd, size, offset)
+            if not data:
+                break
+            offset += len(data)
+            yield data
+    finally:
+        os.close(fd)
+
+
+async def read_frames(path, start=0, end=None):
+    """Like read_chunks, for files written with a compression algorithm."""
+    fd = await run(os.open, path, os.O_RDONLY)
+    try:
+        reader = await run(FrameReader, fd)
+        for frame_no, lo, hi in reader.frames_for(start, end):
+            data = await run(reader.read_frame, frame_no)
+            yield data[lo:hi]
+    finally:
+        os.close(fd)
+
+
+async def write_chunks(path, chunks, chunk_size=CHUNK_SIZE, algorithm=None):
+    """
+    Write an async iterable of bytes to path, coalescing small chunks so each
+    trip to the I/O pool carries about chunk_size bytes. With an algorithm
+    the data is compressed into seekable frames on the way. Returns the
+    uncompressed size and hex MD5 of what was written.
+    """
+    file_hash = hashlib.md5()
+    size = 0
+    buffer = bytearray()
+    fp = await run(open, path, "wb")
+    try:
+        sink = FrameWriter(fp, algorithm) if algorithm else fp
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            buffer += chunk
+            size += len(chunk)
+            if len(buffer) >= chunk_size:
+                await run(_write, sink, bytes(buffer), file_hash)
+                buffer.clear()
+        if buffer:
+            await run(_write, sink, bytes(buffer), file_hash)
+        if algorithm:
+            await run(sink.close)
+    finally:
+        await run(fp.close)
+    return size, file_hash.hexdigest()
+
+
+async def read_file(fp, chunk_size=CHUNK_SIZE):
+    """Yield the rest of an open binary file object in chunks, e.g. a spooled form upload."""
+    while True:
+        data = await run(fp.read, chunk_size)
+        if not data:
+            break
+        yield data
+
+
+def remaining_size(fp):
+    position = fp.tell()
+    size = fp.seek(0, os.SEEK_END) - position
+    fp.seek(position)
+    return size
@@ -1,6 +1,6 @@
-import xmltodict
 from datetime import datetime, timezone
 from fastapi import Response
+from . import serializer
 from .utils import (string_to_bytes,
                     get_host_id)
 
@@ -8,19 +8,30 @@ response_dt_fmt = "%Y-%m-%dT%H:%M:%SZ"
 
 
 def error_response(message, code, status_code=400, extra_args={}):
-    result = {"Error": {"Code": code, "Message": message}}
-    if extra_args:
-        result["Error"].update(extra_args)
-    content = xmltodict.unparse(result)
+    content = serializer.error(code, message, extra_args)
     return Response(content, media_type="application/xml", status_code=status_code)
 
 
+def xml_response(content, status_code=200, headers=None):
+    return Response(content, media_type="application/xml", status_code=status_code, headers=headers)
+
+
 def success_response(response_dict, status_code=200, headers=None):
-    response_dict[list(response_dict.keys())[0]]["@xmlns"] = "http://s3.amazonaws.com/doc/2006-03-01"
-    content = xmltodict.unparse(response_dict)
-    if headers:
-        return Response(content, media_type="application/xml", status_code=status_code, headers=headers)
-    return Response(content, media_type="application/xml", status_code=status_code)
+    return xml_response(serializer.to_xml(response_dict, xmlns=True), status_code, headers)
+
+
+def list_objects_result(bucket, page, encoding_type, prefix, marker, delimiter, max_keys):
+    return xml_response(serializer.list_objects(bucket, page, encoding_type, prefix, marker, delimiter, max_keys))
+
+
+def list_objects_v2_result(bucket, page, encoding_type, prefix, continuation_token, start_after, delimiter, max_keys):
+    return xml_response(serializer.list_objects_v2(bucket, page, encoding_type, prefix, continuation_token,
+                                                   start_after, delimiter, max_keys))
+
+
+def list_object_versions_result(bucket, page, encoding_type, prefix, key_marker, version_id_marker, delimiter, max_keys):
+    return xml_response(serializer.list_object_versions(bucket, page, encoding_type, prefix, key_marker,
+                                                        version_id_marker, delimiter, max_keys))
 
 
 def invalid_signature(access_key_id, sign_string, signature, request_id):
@@ -68,6 +79,100 @@ def invalid_key(file_name, request_id):
     return error_response(msg, code, status_code, extra_args)
 
 
+def invalid_version(file_name, version_id, request_id):
+    code = "NoSuchVersion"
+    msg = "The specified version does not exist."
+    status_code = 404
+    extra_args = {
+        "Key": file_name,
+        "VersionId": version_id,
+        "RequestID": request_id
+    }
+    return error_response(msg, code, status_code, extra_args)
+
+
+def no_such_upload(upload_id, request_id):
+    code = "NoSuchUpload"
+    msg = "The specified multipart upload does not exist. The upload ID might be invalid, or the multipart upload might have been aborted or completed."
+    status_code = 404
+    extra_args = {
+        "UploadId": upload_id,
+        "RequestId": request_id,
+        "HostId": get_host_id()
+    }
+    return error_response(msg, code, status_code, extra_args)
+
+
+def invalid_argument(message, name, value, request_id):
+    code = "InvalidArgument"
+    status_code = 400
+    extra_args = {
+        "ArgumentName": name,
+        "ArgumentValue": value,
+        "RequestId": request_id,
+        "HostId": get_host_id()
+    }
+    return error_response(message, code, status_code, extra_args)
+
+
+def method_not_allowed(method, request_id):
+    code = "MethodNotAllowed"
+    msg = "The specified method is not allowed against this resource."
+    status_code = 405
+    extra_args = {
+        "Method": method,
+        "ResourceType": "DeleteMarker",
+        "RequestId": request_id,
+        "HostId": get_host_id()
+    }
+    response = error_response(msg, code, status_code, extra_args)
+    response.headers["x-amz-delete-marker"] = "true"
+    return response
+
+
+def not_implemented(message, request_id):
+    code = "NotImplemented"
+    status_code = 501
+    extra_args = {
+        "RequestId": request_id,
+        "HostId": get_host_id()
+    }
+    return error_response(message, code, status_code, extra_args)
+
+
+def malformed_xml(request_id):
+    code = "MalformedXML"
+    msg = "The XML you provided was not well-formed or did not validate against our published schema."
+    status_code = 400
+    extra_args = {
+        "RequestId": request_id,
+        "HostId": get_host_id()
+    }
+    return error_response(msg, code, status_code, extra_args)
+
+
+def no_such_lifecycle_configuration(bucket_name, request_id):
+    code = "NoSuchLifecycleConfiguration"
+    msg = "The lifecycle configuration does not exist"
+    status_code = 404
+    extra_args = {
+        "BucketName": bucket_name,
+        "RequestId": request_id,
+        "HostId": get_host_id()
+    }
+    return error_response(msg, code, status_code, extra_args)
+
+
+def invalid_range(size, request_id):
+    code = "InvalidRange"
+    msg = "The requested range is not satisfiable"
+    status_code = 416
+    extra_args = {
+        "ActualObjectSize": size,
+        "RequestId": request_id,
+        "HostId": get_host_id()
+    }
+    return error_response(msg, code, status_code, extra_args)
 
 
 def bucket_not_empty(bucket_name, request_id):
@@ -95,26 +200,81 @@ def request_expired(expiry, request_id):
     return error_response(msg, code, status_code, extra_args)
 
 
-def multipart_upload_result(location, bucket, etag, headers=None):
-    response_dict = {
-        "CompleteMultipartUploadResult": {
-            "Location": location,
-            "Bucket": bucket,
-            "Etag": "&#34;{}&#34;".format(etag)
-        }
+def access_denied(message, request_id):
+    code = "AccessDenied"
+    status_code = 403
+    extra_args = {
+        "RequestId": request_id,
+        "HostId": get_host_id()
     }
-    return success_response(response_dict, 200, headers)
+    return error_response(message, code, status_code, extra_args)
 
 
-def multipart_upload_start(bucket, path, upload_id, headers=None):
-    response_dict = {
-        "InitiateMultipartUploadResult": {
-            "Bucket": bucket,
-            "Key": path,
-            "UploadId": upload_id
-        }
+def invalid_access_key(access_key_id, request_id):
+    code = "InvalidAccessKeyId"
+    msg = "The AWS Access Key Id you provided does not exist in our records."
+    status_code = 403
+    extra_args = {
+        "AWSAccessKeyId": access_key_id,
+        "RequestId": request_id,
+        "HostId": get_host_id()
     }
-    return success_response(response_dict, 200, headers)
+    return error_response(msg, code, status_code, extra_args)
+
+
+def select_error(code, message, request_id):
+    status_code = 400
+    extra_args = {
+        "RequestId": request_id,
+        "HostId": get_host_id()
+    }
+    return error_response(message, code, status_code, extra_args)
+
+
+def slow_down(retry_after, request_id):
+    code = "SlowDown"
+    msg = "Please reduce your request rate."
+    status_code = 503
+    extra_args = {
+        "RequestId": request_id,
+        "HostId": get_host_id()
+    }
+    response = error_response(msg, code, status_code, extra_args)
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+def authorization_query_parameters_error(message, request_id):
+    code = "AuthorizationQueryParametersError"
+    status_code = 400
+    extra_args = {
+        "RequestId": request_id,
+        "HostId": get_host_id()
+    }
+    return error_response(message, code, status_code, extra_args)
+
+
+def entity_size_error(code, size, limit_name, limit, request_id):
+    if code == "EntityTooSmall":
+        msg = "Your proposed upload is smaller than the minimum allowed size"
+    else:
+        msg = "Your proposed upload exceeds the maximum allowed size"
+    status_code = 400
+    extra_args = {
+        "ProposedSize": size,
+        limit_name: limit,
+        "RequestId": request_id,
+        "HostId": get_host_id()
+    }
+    return error_response(msg, code, status_code, extra_args)
+
+
+def multipart_upload_result(location, bucket, path, etag, headers=None):
+    return xml_response(serializer.complete_multipart_upload(location, bucket, path, etag), 200, headers)
+
+
+def multipart_upload_start(bucket, path, upload_id, headers=None):
+    return xml_response(serializer.initiate_multipart_upload(bucket, path, upload_id), 200, headers)
 
 
 def no_content(headers=None):
@@ -122,9 +282,20 @@ def no_content(headers=None):
 
 
 def multiple_obj_delete_successful(deleted_files, headers=None):
+    """deleted_files holds (key, version_id, delete_marker_version_id) tuples."""
+    deleted = []
+    for key, version_id, marker_version_id in deleted_files:
+        entry = {"Key": key}
+        if version_id:
+            entry["VersionId"] = version_id
+        if marker_version_id:
+            # The delete created a marker, or removed one.
+            entry["DeleteMarker"] = True
+            entry["DeleteMarkerVersionId"] = marker_version_id
+        deleted.append(entry)
     response_dict = {
         "DeleteResult": {
-            "Deleted": [{"Key": i, "VersionId": None} for i in deleted_files]
+            "Deleted": deleted
         }
     }
     return success_response(response_dict, 200, headers)
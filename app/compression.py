@@ -0,0 +1,143 @@
+import os
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+FRAME_SIZE = 1024 * 1024
+MAGIC = b"PS3FRMv1"
+# uncompressed size, frame size, frame count, algorithm, magic
+FOOTER = struct.Struct("<QIIB8s")
+FRAME_LENGTH = struct.Struct("<I")
+
+ALGORITHMS = {"gzip": 1, "zstd": 2}
+_NAMES = {v: k for k, v in ALGORITHMS.items()}
+
+
+def available(algorithm):
+    if algorithm == "gzip":
+        return True
+    if algorithm == "zstd":
+        return zstandard is not None
+    return False
+
+
+def _compress(algorithm, data):
+    if algorithm == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    # Every frame is a complete gzip member, so the frames on their own
+    # still form a valid multi-member gzip stream.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _decompress(algorithm, data):
+    if algorithm == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data, 31)
+
+
+# How the first frame of each algorithm starts.
+_FRAME_MAGIC = {"gzip": b"\x1f\x8b", "zstd": b"\x28\xb5\x2f\xfd"}
+
+
+def _layout(fd):
+    """
+    (size, frame_size, algorithm, frame offsets) of a file written by
+    FrameWriter, None for anything else. The footer alone could be part of
+    the user's bytes, so the frame table must also add up to the file size
+    and the first frame must start like the algorithm's output.
+    """
+    stored_size = os.fstat(fd).st_size
+    if stored_size < FOOTER.size:
+        return None
+    size, frame_size, count, algorithm, magic = FOOTER.unpack(os.pread(fd, FOOTER.size, stored_size - FOOTER.size))
+    name = _NAMES.get(algorithm)
+    if magic != MAGIC or name is None or not frame_size or count != -(-size // frame_size):
+        return None
+    table_offset = stored_size - FOOTER.size - count * FRAME_LENGTH.size
+    if table_offset < 0:
+        return None
+    offsets = [0]
+    for (length,) in FRAME_LENGTH.iter_unpack(os.pread(fd, count * FRAME_LENGTH.size, table_offset)):
+        offsets.append(offsets[-1] + length)
+    if offsets[-1] != table_offset:
+        return None
+    if count and os.pread(fd, len(_FRAME_MAGIC[name]), 0) != _FRAME_MAGIC[name]:
+        return None
+    return size, frame_size, name, offsets
+
+
+def detect(fd):
+    """Algorithm of a file written by FrameWriter, None for anything else."""
+    layout = _layout(fd)
+    return layout[2] if layout else None
+
+
+class FrameWriter:
+    """
+    Compresses a byte stream into independently decodable frames of
+    frame_size uncompressed bytes, followed by a table of frame lengths and a
+    fixed size footer. The table lets a reader seek to any offset by
+    decompressing a single frame.
+    """
+
+    def __init__(self, fp, algorithm, frame_size=FRAME_SIZE):
+        if not available(algorithm):
+            raise ValueError("Compression {} is not available".format(algorithm))
+        self.fp = fp
+        self.algorithm = algorithm
+        self.frame_size = frame_size
+        self.buffer = bytearray()
+        self.frames = []
+        self.size = 0
+
+    def _flush_frame(self, data):
+        frame = _compress(self.algorithm, bytes(data))
+        self.fp.write(frame)
+        self.frames.append(len(frame))
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.frame_size:
+            self._flush_frame(self.buffer[:self.frame_size])
+            del self.buffer[:self.frame_size]
+
+    def close(self):
+        if self.buffer:
+            self._flush_frame(self.buffer)
+            self.buffer.clear()
+        self.fp.write(b"".join(FRAME_LENGTH.pack(i) for i in self.frames))
+        self.fp.write(FOOTER.pack(self.size, self.frame_size, len(self.frames), ALGORITHMS[self.algorithm], MAGIC))
+
+
+class FrameReader:
+    """Random access reader for files written by FrameWriter, over a raw fd."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        layout = _layout(fd)
+        if layout is None:
+            raise ValueError("Not a compressed object")
+        self.size, self.frame_size, self.algorithm, self.offsets = layout
+
+    def read_frame(self, frame_no):
+        start, end = self.offsets[frame_no], self.offsets[frame_no + 1]
+        return _decompress(self.algorithm, os.pread(self.fd, end - start, start))
+
+    def frames_for(self, start, end):
+        """Yield (frame_no, lo, hi) so frame[lo:hi] pieces cover [start, end)."""
+        end = self.size if end is None else min(end, self.size)
+        frame_no = start // self.frame_size
+        while frame_no * self.frame_size < end:
+            frame_start = frame_no * self.frame_size
+            yield frame_no, max(start - frame_start, 0), min(end - frame_start, self.frame_size)
+            frame_no += 1
+
+    def read(self, start=0, end=None):
+        return b"".join(self.read_frame(i)[lo:hi] for i, lo, hi in self.frames_for(start, end))
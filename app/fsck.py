@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Check buckets for damage left by crashes or by editing the data root by
+hand: partial uploads, files the index does not know about, index records
+whose file is gone, orphan version files and metadata of deleted keys.
+Buckets are checked in parallel, one process each, and the keys of large
+buckets are split over several processes. With --repair the
+problems are fixed, damaged files are moved to <data_root>/.quarantine.
+Safe to run while the server is up.
+
+    python -m app.fsck [--repair] [--verify] [--jobs N] [bucket ...]
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from . import aio
+from .locks import LeaderLock, lock_dir
+from .settings import settings
+
+
+logger = logging.getLogger(__name__)
+
+SAMPLES = 20
+# Buckets with more objects than this are split into shards checked in
+# parallel, at most one per job.
+SHARD_OBJECTS = 10000
+DONE_MARKER = "fsck.done"
+
+
+class FsckReport:
+    """Problems found in one bucket, counted by kind with a few sample names each."""
+
+    def __init__(self, bucket, region, repair=False):
+        self.bucket = bucket
+        self.region = region
+        self.repair = repair
+        self.scanned = 0
+        self.issues = {}
+        self.samples = {}
+        self.error = None
+
+    def add(self, kind, name):
+        self.issues[kind] = self.issues.get(kind, 0) + 1
+        samples = self.samples.setdefault(kind, [])
+        if len(samples) < SAMPLES:
+            samples.append(name)
+
+    def as_dict(self):
+        return {
+            "bucket": self.bucket,
+            "region": self.region,
+            "repaired": self.repair,
+            "scanned": self.scanned,
+            "issues": self.issues,
+            "samples": self.samples,
+            "error": self.error,
+        }
+
+
+def merge_reports(reports):
+    """Combine the reports of the shards of one bucket."""
+    merged = dict(reports[0], issues=dict(reports[0]["issues"]),
+                  samples={kind: list(names) for kind, names in reports[0]["samples"].items()})
+    for report in reports[1:]:
+        merged["scanned"] += report["scanned"]
+        merged["error"] = merged["error"] or report["error"]
+        merged["seconds"] = max(merged["seconds"], report["seconds"])
+        for kind, count in report["issues"].items():
+            merged["issues"][kind] = merged["issues"].get(kind, 0) + count
+            samples = merged["samples"].setdefault(kind, [])
+            samples.extend(report["samples"][kind][:SAMPLES - len(samples)])
+    return merged
+
+
+def check_bucket(name, region, repair=False, verify=False, shard=0, shards=1):
+    """Check one bucket or shard of it, runs in a worker process and returns the report as a dict."""
+    model = importlib.import_module("app.{}".format(settings.model))
+    report = FsckReport(name, region, repair)
+    started = time.monotonic()
+    try:
+        bucket = model.S3Bucket(name, region)
+        bucket.fsck(report, repair=repair, verify=verify, temp_age=settings.fsck_temp_age,
+                    upload_age=settings.fsck_upload_age, shard=shard, shards=shards)
+    except Exception as error:
+        logger.exception("Checking bucket %s failed", name)
+        report.error = str(error)
+    result = report.as_dict()
+    result["seconds"] = round(time.monotonic() - started, 3)
+    return result
+
+
+def run(buckets=None, repair=False, verify=False, jobs=None):
+    """Yield the report of every bucket as it completes."""
+    model = importlib.import_module("app.{}".format(settings.model))
+    targets = sorted((name, region) for name, region in model.S3().buckets.items() if not buckets or name in buckets)
+    jobs = jobs or settings.fsck_jobs or os.cpu_count() or 1
+    tasks = [(name, region, shard, shards) for name, region in targets
+             for shards in [_shards(model, name, region, jobs)] for shard in range(shards)]
+    if min(jobs, len(tasks)) <= 1:
+        for name, region, shard, shards in tasks:
+            yield check_bucket(name, region, repair, verify)
+        return
+    pending = {}
+    # spawn, forking a server process that already runs threads is unsafe.
+    with ProcessPoolExecutor(min(jobs, len(tasks)), mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(check_bucket, name, region, repair, verify, shard, shards): (name, shards)
+                   for name, region, shard, shards in tasks}
+        for future in as_completed(futures):
+            name, shards = futures[future]
+            done = pending.setdefault(name, [])
+            done.append(future.result())
+            if len(done) == shards:
+                yield merge_reports(pending.pop(name))
+
+
+def _shards(model, name, region, jobs):
+    try:
+        objects = model.S3Bucket(name, region).index.usage()["objects"]
+    except Exception:
+        # Left to the check of the bucket to report.
+        return 1
+    return max(1, min(jobs, objects // SHARD_OBJECTS))
+
+
+def _server_id():
+    """
+    Identity of the supervisor process (uvicorn --workers, gunicorn) this
+    worker was started by, None when the worker is the server itself.
+    Workers it replaces later have the same one, a restarted server does not.
+    """
+    parent = os.getppid()
+    try:
+        if os.path.realpath("/proc/{}/exe".format(parent)) != os.path.realpath("/proc/self/exe"):
+            return None
+        with open("/proc/{}/stat".format(parent)) as fp:
+            started = fp.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+    return "{}:{}".format(parent, started)
+
+
+def _read_marker(path):
+    try:
+        with open(path) as fp:
+            return fp.read()
+    except FileNotFoundError:
+        return None
+
+
+def _write_marker(path, server):
+    with open(path + ".tmp", "w") as fp:
+        fp.write(server)
+    os.replace(path + ".tmp", path)
+
+
+async def startup_check(mode=None):
+    """
+    Run once when the server starts, in the worker that wins the leader
+    lock. A done marker keeps workers the supervisor recycles later from
+    checking again.
+    """
+    mode = settings.fsck_on_startup if mode is None else mode
+    if mode not in ("check", "repair"):
+        return
+    leader = LeaderLock("fsck")
+    if not leader.acquire():
+        return
+    try:
+        server = _server_id()
+        marker = os.path.join(lock_dir(), DONE_MARKER)
+        if server and await aio.run(_read_marker, marker) == server:
+            return
+        reports = await aio.run(lambda: list(run(repair=mode == "repair")))
+        for report in reports:
+            if report["issues"] or report["error"]:
+                logger.warning("fsck %s: %s", report["bucket"], json.dumps(report))
+        logger.info("fsck checked %d buckets", len(reports))
+        if server:
+            await aio.run(_write_marker, marker, server)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception("Startup fsck failed")
+    finally:
+        leader.release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("buckets", nargs="*", help="buckets to check, all of them by default")
+    parser.add_argument("--repair", action="store_true", help="fix the problems found")
+    parser.add_argument("--verify", action="store_true", help="also hash every object and compare its ETag")
+    parser.add_argument("--jobs", type=int, default=None, help="buckets checked in parallel, the CPU count by default")
+    args = parser.parse_args()
+
+    dirty = False
+    for report in run(args.buckets, args.repair, args.verify, args.jobs):
+        print(json.dumps(report), flush=True)
+        dirty = dirty or report["error"] is not None or (bool(report["issues"]) and not args.repair)
+    sys.exit(1 if dirty else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import asyncio
+import datetime
+import logging
+import xmltodict
+
+from . import aio
+from .locks import LeaderLock
+from .settings import settings
+
+
+DAY = 86400
+
+logger = logging.getLogger(__name__)
+
+
+class UnsupportedRule(ValueError):
+    """A valid rule using a feature the scheduler can't honour, such as tag filters."""
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _element(item, name):
+    value = item.get(name)
+    if value is not None and not isinstance(value, dict):
+        raise ValueError("{} must be an element".format(name))
+    return value
+
+
+def _text(item, name):
+    value = item.get(name)
+    if value is not None and not isinstance(value, str):
+        raise ValueError("{} must be text".format(name))
+    return value
+
+
+def _positive_int(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("Days must be a positive integer")
+    if value <= 0:
+        raise ValueError("Days must be a positive integer")
+    return value
+
+
+def _timestamp(value):
+    if not isinstance(value, str):
+        raise ValueError("Date must be text")
+    date = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if not date.tzinfo:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+
+def _filter_prefix(item):
+    """Prefix a rule applies to. Only prefix filters are supported, anything else would widen the rule."""
+    if "Filter" not in item:
+        return _text(item, "Prefix") or ""
+    rule_filter = _element(item, "Filter") or {}
+    unsupported = set(rule_filter) - {"Prefix"}
+    if unsupported:
+        raise UnsupportedRule("Lifecycle filters on {} are not supported".format(", ".join(sorted(unsupported))))
+    return _text(rule_filter, "Prefix") or ""
+
+
+def parse_lifecycle_configuration(body):
+    """
+    Parse a LifecycleConfiguration document into the normalized rule list
+    stored with the bucket. Raises ValueError for anything we can't honour.
+    """
+    try:
+        config = xmltodict.parse(body)["LifecycleConfiguration"]
+    except (KeyError, TypeError, xmltodict.expat.ExpatError):
+        raise ValueError("Invalid lifecycle configuration")
+    if config is not None and not isinstance(config, dict):
+        raise ValueError("Invalid lifecycle configuration")
+    rules = []
+    for item in _as_list((config or {}).get("Rule")):
+        if not isinstance(item, dict):
+            raise ValueError("Rule must be an element")
+        rule = {"ID": _text(item, "ID") or "", "Status": item.get("Status"), "Prefix": _filter_prefix(item)}
+        if rule["Status"] not in ("Enabled", "Disabled"):
+            raise ValueError("Invalid rule status")
+        expiration = _element(item, "Expiration")
+        if expiration:
+            if expiration.get("Days"):
+                rule["ExpirationDays"] = _positive_int(expiration["Days"])
+            elif expiration.get("Date"):
+                rule["ExpirationDate"] = _timestamp(expiration["Date"])
+        noncurrent = _element(item, "NoncurrentVersionExpiration")
+        if noncurrent is not None:
+            rule["NoncurrentDays"] = _positive_int(noncurrent.get("NoncurrentDays"))
+        abort = _element(item, "AbortIncompleteMultipartUpload")
+        if abort is not None:
+            rule["AbortDays"] = _positive_int(abort.get("DaysAfterInitiation"))
+        if not ({"ExpirationDays", "ExpirationDate", "NoncurrentDays", "AbortDays"} & set(rule)):
+            raise ValueError("Rule has no action")
+        rules.append(rule)
+    if not rules:
+        raise ValueError("No rules")
+    return rules
+
+
+def lifecycle_configuration(rules):
+    data = []
+    for rule in rules:
+        item = {"ID": rule["ID"], "Filter": {"Prefix": rule["Prefix"]}, "Status": rule["Status"]}
+        if "ExpirationDays" in rule:
+            item["Expiration"] = {"Days": rule["ExpirationDays"]}
+        elif "ExpirationDate" in rule:
+            date = datetime.datetime.fromtimestamp(rule["ExpirationDate"], tz=datetime.timezone.utc)
+            item["Expiration"] = {"Date": date.strftime(settings.date_fmt)}
+        if "NoncurrentDays" in rule:
+            item["NoncurrentVersionExpiration"] = {"NoncurrentDays": rule["NoncurrentDays"]}
+        if "AbortDays" in rule:
+            item["AbortIncompleteMultipartUpload"] = {"DaysAfterInitiation": rule["AbortDays"]}
+        data.append(item)
+    return {"LifecycleConfiguration": {"Rule": data}}
+
+
+def active_rules(rules):
+    return [i for i in rules or [] if i["Status"] == "Enabled"]
+
+
+def is_expired(rules, key, mtime, now):
+    for rule in rules:
+        if not key.startswith(rule["Prefix"]):
+            continue
+        if "ExpirationDays" in rule and now - mtime >= rule["ExpirationDays"] * DAY:
+            return True
+        if "ExpirationDate" in rule and now >= rule["ExpirationDate"]:
+            return True
+    return False
+
+
+def is_noncurrent_expired(rules, key, noncurrent_since, now):
+    for rule in rules:
+        if key.startswith(rule["Prefix"]) and "NoncurrentDays" in rule:
+            if now - noncurrent_since >= rule["NoncurrentDays"] * DAY:
+                return True
+    return False
+
+
+def abort_after(rules):
+    """
+    Smallest DaysAfterInitiation in seconds among the rules without a prefix.
+    Uploads don't record their key until they are completed, so prefixed
+    abort rules can't be matched and are skipped rather than guessed.
+    """
+    days = [i["AbortDays"] for i in rules if "AbortDays" in i and not i["Prefix"]]
+    return min(days) * DAY if days else None
+
+
+class LifecycleScheduler:
+    """
+    Background task evaluating bucket lifecycle rules inside the server
+    process. Each bucket is walked through its index in batches on the
+    threadpool, and the task sleeps between batches in proportion to the
+    number of objects it removed so expiring a large backlog never uses
+    more than `rate` deletions per second of disk time. When several workers
+    share a data root only the one holding the leader lock runs the rules.
+    """
+
+    def __init__(self, storage, bucket_class, interval=None, rate=None, batch_size=None):
+        self.storage = storage
+        self.bucket_class = bucket_class
+        self.interval = settings.lifecycle_interval if interval is None else interval
+        self.rate = settings.lifecycle_rate if rate is None else rate
+        self.batch_size = settings.lifecycle_batch_size if batch_size is None else batch_size
+        self.task = None
+        self.leader = LeaderLock("lifecycle")
+
+    def start(self):
+        if self.interval > 0 and self.task is None:
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.leader.release()
+
+    async def run(self):
+        while True:
+            try:
+                if self.leader.acquire():
+                    await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Lifecycle run failed")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        buckets = await aio.run(lambda: dict(self.storage().buckets))
+        for name, region in buckets.items():
+            await self.process_bucket(name, region)
+
+    async def process_bucket(self, name, region):
+        bucket = await aio.run(self.bucket_class, name, region)
+        rules = await aio.run(lambda: bucket.exists and bucket.lifecycle_rules)
+        if not active_rules(rules):
+            return
+        now = datetime.datetime.now(tz=datetime.timezone.utc).timestamp()
+        await aio.run(bucket.abort_incomplete_uploads, now)
+        cursor = None
+        while True:
+            cursor, expired = await aio.run(bucket.expire_objects, now, cursor, self.batch_size)
+            await asyncio.sleep(expired / self.rate if self.rate > 0 else 0)
+            if cursor is None:
+                break
@@ -0,0 +1,98 @@
+import fcntl
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+
+from .settings import settings
+
+
+_held = threading.local()
+
+
+def lock_dir():
+    path = os.path.join(settings.data_root, ".locks")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _lock_path(name):
+    digest = hashlib.md5(name.encode("utf-8")).hexdigest()
+    directory = os.path.join(lock_dir(), digest[:2])
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, digest + ".lock")
+
+
+def _acquire(path):
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            # The previous holder may have unlinked the file while we waited.
+            if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+@contextmanager
+def file_lock(name):
+    """
+    Exclusive lock on name shared by every worker process using the same
+    data root. Each name has its own lock file, created on acquisition and
+    removed on release, so unrelated names never wait on each other. Locks
+    are reentrant within a thread. Nested locks are always taken in the
+    order upload, key, meta, replication (and bucket before replication),
+    which keeps processes from deadlocking.
+    """
+    path = _lock_path(name)
+    held = getattr(_held, "locks", None)
+    if held is None:
+        held = _held.locks = {}
+    if path in held:
+        held[path] += 1
+        try:
+            yield
+        finally:
+            held[path] -= 1
+        return
+    fd = _acquire(path)
+    held[path] = 1
+    try:
+        yield
+    finally:
+        del held[path]
+        os.unlink(path)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class LeaderLock:
+    """
+    Non blocking lock used to elect one worker for background jobs. The lock
+    is kept until the process exits, at which point another worker picks it
+    up on its next attempt.
+    """
+
+    def __init__(self, name):
+        self.path = os.path.join(lock_dir(), "{}.leader".format(name))
+        self.fd = None
+
+    def acquire(self):
+        if self.fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
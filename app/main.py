@@ -1,25 +1,37 @@
 #!/usr/bin/env python3
 
-import base64
+import asyncio
 import datetime
-import json
 import xmltodict
 from typing import Union, Any
-from fastapi import FastAPI, Response, Request, Query, File, Form
+from fastapi import FastAPI, Response, Request, Query, File
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
 from .settings import settings
 
+from . import aio
+from . import fsck
+from . import presign
+from . import s3select
+from . import throttle
 from . import aws_responses as AWSResponse
+from .admin import usage_report, prometheus_metrics
+from .lifecycle import LifecycleScheduler, UnsupportedRule, parse_lifecycle_configuration, lifecycle_configuration
+from .replication import Replicator
 from .utils import (
-    get_etag, get_signature, get_sha256_signature,
-    prepare_sign_string, get_amzn_requestid,
-    get_upload_id, get_secret_key
+    get_sha256_signature, get_amzn_requestid,
+    get_upload_id, parse_range
 )
 
 exec("from .{} import *".format(settings.model))
 
 # Server Logic
 app = FastAPI()
+lifecycle_scheduler = LifecycleScheduler(S3, S3Bucket)
+replicator = Replicator(S3, S3Bucket, S3Object)
+admission = throttle.AdmissionControl()
+# Added first so it runs inside set_region, after the signature check.
+app.add_middleware(throttle.AdmissionMiddleware, admission=admission)
 
 
 def DashingQuery(default: Any, *, convert_underscores=True, **kwargs) -> Any:
@@ -28,20 +40,41 @@ def DashingQuery(default: Any, *, convert_underscores=True, **kwargs) -> Any:
     return query
 
 
-def split_query_params(params):
-    def query(q):
-        if len(q) == 1:
-            q.append(None)
-        elif len(q) > 2:
-            q = [q[0], "=".join(q[1:])]
-        return q
-    return dict([query(list(i.split("="))) for i in params.split("&")])
+def presign_error_response(error, request_id):
+    if isinstance(error, presign.InvalidAccessKey):
+        return AWSResponse.invalid_access_key(error.access_key, request_id)
+    if isinstance(error, presign.SignatureMismatch):
+        return AWSResponse.invalid_signature(error.access_key, error.string_to_sign, error.signature, request_id)
+    if isinstance(error, presign.RequestExpired):
+        return AWSResponse.request_expired(error.expiry, request_id)
+    if isinstance(error, presign.EntitySizeError):
+        return AWSResponse.entity_size_error(error.code, error.size, error.limit_name, error.limit, request_id)
+    if isinstance(error, presign.MalformedRequest):
+        return AWSResponse.authorization_query_parameters_error(str(error), request_id)
+    return AWSResponse.access_denied(str(error), request_id)
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    app.state.fsck = asyncio.get_event_loop().create_task(fsck.startup_check())
+    lifecycle_scheduler.start()
+    replicator.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    app.state.fsck.cancel()
+    await lifecycle_scheduler.stop()
+    await replicator.stop()
 
 
 @app.middleware("http")
 async def set_region(request: Request, call_next):
     request_id = get_amzn_requestid()
     request.state.request_id = request_id
+    # Only set once a signature has actually been checked, a region alone
+    # can come from the Host header or an unverified credential.
+    request.state.authenticated = False
     authorization = request.headers.get("Authorization", "")
     host = request.headers.get("host", "")
     if "amazonaws.com" in host:
@@ -55,6 +88,20 @@ async def set_region(request: Request, call_next):
         if settings.validate_signature:
             if get_sha256_signature(request, authorization_headers["AWS4-HMAC-SHA256 Credential"]) != authorization_headers["Signature"]:
                 return AWSResponse.invalid_signature("", "", "", request.state.request_id)
+            request.state.authenticated = True
+    elif presign.is_presigned(request.query_params):
+        # Presigned GET/PUT/HEAD/DELETE urls, SigV2 or SigV4 query auth.
+        raw_path = request.scope.get("raw_path")
+        raw_path = raw_path.decode().split("?")[0] if raw_path else request.scope["path"]
+        try:
+            region = presign.verify_query(request.method, request.scope["path"], raw_path, request.query_params.multi_items(), request.headers)
+        except presign.PresignError as error:
+            return presign_error_response(error, request_id)
+        region = region or S3Obj.region_of(request.scope["path"].split("/")[1])
+        if not region:
+            return AWSResponse.invalid_location(request_id)
+        request.state.aws_region = region
+        request.state.authenticated = settings.validate_signature
     # else:
     #     print("!!!!!!!!!!!!!!!!!!!!! not authorization !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!1", request.headers)
     #     request.state.aws_region = 'us-east-1'
@@ -78,31 +125,99 @@ async def list_buckets(request: Request, response: Response):
 #         aws_responses.invalid_key("test", "rest")
 
 
+# Admin endpoints live under a prefix that can never be a valid bucket name.
+def admin_denied(request):
+    """Response refusing an admin request, None when it may go ahead."""
+    if not settings.admin_api:
+        return Response(status_code=404)
+    if not request.state.authenticated:
+        return AWSResponse.access_denied("Admin requests must be signed.", request.state.request_id)
+    return None
+
+
+@app.get("/_admin/usage")
+async def admin_usage(request: Request, bucket: str = Query(None)):
+    denied = admin_denied(request)
+    if denied:
+        return denied
+    return JSONResponse(await aio.run(usage_report, S3, S3Bucket, bucket))
+
+
+@app.get("/_admin/metrics")
+async def admin_metrics(request: Request):
+    denied = admin_denied(request)
+    if denied:
+        return denied
+    return PlainTextResponse(prometheus_metrics(await aio.run(usage_report, S3, S3Bucket)))
+
+
+@app.get("/_admin/replication")
+async def admin_replication(request: Request):
+    denied = admin_denied(request)
+    if denied:
+        return denied
+    return JSONResponse(await aio.run(replicator.status))
+
+
+@app.post("/_admin/reindex")
+async def admin_reindex(request: Request, bucket: str = Query(...)):
+    denied = admin_denied(request)
+    if denied:
+        return denied
+    region = S3Obj.region_of(bucket)
+    if not region:
+        return AWSResponse.invalid_location(request.state.request_id)
+    return JSONResponse({"bucket": bucket, "indexed": await aio.run(S3Bucket(bucket, region).reindex)})
+
+
 @app.get("/{bucket_name}")
 async def list_objects(bucket_name: Union[str, None], request: Request, response: Response, 
                        encoding_type: str = DashingQuery(None), list_type: str = DashingQuery(None),
                        versions: str = DashingQuery("no"), marker: str = DashingQuery(None),
                        continuation_token: str = DashingQuery(None), prefix: str = DashingQuery(None),
-                       max_keys: int = DashingQuery(1000), delimiter: str = DashingQuery(None)):
+                       max_keys: int = DashingQuery(1000), delimiter: str = DashingQuery(None),
+                       key_marker: str = DashingQuery(None), version_id_marker: str = DashingQuery(None),
+                       versioning: str = DashingQuery(None), lifecycle: str = DashingQuery(None),
+                       compression: str = DashingQuery(None), start_after: str = DashingQuery(None)):
     bucket = S3Bucket(bucket_name, request.state.aws_region)
     if not bucket.exists:
         return AWSResponse.invalid_location(request.state.request_id)
+    if versioning is not None:
+        return AWSResponse.success_response(await aio.run(bucket.get_versioning))
+    if compression is not None:
+        return AWSResponse.success_response(await aio.run(bucket.get_compression))
+    if lifecycle is not None:
+        rules = await aio.run(lambda: bucket.lifecycle_rules)
+        if not rules:
+            return AWSResponse.no_such_lifecycle_configuration(bucket_name, request.state.request_id)
+        return AWSResponse.success_response(lifecycle_configuration(rules))
     if versions == "no":
         if list_type == "2":
-            data = bucket.list_objects_v2(encoding_type, prefix, max_keys, continuation_token, delimiter)
-        else:
-            data = bucket.list_objects(encoding_type, prefix, max_keys, marker, delimiter)
-        return AWSResponse.success_response(data)
+            page = await aio.run(bucket.list_objects_v2, prefix, max_keys, continuation_token, delimiter, start_after)
+            return AWSResponse.list_objects_v2_result(bucket_name, page, encoding_type, prefix, continuation_token,
+                                                      start_after, delimiter, max_keys)
+        page = await aio.run(bucket.list_objects, prefix, max_keys, marker, delimiter)
+        return AWSResponse.list_objects_result(bucket_name, page, encoding_type, prefix, marker, delimiter, max_keys)
     else:
-        data = bucket.list_object_versions(encoding_type, prefix, max_keys, marker, delimiter)
-        return AWSResponse.success_response(data)
+        key_marker = key_marker or marker
+        page = await aio.run(bucket.list_object_versions, prefix, max_keys, key_marker, delimiter, version_id_marker)
+        return AWSResponse.list_object_versions_result(bucket_name, page, encoding_type, prefix, key_marker,
+                                                       version_id_marker, delimiter, max_keys)
     
 
 
 @app.put("/{bucket_name}")
-async def create_bucket(bucket_name: Union[str, None], request: Request, response: Response):
+async def create_bucket(bucket_name: Union[str, None], request: Request, response: Response,
+                        versioning: str = DashingQuery(None), lifecycle: str = DashingQuery(None),
+                        compression: str = DashingQuery(None)):
     body = await request.body()
     body = body.decode('utf-8')
+    if versioning is not None:
+        return await aio.run(put_bucket_versioning, bucket_name, body, request)
+    if compression is not None:
+        return await aio.run(put_bucket_compression, bucket_name, body, request)
+    if lifecycle is not None:
+        return await aio.run(put_bucket_lifecycle, bucket_name, body, request)
     if body:
         req_data = xmltodict.parse(body)
         region = S3Region(req_data["CreateBucketConfiguration"]["LocationConstraint"])
@@ -111,59 +226,111 @@ async def create_bucket(bucket_name: Union[str, None], request: Request, respons
     bucket = S3Bucket(bucket_name, region)
     if bucket.exists:
         return AWSResponse.duplicate_bucket_error(bucket_name)
-    data = bucket.create()
+    data = await aio.run(bucket.create)
     if data:
         location = '{scheme}://{name}.s3.{host}:{port}/'.format(name=bucket.name, scheme=request.url.scheme, host=request.url.hostname, port=request.url.port)
         return AWSResponse.success_response(data, headers={"location": location})
     return AWSResponse.duplicate_bucket_error(bucket_name)
 
 
+def put_bucket_versioning(bucket_name, body, request):
+    bucket = S3Bucket(bucket_name, request.state.aws_region)
+    if not bucket.exists:
+        return AWSResponse.invalid_location(request.state.request_id)
+    try:
+        bucket.set_versioning(xmltodict.parse(body)["VersioningConfiguration"]["Status"])
+    except (ValueError, KeyError, TypeError, xmltodict.expat.ExpatError):
+        return AWSResponse.malformed_xml(request.state.request_id)
+    return Response("", status_code=200)
+
+
+def put_bucket_lifecycle(bucket_name, body, request):
+    bucket = S3Bucket(bucket_name, request.state.aws_region)
+    if not bucket.exists:
+        return AWSResponse.invalid_location(request.state.request_id)
+    try:
+        bucket.set_lifecycle(parse_lifecycle_configuration(body))
+    except UnsupportedRule as error:
+        return AWSResponse.not_implemented(str(error), request.state.request_id)
+    except ValueError:
+        return AWSResponse.malformed_xml(request.state.request_id)
+    return Response("", status_code=200)
+
+
+def put_bucket_compression(bucket_name, body, request):
+    # pseudo-s3 extension: objects written afterwards are stored compressed,
+    # clients keep seeing the original bytes, size and ETag.
+    bucket = S3Bucket(bucket_name, request.state.aws_region)
+    if not bucket.exists:
+        return AWSResponse.invalid_location(request.state.request_id)
+    try:
+        algorithm = xmltodict.parse(body)["CompressionConfiguration"]["Algorithm"]
+    except (KeyError, TypeError, xmltodict.expat.ExpatError):
+        return AWSResponse.malformed_xml(request.state.request_id)
+    try:
+        bucket.set_compression(algorithm)
+    except ValueError as e:
+        return AWSResponse.invalid_argument(str(e), "Algorithm", algorithm, request.state.request_id)
+    return Response("", status_code=200)
+
+
 @app.delete("/{bucket_name}")
-async def delete_bucket(bucket_name: Union[str, None], request: Request, response: Response):
+async def delete_bucket(bucket_name: Union[str, None], request: Request, response: Response,
+                        lifecycle: str = DashingQuery(None), compression: str = DashingQuery(None)):
     bucket_object = S3Bucket(bucket_name, request.state.aws_region)
     if not bucket_object.exists:
         return AWSResponse.invalid_location(request.state.request_id)
-    if not bucket_object.is_empty:
+    if lifecycle is not None:
+        await aio.run(bucket_object.delete_lifecycle)
+        return AWSResponse.no_content()
+    if compression is not None:
+        await aio.run(bucket_object.delete_compression)
+        return AWSResponse.no_content()
+    if not await aio.run(lambda: bucket_object.is_empty):
         return AWSResponse.bucket_not_empty(bucket_name, request.state.request_id)
-    if bucket_object.delete():
+    if await aio.run(bucket_object.delete):
         return AWSResponse.no_content()
 
 
 @app.put("/{file_path:path}")
 async def create_object(file_path: Union[str, None], request: Request, response: Response, uploadId: str = DashingQuery(None), partNumber: str = DashingQuery(None)):
-    body = await request.body()
     bucket, path = S3Object.split_bucket_and_path(file_path)
-    obj = S3Object(path, bucket, request.state.aws_region)
+    obj = await aio.run(S3Object, path, bucket, request.state.aws_region)
     if not obj.bucket.exists:
         return AWSResponse.invalid_location(request.state.request_id)
     if uploadId and partNumber:
         # add part of large file
-        etag = obj.create_temp_file(body, uploadId, partNumber)
+        etag = await obj.write_part_stream(request.stream(), uploadId, partNumber)
     else:
         # create object
-        try:
-            etag = obj.create_object(body.decode('utf-8'))
-        except UnicodeDecodeError:
-            etag = obj.create_object(body)
+        etag = await obj.write_stream(request.stream())
         metadata = {}
         for key, val in request.headers.items():
             if key.startswith("x-amz-meta"):
                 metadata[key] = val
         if metadata:
-            obj.set_metadata(metadata)
+            await aio.run(obj.set_metadata, metadata)
     location = '{scheme}://{name}.s3.{host}:{port}/'.format(name=file_path.split("/")[0], scheme=request.url.scheme, host=request.url.hostname, port=request.url.port)
-    return Response("", media_type="plain/text", headers={"location": location, "Etag": etag})
+    headers = {"location": location, "Etag": etag}
+    if not (uploadId and partNumber):
+        headers.update(await aio.run(obj.version_headers))
+    return Response("", media_type="plain/text", headers=headers)
 
 
 @app.head("/{file_path:path}")
-async def head_object(file_path: Union[str, None], request: Request, response: Response):
+async def head_object(file_path: Union[str, None], request: Request, response: Response, versionId: str = DashingQuery(None)):
     bucket, path = S3Object.split_bucket_and_path(file_path)
     if path:
-        obj = S3Object(path, bucket, request.state.aws_region)
+        obj = await aio.run(S3Object, path, bucket, request.state.aws_region, versionId)
+        if obj.delete_marker:
+            return AWSResponse.method_not_allowed("HEAD", request.state.request_id)
         if not obj.exists:
             return AWSResponse.invalid_key(obj.relative_path, request.state.request_id)
-        headers = {'content-length': str(obj.size), "etag": obj.etag, "last-modified": obj.mtime}
-        headers.update(obj.get_metadata())
+        size, etag, metadata, version_headers = await aio.run(
+            lambda: (obj.size, obj.etag, obj.get_metadata(), obj.version_headers()))
+        headers = {'content-length': str(size), "etag": etag, "last-modified": obj.mtime}
+        headers.update(metadata)
+        headers.update(version_headers)
     else:
         bucket = S3Bucket(bucket, request.state.aws_region)
         if not bucket.exists:
@@ -174,46 +341,35 @@ async def head_object(file_path: Union[str, None], request: Request, response: R
 
 
 @app.get("/{file_path:path}")
-async def read_object(file_path: Union[str, None], request: Request, response: Response):
-    query_params = split_query_params(request.query_params.__str__())
+async def read_object(file_path: Union[str, None], request: Request, response: Response, versionId: str = DashingQuery(None)):
     bucket, path = S3Object.split_bucket_and_path(file_path)
     aws_region = getattr(request.state, "aws_region", None)
-
-    ###########################################################################
-    # This is logic to serve pre_signed urls. Needs to be revisited again
-    if query_params.get("Expires", None):
-        secret_key = get_secret_key(query_params.get("AWSAccessKeyId"))
-        if secret_key:
-            string_to_sign = prepare_sign_string("GET", "/"+file_path, query_params["Expires"])
-            if not aws_region:
-                aws_region = S3Obj.buckets.get(bucket, None)
-            if (not settings.validate_signature or (query_params.get("Signature", None) == get_signature(string_to_sign, secret_key))) and aws_region:
-                expiry = datetime.datetime.fromtimestamp(int(query_params["Expires"]), datetime.timezone.utc)
-                if expiry < datetime.datetime.now(tz=datetime.timezone.utc):
-                    return AWSResponse.request_expired(expiry, request.state.request_id)
-            else:
-                return AWSResponse.invalid_signature(query_params["AWSAccessKeyId"], string_to_sign, query_params["Signature"], request.state.request_id)
-    ###########################################################################
     status_code = 200
-    obj = S3Object(path, bucket, aws_region)
+    obj = await aio.run(S3Object, path, bucket, aws_region, versionId)
+    if obj.delete_marker:
+        return AWSResponse.method_not_allowed("GET", request.state.request_id)
     if not obj.exists:
+        if versionId:
+            return AWSResponse.invalid_version(obj.relative_path, versionId, request.state.request_id)
         return AWSResponse.invalid_key(obj.relative_path, request.state.request_id)
     if request.headers.get("If-Modified-Since", None):
         date = datetime.datetime.strptime(request.headers["If-Modified-Since"], "%a, %d %b %Y %H:%M:%S %Z").replace(tzinfo=datetime.timezone.utc)
         if date > datetime.datetime.fromtimestamp(obj.stats.st_mtime, tz=datetime.timezone.utc):
-            raise 304
+            return Response(status_code=304)
 
-    range_low = range_high = content_range = None
+    size = await aio.run(lambda: obj.size)
+    start, end = 0, size
+    content_range = None
     if request.headers.get("Range", None):
-        range_low, range_high = request.headers["Range"].split("=")[1].split("-")
-        range_low = int(range_low) if range_low else None 
-        range_high = int(range_high) if range_high else None
-        content_range = "bytes {0}-{1}/{2}".format(range_low, range_high, obj.size)
+        byte_range = parse_range(request.headers["Range"], size)
+        if not byte_range:
+            return AWSResponse.invalid_range(size, request.state.request_id)
+        start, end = byte_range
+        content_range = "bytes {0}-{1}/{2}".format(start, end - 1, size)
         status_code = 206
-    resp = obj.read_object(range_low, range_high)
-    etag = get_etag(resp)
+    etag, metadata, version_headers = await aio.run(lambda: (obj.etag, obj.get_metadata(), obj.version_headers()))
     headers = {
-        'content-length': str(len(resp)),
+        'content-length': str(end - start),
         "etag": '"{}"'.format(etag),
         "last-modified": obj.mtime}
     if content_range:
@@ -221,39 +377,59 @@ async def read_object(file_path: Union[str, None], request: Request, response: R
     else:
         headers['accept-ranges'] = 'bytes'
 
-    headers.update(obj.get_metadata())
+    headers.update(metadata)
+    headers.update(version_headers)
+    return StreamingResponse(obj.read_stream(start, end), media_type="binary/octet-stream", headers=headers, status_code=status_code)
+
+
+async def select_object_content(bucket, path, request):
+    version_id = request.query_params.get("versionId")
+    obj = await aio.run(S3Object, path, bucket, request.state.aws_region, version_id)
+    if obj.delete_marker:
+        return AWSResponse.method_not_allowed("POST", request.state.request_id)
+    if not obj.exists:
+        if version_id:
+            return AWSResponse.invalid_version(obj.relative_path, version_id, request.state.request_id)
+        return AWSResponse.invalid_key(obj.relative_path, request.state.request_id)
     try:
-        resp = resp.decode('utf-8')
-    except UnicodeDecodeError:
-        pass
-    return Response(resp, media_type="binary/octet-stream", headers=headers, status_code=status_code)
+        select_request = s3select.parse_request(await request.body())
+    except s3select.SelectError as error:
+        return AWSResponse.select_error(error.code, str(error), request.state.request_id)
+    chunks, headers = await aio.run(lambda: (obj.read_stream(), obj.version_headers()))
+    return StreamingResponse(s3select.stream(select_request, chunks), media_type="application/octet-stream", headers=headers)
 
 
 @app.post("/{file_path:path}")
-async def post(file_path: Union[str, None], request: Request, response: Response, uploadId: str = DashingQuery(None), key: str = Form(None), 
-               AWSAccessKeyId = Form(None), signature = Form(None), policy = Form(None), file=File(None)):
+async def post(file_path: Union[str, None], request: Request, response: Response, uploadId: str = DashingQuery(None), file=File(None)):
     bucket, path = S3Object.split_bucket_and_path(file_path)
     location = '{scheme}://{name}.s3.{host}:{port}{path}'.format(name=bucket, scheme=request.url.scheme, host=request.url.hostname, port=request.url.port, path=file_path)
     if getattr(request.state, "aws_region", None):
         bucket = S3Bucket(bucket, request.state.aws_region)
         if not bucket.exists:
             return AWSResponse.invalid_location(request.state.request_id)
+        if "select" in request.query_params:
+            return await select_object_content(bucket, path, request)
         if uploadId:
             # large file upload finish
             body = await request.body()
             request_data = xmltodict.parse(body)
-            obj = S3Object(path, bucket, request.state.aws_region)
-            obj.merge_temp_file(uploadId, request_data["CompleteMultipartUpload"]["Part"])
-            bucket.meta_manager.move(uploadId, path)
-            return AWSResponse.multipart_upload_result(location, bucket, obj.etag, {"location": location})
+            obj = await aio.run(S3Object, path, bucket, request.state.aws_region)
+            parts = request_data["CompleteMultipartUpload"]["Part"]
+            if isinstance(parts, dict):
+                parts = [parts]
+            await aio.run(obj.merge_temp_file, uploadId, parts)
+            await aio.run(bucket.meta_manager.move, uploadId, path)
+            etag = await aio.run(lambda: obj.etag)
+            return AWSResponse.multipart_upload_result(location, bucket.name, path, etag, {"location": location})
         elif request.query_params.__str__() == "delete=":
             # Delete multiple objects
             body = await request.body()
             request_data = xmltodict.parse(body)
-            files_to_delete = [i["Key"] for i in request_data["Delete"]["Object"]]
-            for file in files_to_delete:
-                S3Object(file, bucket, request.state.aws_region).delete_object()
-            return AWSResponse.multiple_obj_delete_successful(files_to_delete)
+            objects = request_data["Delete"]["Object"]
+            if isinstance(objects, dict):
+                objects = [objects]
+            deleted = await aio.run(delete_objects, bucket, objects, request.state.aws_region)
+            return AWSResponse.multiple_obj_delete_successful(deleted)
         elif request.query_params.__str__() == "uploads=":
             # Start large file upload 
             upload_id = get_upload_id()
@@ -261,40 +437,57 @@ async def post(file_path: Union[str, None], request: Request, response: Response
             for key, val in request.headers.items():
                 if key.startswith("x-amz-meta"):
                     metadata[key] = val
-            if metadata:
-                bucket.meta_manager.set(upload_id, metadata)
+            await aio.run(bucket.start_upload, upload_id, metadata)
             return AWSResponse.multipart_upload_start(bucket, path, upload_id, {"location": location})
     elif file:
-        # handle presigned post url
-        secret_key = get_secret_key(AWSAccessKeyId)
-        if secret_key:
-            if settings.validate_signature:
-                server_signature = get_signature(policy, secret_key, url_encoded=False)
-                if signature != server_signature:
-                    return AWSResponse.invalid_signature(AWSAccessKeyId, policy, signature, request.state.request_id)
-            policy = json.loads(base64.b64decode(policy))
-            expiry = datetime.datetime.strptime(policy["expiration"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc)
-            if expiry < datetime.datetime.now(tz=datetime.timezone.utc):
-                return AWSResponse.request_expired(expiry, request.state.request_id)
-            aws_region = S3Obj.buckets.get(bucket, None)
-            bucket = S3Bucket(bucket, aws_region)
-            if not bucket.exists:
-                return AWSResponse.invalid_location(request.state.request_id)
-            obj = S3Object(key, bucket, aws_region)
-            body = await file.read()
-            try:
-                etag = obj.create_object(body.decode('utf-8'))
-            except UnicodeDecodeError:
-                etag = obj.create_object(body)
-            return AWSResponse.no_content()
+        # Browser based upload signed with a POST policy
+        form = await request.form()
+        fields = {k.lower(): v for k, v in form.multi_items() if isinstance(v, str)}
+        if not fields.get("key"):
+            return AWSResponse.invalid_argument("Bucket POST must contain a field named 'key'.", "key", "", request.state.request_id)
+        fields["key"] = fields["key"].replace("${filename}", file.filename or "")
+        try:
+            length_range = presign.verify_post_policy(fields, bucket)
+            presign.check_content_length(length_range, aio.remaining_size(file.file))
+        except presign.PresignError as error:
+            return presign_error_response(error, request.state.request_id)
+        aws_region = await aio.run(S3Obj.region_of, bucket)
+        if not aws_region:
+            return AWSResponse.invalid_location(request.state.request_id)
+        obj = await aio.run(S3Object, fields["key"], S3Bucket(bucket, aws_region), aws_region)
+        await obj.write_stream(aio.read_file(file.file))
+        metadata = {k: v for k, v in fields.items() if k.startswith("x-amz-meta")}
+        if metadata:
+            await aio.run(obj.set_metadata, metadata)
+        return AWSResponse.no_content(await aio.run(obj.version_headers))
+
+
+def delete_objects(bucket, objects, region):
+    deleted = []
+    for file in objects:
+        obj = S3Object(file["Key"], bucket, region, file.get("VersionId"))
+        obj.delete_object()
+        deleted.append((file["Key"], file.get("VersionId"), obj.version_id if obj.delete_marker else None))
+    return deleted
 
 
 @app.delete("/{file_path:path}")
-async def delete_object(file_path: Union[str, None], request: Request, response: Response):
+async def delete_object(file_path: Union[str, None], request: Request, response: Response,
+                        versionId: str = DashingQuery(None), uploadId: str = DashingQuery(None)):
     bucket, path = S3Object.split_bucket_and_path(file_path)
-    obj = S3Object(path, bucket, request.state.aws_region)
-    obj.delete_object()
-    return AWSResponse.no_content()
+    obj = await aio.run(S3Object, path, bucket, request.state.aws_region, versionId)
+    if uploadId:
+        # abort large file upload
+        if not (obj.bucket.exists and await aio.run(obj.bucket.remove_upload, uploadId)):
+            return AWSResponse.no_such_upload(uploadId, request.state.request_id)
+        return AWSResponse.no_content()
+    await aio.run(obj.delete_object)
+    headers = {}
+    if obj.version_id:
+        headers["x-amz-version-id"] = obj.version_id
+    if obj.delete_marker:
+        headers["x-amz-delete-marker"] = "true"
+    return AWSResponse.no_content(headers)
 
 if __name__ == '__main__':
     app.run()
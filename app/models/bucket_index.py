@@ -0,0 +1,374 @@
+import itertools
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+
+
+INDEX_FILE = ".index.db"
+
+# Objects imported per transaction when indexing an existing bucket.
+BUILD_BATCH = 1000
+# Index connections each thread keeps open, least recently used go first.
+MAX_CONNECTIONS = 16
+
+VersionRecord = namedtuple("VersionRecord", ["key", "version_id", "seq", "size", "mtime", "etag", "delete_marker", "is_latest", "encoding"])
+
+_COLUMNS = "key, version_id, seq, size, mtime, etag, delete_marker, is_latest, encoding"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    version_id TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    mtime REAL NOT NULL,
+    etag TEXT,
+    delete_marker INTEGER NOT NULL DEFAULT 0,
+    is_latest INTEGER NOT NULL DEFAULT 1,
+    encoding TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS versions_key_version ON versions(key, version_id);
+CREATE INDEX IF NOT EXISTS versions_key_seq ON versions(key, seq);
+CREATE INDEX IF NOT EXISTS versions_current ON versions(key) WHERE is_latest = 1 AND delete_marker = 0;
+CREATE TABLE IF NOT EXISTS config (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    objects INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    versions INTEGER NOT NULL DEFAULT 0,
+    version_bytes INTEGER NOT NULL DEFAULT 0,
+    multipart_bytes INTEGER NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS usage_insert AFTER INSERT ON versions WHEN NEW.delete_marker = 0 BEGIN
+    UPDATE usage SET objects = objects + NEW.is_latest, bytes = bytes + NEW.is_latest * NEW.size,
+        versions = versions + 1, version_bytes = version_bytes + NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS usage_delete AFTER DELETE ON versions WHEN OLD.delete_marker = 0 BEGIN
+    UPDATE usage SET objects = objects - OLD.is_latest, bytes = bytes - OLD.is_latest * OLD.size,
+        versions = versions - 1, version_bytes = version_bytes - OLD.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS usage_latest AFTER UPDATE OF is_latest ON versions
+WHEN OLD.delete_marker = 0 AND OLD.is_latest != NEW.is_latest BEGIN
+    UPDATE usage SET objects = objects + NEW.is_latest - OLD.is_latest,
+        bytes = bytes + (NEW.is_latest - OLD.is_latest) * NEW.size WHERE id = 0;
+END;
+"""
+
+USAGE_FIELDS = ["objects", "bytes", "versions", "version_bytes", "multipart_bytes"]
+
+
+def _record(cursor, row):
+    return VersionRecord(*row)
+
+
+_local = threading.local()
+
+
+def _file_id(path):
+    try:
+        stats = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stats.st_dev, stats.st_ino
+
+
+def _connection(path):
+    """
+    This thread's connection to the index at path, and whether it was just
+    opened. Connections are reused by every request the thread serves and
+    reopened once the file at path is replaced, by an fsck rebuild or a
+    deleted and recreated bucket.
+    """
+    conns = _local.__dict__.setdefault("conns", OrderedDict())
+    cached = conns.get(path)
+    if cached is not None:
+        conn, file_id = cached
+        if conn.in_transaction or file_id == _file_id(path):
+            conns.move_to_end(path)
+            return conn, False
+        _close(path)
+    while len(conns) >= MAX_CONNECTIONS:
+        idle = next((i for i, (conn, file_id) in conns.items() if not conn.in_transaction), None)
+        if idle is None:
+            break
+        _close(idle)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conns[path] = (conn, _file_id(path))
+    return conn, True
+
+
+def _close(path):
+    cached = _local.__dict__.get("conns", {}).pop(path, None)
+    if cached is not None:
+        cached[0].close()
+
+
+def read_config(path):
+    """
+    Raw name to value rows of the config table of the index at path, read
+    without touching the rest of a possibly damaged database.
+    """
+    conn = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    try:
+        return dict(conn.execute("SELECT name, value FROM config"))
+    finally:
+        conn.close()
+
+
+def prefix_upper_bound(prefix):
+    """Smallest string sorting after every key starting with prefix."""
+    return prefix + "\U0010ffff"
+
+
+class BucketIndex:
+    """
+    Per bucket sqlite index holding the version chain of every key and the
+    bucket level configuration. Object data stays on disk, the index only
+    records what exists so listings can page without walking the bucket.
+    Usage counters are kept up to date by triggers, inside the same
+    transaction as the change to the versions table.
+    """
+
+    def __init__(self, bucket, config=None):
+        # config: rows of the config table of an index being rebuilt.
+        self.bucket = bucket
+        self.path = os.path.join(bucket.path, INDEX_FILE)
+        if config or self._get_config("indexed") is None:
+            self._build(config or {})
+
+    @property
+    def conn(self):
+        conn, opened = _connection(self.path)
+        if opened:
+            # Schema and migrations run once per connection, not per request.
+            try:
+                conn.executescript(_SCHEMA)
+                self._migrate()
+            except BaseException:
+                _close(self.path)
+                raise
+        return conn
+
+    def close(self):
+        """Close this thread's connection, before the file is moved or removed."""
+        _close(self.path)
+
+    def _migrate(self):
+        columns = [i[1] for i in self.conn.execute("PRAGMA table_info(versions)")]
+        if "encoding" not in columns:
+            try:
+                self.conn.execute("ALTER TABLE versions ADD COLUMN encoding TEXT")
+            except sqlite3.OperationalError:
+                # Another worker added it first.
+                pass
+        if self.conn.execute("SELECT 1 FROM usage WHERE id = 0").fetchone() is None:
+            self.reconcile_usage()
+
+    def _build(self, config):
+        # One time import of objects written before the index existed, or
+        # left behind by an index that had to be replaced. Only file metadata
+        # is read, ETags are filled in when first asked for, and objects are
+        # committed in batches so other workers never wait on the whole scan.
+        conn = self.conn
+        objects = self.bucket.scan_objects()
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for name, value in config.items():
+                    if name != "indexed":
+                        # A setting changed since the rebuild started wins.
+                        conn.execute("INSERT OR IGNORE INTO config (name, value) VALUES (?, ?)", (name, value))
+                config = {}
+                if self._get_config("indexed") is not None:
+                    # Finished by another worker.
+                    conn.execute("COMMIT")
+                    return
+                batch = list(itertools.islice(objects, BUILD_BATCH))
+                for key, stats, size, encoding in batch:
+                    # Keys written since the import started already have a record.
+                    conn.execute(
+                        "INSERT INTO versions (key, version_id, size, mtime, encoding) SELECT ?, 'null', ?, ?, ? "
+                        "WHERE NOT EXISTS (SELECT 1 FROM versions WHERE key = ?)",
+                        (key, size, stats.st_mtime, encoding, key))
+                if not batch:
+                    conn.execute("INSERT OR REPLACE INTO config (name, value) VALUES ('indexed', 'true')")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            if not batch:
+                return
+
+    def _get_config(self, name):
+        row = self.conn.execute("SELECT value FROM config WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def get_config(self, name, default=None):
+        value = self._get_config(name)
+        return json.loads(value) if value is not None else default
+
+    def set_config(self, name, value):
+        self.conn.execute("INSERT OR REPLACE INTO config (name, value) VALUES (?, ?)", (name, json.dumps(value)))
+
+    def delete_config(self, name):
+        self.conn.execute("DELETE FROM config WHERE name = ?", (name,))
+
+    def _fetchone(self, query, args):
+        cursor = self.conn.execute(query, args)
+        cursor.row_factory = _record
+        return cursor.fetchone()
+
+    def latest(self, key):
+        return self._fetchone("SELECT {} FROM versions WHERE key = ? AND is_latest = 1".format(_COLUMNS), (key,))
+
+    def get_version(self, key, version_id):
+        return self._fetchone("SELECT {} FROM versions WHERE key = ? AND version_id = ?".format(_COLUMNS), (key, version_id))
+
+    def put_version(self, key, version_id, size, mtime, etag, delete_marker=False, encoding=None):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute("DELETE FROM versions WHERE key = ? AND version_id = ?", (key, version_id))
+            self.conn.execute("UPDATE versions SET is_latest = 0 WHERE key = ? AND is_latest = 1", (key,))
+            self.conn.execute(
+                "INSERT INTO versions (key, version_id, size, mtime, etag, delete_marker, encoding) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, version_id, size, mtime, etag, int(delete_marker), encoding))
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def remove_version(self, key, version_id):
+        """Drop a version and return the record that is now the latest for the key."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute("DELETE FROM versions WHERE key = ? AND version_id = ?", (key, version_id))
+            head = self._fetchone("SELECT {} FROM versions WHERE key = ? ORDER BY seq DESC LIMIT 1".format(_COLUMNS), (key,))
+            if head and not head.is_latest:
+                self.conn.execute("UPDATE versions SET is_latest = 1 WHERE seq = ?", (head.seq,))
+                head = head._replace(is_latest=1)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return head
+
+    def update_version(self, key, version_id, size, mtime, etag, encoding=None):
+        """Refresh the recorded state of a version after the file changed under it."""
+        self.conn.execute("UPDATE versions SET size = ?, mtime = ?, etag = ?, encoding = ? WHERE key = ? AND version_id = ?",
+                          (size, mtime, etag, encoding, key, version_id))
+
+    def set_etag(self, key, version_id, mtime, etag):
+        """Store the ETag of a version imported without one, unless its file changed since."""
+        self.conn.execute("UPDATE versions SET etag = ? WHERE key = ? AND version_id = ? AND mtime = ? AND etag IS NULL",
+                          (etag, key, version_id, mtime))
+
+    def quick_check(self):
+        return [row[0] for row in self.conn.execute("PRAGMA quick_check")]
+
+    def key_versions(self, key):
+        """Every record of key, newest first."""
+        cursor = self.conn.execute("SELECT {} FROM versions WHERE key = ? ORDER BY seq DESC".format(_COLUMNS), (key,))
+        cursor.row_factory = _record
+        return cursor.fetchall()
+
+    def backup(self, path):
+        """Write a consistent snapshot of the index to path."""
+        target = sqlite3.connect(path)
+        try:
+            self.conn.backup(target)
+        finally:
+            target.close()
+
+    def usage(self):
+        row = self.conn.execute("SELECT {} FROM usage WHERE id = 0".format(", ".join(USAGE_FIELDS))).fetchone()
+        return dict(zip(USAGE_FIELDS, row or [0] * len(USAGE_FIELDS)))
+
+    def add_multipart_bytes(self, delta):
+        self.conn.execute("UPDATE usage SET multipart_bytes = MAX(multipart_bytes + ?, 0) WHERE id = 0", (delta,))
+
+    def reconcile_usage(self, multipart_bytes=None):
+        """Recompute the counters from the versions table."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            if multipart_bytes is None:
+                row = self.conn.execute("SELECT multipart_bytes FROM usage WHERE id = 0").fetchone()
+                multipart_bytes = row[0] if row else 0
+            self.conn.execute("""
+                INSERT OR REPLACE INTO usage (id, objects, bytes, versions, version_bytes, multipart_bytes)
+                SELECT 0, COALESCE(SUM(is_latest), 0), COALESCE(SUM(is_latest * size), 0),
+                       COUNT(*), COALESCE(SUM(size), 0), ?
+                FROM versions WHERE delete_marker = 0""", (multipart_bytes,))
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return self.usage()
+
+    def has_versions(self):
+        return self.conn.execute("SELECT 1 FROM versions LIMIT 1").fetchone() is not None
+
+    def iter_objects(self, prefix=None, start_after=None, batch_size=1000):
+        """Yield the current (latest, not deleted) record of every key after start_after."""
+        high = prefix_upper_bound(prefix) if prefix else None
+        last_key = start_after
+        while True:
+            query = "SELECT {} FROM versions WHERE is_latest = 1 AND delete_marker = 0 AND key >= ?".format(_COLUMNS)
+            args = [prefix or ""]
+            if high is not None:
+                query += " AND key < ?"
+                args.append(high)
+            if last_key is not None:
+                query += " AND key > ?"
+                args.append(last_key)
+            query += " ORDER BY key LIMIT ?"
+            args.append(batch_size)
+            cursor = self.conn.execute(query, args)
+            cursor.row_factory = _record
+            rows = cursor.fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                return
+            last_key = rows[-1].key
+
+    def iter_versions(self, prefix=None, key_marker=None, version_id_marker=None, batch_size=1000):
+        """
+        Yield version records ordered by key and newest first, starting after
+        the given markers. Rows are read in batches with keyset pagination so
+        a deep marker costs the same as the first page.
+        """
+        low = prefix or ""
+        high = prefix_upper_bound(prefix) if prefix else None
+        last_key, last_seq = None, None
+        if key_marker:
+            record = self.get_version(key_marker, version_id_marker) if version_id_marker else None
+            if record:
+                last_key, last_seq = record.key, record.seq
+            else:
+                last_key, last_seq = key_marker, -1
+        while True:
+            query = "SELECT {} FROM versions WHERE key >= ?".format(_COLUMNS)
+            args = [low]
+            if high is not None:
+                query += " AND key < ?"
+                args.append(high)
+            if last_key is not None:
+                query += " AND (key > ? OR (key = ? AND seq < ?))"
+                args.extend([last_key, last_key, last_seq])
+            query += " ORDER BY key, seq DESC LIMIT ?"
+            args.append(batch_size)
+            cursor = self.conn.execute(query, args)
+            cursor.row_factory = _record
+            rows = cursor.fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                return
+            last_key, last_seq = rows[-1].key, rows[-1].seq
@@ -1,14 +1,35 @@
 import datetime
+import functools
 import hashlib
+import itertools
 import json
 import os
 import shutil
+import sqlite3
+import tempfile
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
+from app import aio, compression, lifecycle, replication
+from app.locks import file_lock
 from app.settings import settings
-from app.utils import get_etag
+from app.utils import get_version_id, is_upload_id
+from .bucket_index import BucketIndex, INDEX_FILE, prefix_upper_bound, read_config
 
 
 DISPLAY_NAME = settings.name
+VERSIONS_DIR = ".versions"
+INTERNAL_NAMES = {".metadata.json", ".tmp", VERSIONS_DIR, INDEX_FILE, INDEX_FILE + "-wal", INDEX_FILE + "-shm", INDEX_FILE + "-journal"}
+VERSIONING_STATUS = ("Enabled", "Suspended")
+QUARANTINE_DIR = ".quarantine"
+META_TEMP_PREFIX = ".metadata.json."
+# Created with the directory of a multipart upload, dates the upload.
+UPLOAD_MARKER = ".initiated"
+
+# One page of a listing: index records, rolled up prefixes and where to resume.
+ListingPage = namedtuple("ListingPage", ["entries", "common_prefixes", "is_truncated", "next_marker", "next_version_id_marker"])
 
 
 def set_directory_path(path):
@@ -18,14 +39,30 @@ def set_directory_path(path):
 
 
 class S3:
+    # Buckets are looked up on disk every time instead of being cached, so
+    # every worker process sees buckets created or deleted by the others.
     def __init__(self):
         self.root = set_directory_path(settings.data_root)
         if not os.path.exists(self.root):
-            os.makedirs(self.root)
-        self.buckets = {}
-        for region in os.listdir(self.root):
+            os.makedirs(self.root, exist_ok=True)
+
+    @property
+    def regions(self):
+        return [i for i in os.listdir(self.root) if not i.startswith(".")]
+
+    @property
+    def buckets(self):
+        buckets = {}
+        for region in self.regions:
             for bucket in os.listdir(os.path.join(self.root, region)):
-                self.buckets[bucket] = region
+                buckets[bucket] = region
+        return buckets
+
+    def region_of(self, bucket):
+        for region in self.regions:
+            if os.path.isdir(os.path.join(self.root, region, bucket)):
+                return region
+        return None
 
 S3Obj = S3()
 
@@ -33,7 +70,7 @@ S3Obj = S3()
 class S3Region:
     def __init__(self, region):
         self.name = region
-        self.parent = S3()
+        self.parent = S3Obj
         self.path = set_directory_path(os.path.join(self.parent.root, region))
         if not os.path.exists(self.path):
             os.makedirs(self.path, exist_ok=True)
@@ -60,10 +97,8 @@ class S3Bucket:
         self.name = name
         self.region = region if isinstance(region, S3Region) else S3Region(region)
         self.path = set_directory_path(os.path.join(self.region.path, name))
-        if self.exists:
-            self.meta_manager = MetaManager(self, self.region)
-        else:
-            self.meta_manager = None
+        self._index = None
+        self._meta_manager = None
 
     def __str__(self):
         return self.name
@@ -79,174 +114,619 @@ class S3Bucket:
     def exists(self):
         return os.path.exists(self.path)
 
+    @property
+    def meta_manager(self):
+        if self._meta_manager is None and self.exists:
+            self._meta_manager = MetaManager(self, self.region)
+        return self._meta_manager
+
     @property
     def is_empty(self):
-        return len([i for i in os.listdir(self.path) if i not in [".metadata.json", ".tmp"]]) == 0
+        return not self.index.has_versions()
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = BucketIndex(self)
+        return self._index
+
+    @property
+    def versioning(self):
+        return self.index.get_config("versioning")
+
+    def set_versioning(self, status):
+        if status not in VERSIONING_STATUS:
+            raise ValueError("Invalid versioning status")
+        if status == "Suspended" and not self.versioning:
+            return
+        self.index.set_config("versioning", status)
+        replication.record(self.region, self.name)
+
+    def get_versioning(self):
+        data = {"VersioningConfiguration": {}}
+        if self.versioning:
+            data["VersioningConfiguration"]["Status"] = self.versioning
+        return data
+
+    @property
+    def compression(self):
+        return self.index.get_config("compression")
+
+    def set_compression(self, algorithm):
+        if algorithm not in compression.ALGORITHMS or not compression.available(algorithm):
+            raise ValueError("Unsupported compression {}".format(algorithm))
+        self.index.set_config("compression", algorithm)
+        replication.record(self.region, self.name)
+
+    def delete_compression(self):
+        self.index.delete_config("compression")
+        replication.record(self.region, self.name)
+
+    def get_compression(self):
+        data = {"CompressionConfiguration": {}}
+        if self.compression:
+            data["CompressionConfiguration"]["Algorithm"] = self.compression
+        return data
+
+    @property
+    def lifecycle_rules(self):
+        return self.index.get_config("lifecycle")
+
+    def set_lifecycle(self, rules):
+        self.index.set_config("lifecycle", rules)
+        replication.record(self.region, self.name)
+
+    def delete_lifecycle(self):
+        self.index.delete_config("lifecycle")
+        replication.record(self.region, self.name)
+
+    def expire_objects(self, now, cursor=None, batch_size=1000):
+        """
+        Apply the expiration rules to roughly batch_size keys after cursor.
+        Returns the cursor to resume from (None once the bucket is done) and
+        the number of objects and versions removed.
+        """
+        rules = lifecycle.active_rules(self.lifecycle_rules)
+        expired = scanned = 0
+        current_key = newer_mtime = None
+        for record in self.index.iter_versions(key_marker=cursor):
+            if record.key != current_key:
+                if scanned >= batch_size:
+                    return current_key, expired
+                current_key, newer_mtime = record.key, None
+                scanned += 1
+            if record.is_latest:
+                if not record.delete_marker and lifecycle.is_expired(rules, record.key, record.mtime, now):
+                    expired += self._expire(record)
+            elif newer_mtime is not None and lifecycle.is_noncurrent_expired(rules, record.key, newer_mtime, now):
+                expired += self._expire(record)
+            newer_mtime = record.mtime
+        return None, expired
+
+    def _expire(self, record):
+        """
+        Delete what record describes, unless the key changed since the scan
+        read it. The current version gets a delete marker in versioned
+        buckets, like a DELETE without a version id.
+        """
+        obj = S3Object(record.key, self, self.region)
+        with obj.lock():
+            if record.is_latest:
+                current = self.index.latest(record.key)
+            else:
+                current = self.index.get_version(record.key, record.version_id)
+            if (not current or current.version_id != record.version_id or current.mtime != record.mtime
+                    or current.is_latest != record.is_latest):
+                return 0
+            version_id = None if record.is_latest else record.version_id
+            return int(bool(S3Object(record.key, self, self.region, version_id).delete_object()))
+
+    def abort_incomplete_uploads(self, now):
+        max_age = lifecycle.abort_after(lifecycle.active_rules(self.lifecycle_rules))
+        temp_dir = os.path.join(self.path, ".tmp")
+        if max_age is None or not os.path.exists(temp_dir):
+            return 0
+        aborted = 0
+        with os.scandir(temp_dir) as entries:
+            uploads = [i.name for i in entries if i.is_dir()]
+        for upload_id in uploads:
+            started = self.upload_started(upload_id)
+            if started is not None and now - started >= max_age:
+                self.remove_upload(upload_id)
+                aborted += 1
+        return aborted
+
+    def upload_dir(self, upload_id):
+        return os.path.join(self.path, ".tmp", upload_id)
+
+    def start_upload(self, upload_id, metadata=None):
+        """
+        Create the directory of a new multipart upload. Its marker file keeps
+        the initiation time, parts written later do not make the upload look
+        younger and uploads that never get a part can still be aborted.
+        """
+        temp_dir = self.upload_dir(upload_id)
+        os.makedirs(temp_dir)
+        open(os.path.join(temp_dir, UPLOAD_MARKER), "w").close()
+        if metadata:
+            self.meta_manager.set(upload_id, metadata)
+
+    def upload_started(self, upload_id):
+        """Initiation time of an upload, None if there is no such upload."""
+        temp_dir = self.upload_dir(upload_id)
+        # Uploads started before markers were written only have their directory.
+        stats = stat_or_none(os.path.join(temp_dir, UPLOAD_MARKER)) or stat_or_none(temp_dir)
+        return stats.st_mtime if stats else None
+
+    def remove_upload(self, upload_id, keep_metadata=False):
+        """Drop the parts of a multipart upload, returns False if there was none."""
+        temp_dir = self.upload_dir(upload_id)
+        if not os.path.isdir(temp_dir):
+            return False
+        size = dir_size(temp_dir)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        self.index.add_multipart_bytes(-size)
+        if not keep_metadata:
+            self.meta_manager.delete(upload_id)
+        return True
+
+    @property
+    def usage(self):
+        return self.index.usage()
+
+    def reconcile_usage(self):
+        temp_dir = os.path.join(self.path, ".tmp")
+        multipart_bytes = 0
+        if os.path.isdir(temp_dir):
+            with os.scandir(temp_dir) as entries:
+                multipart_bytes = sum(dir_size(i.path) for i in entries if i.is_dir())
+        return self.index.reconcile_usage(multipart_bytes)
+
+    def quarantine(self, path):
+        """Move a damaged file out of the bucket into <data_root>/.quarantine."""
+        target = os.path.join(self.region.parent.root, QUARANTINE_DIR, self.region.name, self.name,
+                              "{}.{}".format(os.path.relpath(path, self.path), int(time.time())))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+        return target
+
+    def fsck(self, report, repair=False, verify=False, now=None, temp_age=3600, upload_age=7 * 86400, threads=4,
+             shard=0, shards=1):
+        """
+        Compare the bucket on disk with its index and metadata, count what
+        is wrong in report and fix it when repair is set. Safe next to a
+        running server: keys are repaired under their lock after checking
+        them again, and temp files are left alone until older than temp_age.
+        verify also hashes every object against its recorded ETag.
+
+        A large bucket can be split over several processes: each checks the
+        keys of its shard out of shards, and only shard 0 checks the bucket
+        as a whole (index, temp files, versions, metadata).
+        """
+        now = now or time.time()
+        if shard:
+            if not self._index_problems():
+                self._fsck_objects(report, repair, verify, threads, shard, shards)
+            return report
+        if not self._fsck_index(report, repair):
+            return report
+        self._fsck_temp(report, repair, now, temp_age, upload_age)
+        self._fsck_objects(report, repair, verify, threads, shard, shards)
+        self._fsck_versions(report, repair, now, temp_age)
+        self._fsck_metadata(report, repair)
+        if repair:
+            self.reconcile_usage()
+        return report
+
+    def _index_problems(self):
+        try:
+            return [i for i in self.index.quick_check() if i != "ok"]
+        except sqlite3.DatabaseError as error:
+            return [str(error)]
+
+    def _fsck_index(self, report, repair):
+        problems = self._index_problems()
+        if not problems:
+            return True
+        report.add("corrupt_index", "; ".join(problems))
+        if not repair:
+            return False
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        try:
+            config = read_config(os.path.join(self.path, INDEX_FILE))
+        except sqlite3.DatabaseError:
+            # Rebuilding would silently drop versioning, compression and
+            # lifecycle settings.
+            report.add("manual_repair_needed", "bucket configuration is unreadable")
+            return False
+        for name in [INDEX_FILE, INDEX_FILE + "-wal", INDEX_FILE + "-shm", INDEX_FILE + "-journal"]:
+            if os.path.exists(os.path.join(self.path, name)):
+                self.quarantine(os.path.join(self.path, name))
+        # Current objects are imported from the files on disk, noncurrent
+        # versions are only kept in the quarantine.
+        self._index = BucketIndex(self, config=config)
+        return True
+
+    def _fsck_temp(self, report, repair, now, temp_age, upload_age):
+        temp_dir = os.path.join(self.path, ".tmp")
+        if os.path.isdir(temp_dir):
+            with os.scandir(temp_dir) as entries:
+                entries = list(entries)
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    started = self.upload_started(entry.name)
+                    if upload_age and started is not None and now - started >= upload_age:
+                        report.add("stale_upload", entry.name)
+                        if repair:
+                            self.remove_upload(entry.name)
+                elif now - entry.stat(follow_symlinks=False).st_mtime >= temp_age:
+                    # A write that never got committed.
+                    report.add("partial_file", entry.name)
+                    if repair:
+                        self.quarantine(entry.path)
+        with os.scandir(self.path) as entries:
+            stale = [i for i in entries if i.name.startswith(META_TEMP_PREFIX) and now - i.stat().st_mtime >= temp_age]
+        for entry in stale:
+            report.add("stale_temp", entry.name)
+            if repair:
+                os.remove(entry.path)
+
+    def _check_key(self, key, stats, etag=None):
+        """
+        What is wrong with the file of key compared to its latest record,
+        None if nothing. etag is the hash of the file when verifying.
+        """
+        record = self.index.latest(key)
+        if not record or record.delete_marker:
+            return "unindexed_object", record
+        if record.encoding:
+            with open(os.path.join(self.path, key), "rb") as fp:
+                if compression.detect(fp.fileno()) != record.encoding:
+                    return "corrupt_object", record
+        if record.mtime != stats.st_mtime:
+            return "stale_record", record
+        if not record.encoding and record.size != stats.st_size:
+            return "truncated_object", record
+        if etag is False:
+            return "corrupt_object", record
+        if etag is not None and record.etag is not None and etag != record.etag:
+            return "etag_mismatch", record
+        return None, record
+
+    def _hash_key(self, key):
+        path = os.path.join(self.path, key)
+        try:
+            return object_md5(path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Frames that no longer decompress.
+            return False
+
+    def _fsck_objects(self, report, repair, verify, threads, shard=0, shards=1):
+        entries = self.scan_entries()
+        if shards > 1:
+            # crc32 rather than hash(), which differs between processes.
+            entries = (i for i in entries if zlib.crc32(i[0].encode("utf-8", "surrogateescape")) % shards == shard)
+        pool = ThreadPoolExecutor(max_workers=threads) if verify else None
+        try:
+            while True:
+                batch = list(itertools.islice(entries, 256))
+                if not batch:
+                    break
+                etags = pool.map(self._hash_key, [key for key, stats in batch]) if pool else itertools.repeat(None)
+                for (key, stats), etag in zip(batch, etags):
+                    report.scanned += 1
+                    issue, record = self._check_key(key, stats, etag)
+                    if issue and repair:
+                        issue = self._repair_key(key, verify)
+                    if issue:
+                        report.add(issue, key)
+        finally:
+            if pool:
+                pool.shutdown()
+
+    def _repair_key(self, key, verify):
+        obj = S3Object(key, self, self.region)
+        with obj.lock():
+            stats = stat_or_none(obj.current_path)
+            if stats is None:
+                return None
+            issue, record = self._check_key(key, stats, self._hash_key(key) if verify else None)
+            if issue in ("truncated_object", "corrupt_object"):
+                self.quarantine(obj.current_path)
+                S3Object(key, self, self.region, record.version_id, record)._delete_version()
+            elif issue:
+                size, etag, encoding = stored_object(obj.current_path, stats)
+                if issue == "unindexed_object":
+                    self.index.put_version(key, obj._new_version_id(), size, stats.st_mtime, etag, encoding=encoding)
+                else:
+                    self.index.update_version(key, record.version_id, size, stats.st_mtime, etag, encoding)
+                replication.record(self.region, self.name, key)
+        return issue
+
+    def reindex(self):
+        """
+        Index files placed in the bucket directory by hand and refresh the
+        records of files changed behind the index's back, so listings see
+        them. Returns the number of keys updated.
+        """
+        updated = 0
+        for key, stats in self.scan_entries():
+            issue, record = self._check_key(key, stats)
+            if issue in ("unindexed_object", "stale_record") and self._repair_key(key, False):
+                updated += 1
+        return updated
+
+    def _fsck_versions(self, report, repair, now, temp_age):
+        expected = set()
+        for record in self.index.iter_versions():
+            if record.delete_marker:
+                continue
+            path = os.path.join(self.path, record.key) if record.is_latest else self.version_file(record.key, record.version_id)
+            if os.path.exists(path):
+                if not record.is_latest:
+                    expected.add(os.path.basename(path))
+                continue
+            issue = "missing_object" if record.is_latest else "missing_version"
+            if repair:
+                obj = S3Object(record.key, self, self.region, record.version_id)
+                with obj.lock():
+                    current = self.index.get_version(record.key, record.version_id)
+                    if current and current.is_latest == record.is_latest and not os.path.exists(path):
+                        obj._delete_version()
+                    else:
+                        issue = None
+            if issue:
+                report.add(issue, record.key)
+        versions_dir = os.path.join(self.path, VERSIONS_DIR)
+        if not os.path.isdir(versions_dir):
+            return
+        with os.scandir(versions_dir) as entries:
+            # Linking a new version file updates its ctime, so a version
+            # being retired right now is never mistaken for an orphan.
+            orphans = [i for i in entries if i.name not in expected and now - i.stat().st_ctime >= temp_age]
+        for entry in orphans:
+            report.add("orphan_version", entry.name)
+            if repair:
+                self.quarantine(entry.path)
+
+    def _fsck_metadata(self, report, repair):
+        manager = self.meta_manager
+        with manager.lock():
+            try:
+                with open(manager.metafile) as fp:
+                    content = fp.read()
+                data = json.loads(content) if content.strip() else {}
+                if not isinstance(data, dict):
+                    raise ValueError("Metadata is not an object")
+            except ValueError:
+                report.add("corrupt_metadata", ".metadata.json")
+                if repair:
+                    self.quarantine(manager.metafile)
+                    manager._write({})
+                return
+            orphans = [i for i in data if not is_upload_id(i) and self.index.latest(i) is None]
+            for name in orphans:
+                report.add("orphan_metadata", name)
+                del data[name]
+            if orphans and repair:
+                manager._write(data)
+
+    def version_file(self, relative_path, version_id):
+        name = hashlib.md5("{}\0{}".format(relative_path, version_id).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, VERSIONS_DIR, name)
 
     def create(self):
-        if not (self.exists or S3Obj.buckets.get(self.name, None)):
-            os.makedirs(self.path)
-            S3Obj.buckets[self.name] = self.region.name
-            return {"CreateBucketResponse": {"CreateBucketResponse": {"Bucket": self.name}}}
+        with file_lock("bucket:" + self.name):
+            if not (self.exists or S3Obj.region_of(self.name)):
+                os.makedirs(self.path)
+                self._meta_manager = MetaManager(self, self.region)
+                replication.record(self.region, self.name)
+                return {"CreateBucketResponse": {"CreateBucketResponse": {"Bucket": self.name}}}
         return False
 
-    def get_obj_list(self):
-        file_list = [i for i in list(os.walk(self.path)) if i[2]]
-        objects = [S3Object(os.path.join(j[0], k).replace(self.path, ""), self, self.region) for j in file_list for k in j[2] if not (k==".metadata.json" or j[0].endswith(".tmp"))]
-        objects.sort(key=lambda x: x.relative_path)
-        return objects
-
-    def _apply_marker(self, objects, marker=None):
-        if not marker:
-            return objects
-        marker_obj = next((i for i in objects if i.relative_path == marker), None)
-        if marker_obj:
-            return objects[objects.index(marker_obj)+1:]
-        else:
-            return []
-
-    def _check_prefix(self, objects, prefix=None):
-        if not prefix:
-            return objects
-        return [i for i in objects if i.relative_path.startswith(prefix)]
-
-    def _check_delimiter(self, objects, delimiter=None, prefix=None):
-        common_prefixes = []
-        if not delimiter:
-            return objects, common_prefixes
-        new_objects = []
-        for obj in objects:
-            if delimiter in obj.relative_path:
-                if prefix:
-                    pfx = "{0}{1}{2}".format(prefix, obj.relative_path.replace(prefix, "").split(delimiter)[0], delimiter)
-                else:
-                    pfx = "{0}{1}".format(obj.relative_path.split(delimiter)[0], delimiter)
-                if not pfx in common_prefixes:
-                    common_prefixes.append(pfx)
-            else:
-                new_objects.append(obj)
-        return new_objects, common_prefixes
+    def scan_entries(self):
+        """
+        Yield (key, stat) for every object file on disk. A single scandir
+        pass: directory entries tell files from folders without a stat, and
+        each file is stat-ed exactly once.
+        """
+        stack = [(self.path, "")]
+        while stack:
+            path, prefix = stack.pop()
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if not prefix and (entry.name in INTERNAL_NAMES or entry.name.startswith(META_TEMP_PREFIX)):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, prefix + entry.name + "/"))
+                    elif entry.is_file():
+                        yield prefix + entry.name, entry.stat()
 
-    def _apply_max_keys_limit(self, objects, max_keys=1000):
-        istruncated = False
-        if len(objects) > max_keys:
-            objects = objects[:max_keys]
-            istruncated = True
-        return objects, istruncated
+    def scan_objects(self):
+        """Yield (key, stat, size, encoding) for every object file on disk, without hashing."""
+        for key, stats in self.scan_entries():
+            try:
+                yield (key, stats) + stored_format(os.path.join(self.path, key), stats)
+            except FileNotFoundError:
+                pass
 
     def delete(self):
+        with file_lock("bucket:" + self.name):
+            return self._delete()
+
+    def _delete(self):
         if os.path.exists(self.meta_manager.metafile):
             os.remove(self.meta_manager.metafile)
-        temp_dir = os.path.join(self.path, ".tmp")
-        if os.path.exists(temp_dir):
-            os.rmdir(temp_dir)
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        for name in INTERNAL_NAMES:
+            if name.startswith(INDEX_FILE) and os.path.exists(os.path.join(self.path, name)):
+                os.remove(os.path.join(self.path, name))
+        for name in [".tmp", VERSIONS_DIR]:
+            temp_dir = os.path.join(self.path, name)
+            if os.path.exists(temp_dir):
+                os.rmdir(temp_dir)
         os.rmdir(self.path)
-        del S3Obj.buckets[self.name]
+        replication.record(self.region, self.name)
         return True
 
-    def list_objects(self, encoding_type, prefix=None, max_keys=1000, marker=None, delimiter=None):
-        objects = self.get_obj_list()
-        objects = self._apply_marker(objects, marker)
-        objects = self._check_prefix(objects, prefix)
-        objects, common_prefixes = self._check_delimiter(objects, delimiter, prefix)
-        objects, istruncated = self._apply_max_keys_limit(objects, max_keys)
+    def _list_page(self, fetch, prefix=None, marker=None, delimiter=None, max_keys=1000):
+        """
+        Build one listing page from fetch(start), an iterator of index records
+        in key order after start. Once a key rolls up into a common prefix the
+        fetch restarts past that prefix, so a folder with a million keys costs
+        one query instead of a million rows.
+        """
+        prefix = prefix or ""
+        start = marker
+        if delimiter and marker and marker.startswith(prefix):
+            rest = marker[len(prefix):]
+            if rest.endswith(delimiter) and rest.find(delimiter) == len(rest) - len(delimiter):
+                # The marker is a common prefix returned by the previous page.
+                start = prefix_upper_bound(marker)
+        entries, common_prefixes = [], []
+        next_marker = next_version_id = None
+        records = fetch(start)
+        while True:
+            for record in records:
+                if len(entries) + len(common_prefixes) >= max_keys:
+                    return ListingPage(entries, common_prefixes, True, next_marker, next_version_id)
+                rest = record.key[len(prefix):]
+                if delimiter and delimiter in rest:
+                    pfx = prefix + rest.split(delimiter, 1)[0] + delimiter
+                    common_prefixes.append(pfx)
+                    next_marker, next_version_id = pfx, None
+                    records = fetch(prefix_upper_bound(pfx))
+                    break
+                entries.append(record)
+                next_marker, next_version_id = record.key, record.version_id
+            else:
+                return ListingPage(entries, common_prefixes, False, None, None)
 
-        data = {
-            "ListBucketResult": {
-                "Name": self.name,
-                "MaxKeys": max_keys,
-                "EncodingType": encoding_type,
-                "IsTruncated": istruncated,
-                "Marker": marker,
-                "Contents": [obj.__dict__() for obj in objects],
-                "CommonPrefixes": [{"Prefix": x} for x in common_prefixes]
-            }
-        }
-        if istruncated:
-            data["ListBucketResult"]["NextMarker"] = objects[-1].relative_path
-        if prefix:
-            data["ListBucketResult"]["Prefix"] = prefix
-        if delimiter:
-            data["ListBucketResult"]["Delimiter"] = delimiter 
-        return data
+    def _with_etags(self, page):
+        """Hash the objects on page imported from disk without an ETag."""
+        entries = []
+        for record in page.entries:
+            if not (record.etag or record.delete_marker):
+                try:
+                    record = record._replace(etag=S3Object(record.key, self, self.region, record.version_id, record).etag)
+                except FileNotFoundError:
+                    # Deleted since the page was read.
+                    continue
+            entries.append(record)
+        return page._replace(entries=entries)
 
-    def list_object_versions(self, encoding_type, prefix=None, max_keys=1000, marker=None, delimiter=None):
-        objects = self.get_obj_list()
-        objects = self._apply_marker(objects, marker)
-        objects = self._check_prefix(objects, prefix)
-        objects, common_prefixes = self._check_delimiter(objects, delimiter, prefix)
-        objects, istruncated = self._apply_max_keys_limit(objects, max_keys)
+    def list_objects(self, prefix=None, max_keys=1000, marker=None, delimiter=None):
+        batch_size = min(max_keys + 1, 1000)
+        return self._with_etags(self._list_page(lambda start: self.index.iter_objects(prefix, start, batch_size),
+                                                prefix, marker, delimiter, max_keys))
 
-        data = {
-            "ListVersionsResult": {
-                "Name": self.name,
-                "MaxKeys": max_keys,
-                "EncodingType": encoding_type,
-                "IsTruncated": istruncated,
-                "KeyMarker": marker,
-                "Version": [obj.__dict__(version=True) for obj in objects],
-                "CommonPrefixes": [{"Prefix": x} for x in common_prefixes]
-            }
-        }
-        if istruncated:
-            data["ListBucketResult"]["NextMarker"] = objects[-1].relative_path
-        if prefix:
-            data["ListBucketResult"]["Prefix"] = prefix
-        if delimiter:
-            data["ListBucketResult"]["Delimiter"] = delimiter 
-        return data
+    def list_objects_v2(self, prefix=None, max_keys=1000, continuation_token=None, delimiter=None, start_after=None):
+        return self.list_objects(prefix, max_keys, continuation_token or start_after, delimiter)
 
-    def list_objects_v2(self, encoding_type, prefix=None, max_keys=1000, marker=None, delimiter=None):
-        objects = self.get_obj_list()
-        objects = self._apply_marker(objects, marker)
-        objects = self._check_prefix(objects, prefix)
-        objects, common_prefixes = self._check_delimiter(objects, delimiter, prefix)
-        objects, istruncated = self._apply_max_keys_limit(objects, max_keys)
+    def list_object_versions(self, prefix=None, max_keys=1000, key_marker=None, delimiter=None, version_id_marker=None):
+        batch_size = min(max_keys + 1, 1000)
+
+        def fetch(start):
+            return self.index.iter_versions(prefix, start, version_id_marker if start == key_marker else None, batch_size)
+        return self._with_etags(self._list_page(fetch, prefix, key_marker, delimiter, max_keys))
+
+
+def stat_or_none(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
 
-        data = {
-            "ListBucketResult": {
-                "Name": self.name,
-                "Prefix": prefix,
-                "MaxKeys": max_keys,
-                "KeyCount": len(objects),
-                "EncodingType": encoding_type,
-                "IsTruncated": istruncated,
-                "Contents": [obj.__dict__(v2=True) for obj in objects]
-            }
-        }
-        if istruncated:
-            data["ListBucketResult"]["NextContinuationToken"] = objects[-1].relative_path
-        return data
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        total += sum(file_size(os.path.join(root, i)) for i in files)
+    return total
+
+
+def file_md5(path):
+    with open(path, "rb") as f:
+        file_hash = hashlib.md5()
+        chunk = f.read(aio.CHUNK_SIZE)
+        while chunk:
+            file_hash.update(chunk)
+            chunk = f.read(aio.CHUNK_SIZE)
+    return file_hash.hexdigest()
+
+
+def object_md5(path, encoding=None):
+    """MD5 of the object data in path, decompressing framed files."""
+    with open(path, "rb") as fp:
+        if encoding is None:
+            encoding = compression.detect(fp.fileno())
+        if not encoding:
+            return file_md5(path)
+        reader = compression.FrameReader(fp.fileno())
+        file_hash = hashlib.md5()
+        for frame_no, lo, hi in reader.frames_for(0, None):
+            file_hash.update(reader.read_frame(frame_no)[lo:hi])
+    return file_hash.hexdigest()
+
+
+def stored_format(path, stats):
+    """Logical size and encoding of the object file at path."""
+    with open(path, "rb") as fp:
+        encoding = compression.detect(fp.fileno())
+        size = compression.FrameReader(fp.fileno()).size if encoding else stats.st_size
+    return size, encoding
+
+
+def stored_object(path, stats):
+    """Logical size, MD5 and encoding of the object file at path."""
+    size, encoding = stored_format(path, stats)
+    return size, object_md5(path, encoding or ""), encoding
+
+
+def link_or_copy(src, dst):
+    # Hard links share the data blocks, copying is only a fallback for
+    # filesystems that do not support them.
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
 
 
 class S3Object:
 
-    def __init__(self, relative_path, bucket, region):
+    def __init__(self, relative_path, bucket, region, version_id=None, record=None):
+        # record lets bulk operations that already hold the index row of the
+        # key skip looking it up again.
         self.relative_path = relative_path
-        self.region = region if isinstance(region, S3Region) else S3Region(region)
         self.bucket = bucket if isinstance(bucket, S3Bucket) else S3Bucket(bucket, region)
+        self.region = self.bucket.region
         self.path = os.path.join(self.bucket.path, relative_path)
-        self.exists = False
-        if os.path.exists(self.path):
-            self.exists = True
-
-    def __dict__(self, v2=None, version=False):
-        if self.exists:
-            data = {
-                "Key": self.relative_path,
-                "LastModified": self.mtime,
-                "ETag": "\"{}\"".format(self.etag),
-                "Size": self.size,
-                "StorageClass": "STANDARD",
-            }
-            if not v2:
-                data["Owner"] = {"ID": settings.owner_id, "DisplayName": DISPLAY_NAME}
-            if version:
-                data["VersionId"] = "null"
-                data["IsLatest"] = True
-            return data
-        else:
-            return {}
+        self.version_id = version_id
+        self.delete_marker = False
+        self._record = record
+        self._footer = None
+        if version_id:
+            if record is None and self.bucket.exists:
+                record = self._record = self.bucket.index.get_version(relative_path, version_id)
+            if record:
+                self.delete_marker = bool(record.delete_marker)
+                if not record.is_latest:
+                    self.path = self.bucket.version_file(relative_path, version_id)
+        self._stats = None if self.delete_marker or (version_id and not record) else stat_or_none(self.path)
+        self.exists = self._stats is not None
 
     @staticmethod
     def split_bucket_and_path(path):
@@ -258,9 +738,9 @@ class S3Object:
 
     @property
     def stats(self):
-        if self.exists:
-            return os.stat(self.path)
-        return None
+        # Stat-ed once per instance, writes and deletes through this object
+        # refresh it.
+        return self._stats
 
     @property
     def mtime(self):
@@ -273,78 +753,246 @@ class S3Object:
         return datetime.datetime.fromtimestamp(stats.st_ctime, tz=datetime.timezone.utc).strftime(settings.date_fmt) if stats else ""
 
     @property
-    def size(self):
+    def record(self):
+        """
+        Index record of this object, as long as the file on disk still has
+        the mtime (and for uncompressed files the size) recorded at write.
+        """
         stats = self.stats
-        if stats:
-            return stats.st_size
+        if not stats or not self.bucket.exists:
+            return None
+        if self._record is None:
+            if self.version_id:
+                self._record = self.bucket.index.get_version(self.relative_path, self.version_id)
+            else:
+                self._record = self.bucket.index.latest(self.relative_path)
+        record = self._record
+        if record and record.mtime == stats.st_mtime and (record.encoding or record.size == stats.st_size):
+            return record
+        return None
+
+    def _read_footer(self):
+        """
+        Encoding and logical size of the file itself, for files the index
+        record no longer describes (replaced or edited behind our back).
+        """
+        stats = self.stats
+        if self._footer is None or self._footer[0] is not stats:
+            encoding, size = None, stats.st_size
+            try:
+                with open(self.path, "rb") as fp:
+                    encoding = compression.detect(fp.fileno())
+                    if encoding:
+                        size = compression.FrameReader(fp.fileno()).size
+            except OSError:
+                pass
+            self._footer = (stats, encoding, size)
+        return self._footer[1:]
+
+    @property
+    def encoding(self):
+        record = self.record
+        if record:
+            return record.encoding
+        if self.stats:
+            return self._read_footer()[0]
+        return None
+
+    @property
+    def size(self):
+        record = self.record
+        if record:
+            return record.size
+        if self.stats:
+            return self._read_footer()[1]
         return 0
 
     @property
     def etag(self):
-        with open(self.path, "rb") as f:
-            file_hash = hashlib.md5()
-            chunk = f.read(8192)
-            while chunk:
-                file_hash.update(chunk)
-                chunk = f.read(8192)
+        record = self.record
+        if record and record.etag:
+            return record.etag
+        etag = object_md5(self.path, self.encoding or "")
+        if record:
+            # Imported from disk without hashing, keep it for next time.
+            self.bucket.index.set_etag(record.key, record.version_id, record.mtime, etag)
+        return etag
+
+    @property
+    def current_path(self):
+        return os.path.join(self.bucket.path, self.relative_path)
+
+    def version_headers(self):
+        if not self.bucket.versioning:
+            return {}
+        version_id = self.version_id
+        if not version_id:
+            record = self.bucket.index.latest(self.relative_path)
+            version_id = record.version_id if record else "null"
+        return {"x-amz-version-id": version_id}
+
+    def _temp_file(self):
+        temp_dir = os.path.join(self.bucket.path, ".tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir, prefix=".put-")
+        os.close(fd)
+        return temp_path
+
+    def _new_version_id(self):
+        return get_version_id() if self.bucket.versioning == "Enabled" else "null"
 
-        return file_hash.hexdigest()
+    def _retire_latest(self, version_id):
+        """
+        Keep the data of the current latest version reachable before a new
+        version or delete marker with version_id supersedes it.
+        """
+        index = self.bucket.index
+        latest = index.latest(self.relative_path)
+        if version_id == "null":
+            stale = index.get_version(self.relative_path, "null")
+            if stale and not stale.is_latest and os.path.exists(self.bucket.version_file(self.relative_path, "null")):
+                os.remove(self.bucket.version_file(self.relative_path, "null"))
+        if not latest or latest.delete_marker or not self.bucket.versioning:
+            return
+        if latest.version_id == "null" and version_id == "null":
+            return
+        version_file = self.bucket.version_file(self.relative_path, latest.version_id)
+        if os.path.exists(self.current_path) and not os.path.exists(version_file):
+            os.makedirs(os.path.dirname(version_file), exist_ok=True)
+            link_or_copy(self.current_path, version_file)
 
-    def create_object(self, data):
+    def lock(self):
+        return file_lock("key:" + self.current_path)
+
+    def _commit(self, temp_path, etag, size=None, encoding=None):
+        with self.lock():
+            version_id = self._new_version_id()
+            self._retire_latest(version_id)
+            if not os.path.exists(os.path.dirname(self.current_path)):
+                os.makedirs(os.path.dirname(self.current_path), exist_ok=True)
+            os.replace(temp_path, self.current_path)
+            stats = os.stat(self.current_path)
+            size = stats.st_size if size is None else size
+            self.bucket.index.put_version(self.relative_path, version_id, size, stats.st_mtime, etag, encoding=encoding)
+            self._record = None
+            replication.record(self.region, self.bucket.name, self.relative_path)
+        self.path = self.current_path
+        self.version_id = version_id
+        self._stats = stats
+        self.exists = True
+        return etag
+
+    async def write_stream(self, chunks):
         if not self.bucket.exists:
             raise ValueError("Invalid Bucket")
-        if not os.path.exists(os.path.dirname(self.path)):
-            os.makedirs(os.path.dirname(self.path), exist_ok=True)
-        mode = "w"
-        if type(data) == bytes:
-            mode = "wb"
-        with open(self.path, mode) as fp:
-            fp.write(data)
-        return get_etag(data)
-
-    def create_temp_file(self, data, upload_id, part_no):
+        algorithm = await aio.run(lambda: self.bucket.compression)
+        temp_path = await aio.run(self._temp_file)
+        try:
+            size, etag = await aio.write_chunks(temp_path, chunks, algorithm=algorithm)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return await aio.run(self._commit, temp_path, etag, size, algorithm)
+
+    async def write_part_stream(self, chunks, upload_id, part_no):
         if not self.bucket.exists:
             raise ValueError("Invalid Bucket")
-        temp_dir = os.path.join(self.bucket.path, ".tmp/{}".format(upload_id))
-        temp_file = os.path.join(temp_dir, part_no)
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
-        with open(temp_file, "wb") as fp:
-            fp.write(data)
-        return get_etag(data)
+        temp_dir = self.bucket.upload_dir(upload_id)
+        part_file = os.path.join(temp_dir, part_no)
+        await aio.run(functools.partial(os.makedirs, temp_dir, exist_ok=True))
+        previous = await aio.run(file_size, part_file)
+        size, etag = await aio.write_chunks(part_file, chunks)
+        await aio.run(self.bucket.index.add_multipart_bytes, size - previous)
+        return etag
+
+    def read_stream(self, start=0, end=None):
+        if self.encoding:
+            return aio.read_frames(self.path, start, end)
+        return aio.read_chunks(self.path, start, end)
 
     def merge_temp_file(self, upload_id, parts_list):
-        temp_dir = os.path.join(self.bucket.path, ".tmp/{}".format(upload_id))
-        with open(self.path, "ab") as fp:
-            for part in parts_list:
-                with open(os.path.join(temp_dir, part["PartNumber"]), "rb") as part:
-                    data = part.read()
-                    # if hashlib.md5(data).hexdigest() != part["ETag"]:
-                    #     raise ValueError("Corrupt file.")
-                    fp.write(data)
-        shutil.rmtree(temp_dir)
+        temp_dir = self.bucket.upload_dir(upload_id)
+        algorithm = self.bucket.compression
+        with file_lock("upload:" + upload_id):
+            temp_path = self._temp_file()
+            file_hash = hashlib.md5()
+            size = 0
+            with open(temp_path, "wb") as fp:
+                writer = compression.FrameWriter(fp, algorithm) if algorithm else fp
+                for part in parts_list:
+                    with open(os.path.join(temp_dir, part["PartNumber"]), "rb") as part:
+                        data = part.read(aio.CHUNK_SIZE)
+                        while data:
+                            file_hash.update(data)
+                            size += len(data)
+                            writer.write(data)
+                            data = part.read(aio.CHUNK_SIZE)
+                if algorithm:
+                    writer.close()
+            self._commit(temp_path, file_hash.hexdigest(), size, algorithm)
+            # The upload's metadata is moved to the key by the caller.
+            self.bucket.remove_upload(upload_id, keep_metadata=True)
         return True
 
-    def read_object(self, range_low=None, range_high=None):
-        if self.exists:
-            with open(self.path, "rb") as fp:
-                if range_low:
-                    fp.seek(range_low, 0)
-                    if range_high:
-                        return fp.read(range_high-range_low)
-                return fp.read()
-        else:
-            return ""
-
     def delete_object(self):
-        if self.exists:
-            os.remove(self.path)
-            # self.bucket.meta_manager.delete(self.relative_path)
-            return True
-        return False
+        if not self.bucket.exists:
+            return False
+        with self.lock():
+            return self._delete_object()
+
+    def _delete_object(self):
+        if self.version_id:
+            return self._delete_version()
+        if not self.bucket.versioning:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+                self.bucket.index.remove_version(self.relative_path, "null")
+                # self.bucket.meta_manager.delete(self.relative_path)
+                replication.record(self.region, self.bucket.name, self.relative_path)
+                self._stats = None
+                self.exists = False
+                return True
+            return False
+        # Versioned buckets keep the data and stack a delete marker on top.
+        version_id = self._new_version_id()
+        self._retire_latest(version_id)
+        if os.path.exists(self.current_path):
+            os.remove(self.current_path)
+        self.bucket.index.put_version(self.relative_path, version_id, 0, datetime.datetime.now().timestamp(), None, delete_marker=True)
+        replication.record(self.region, self.bucket.name, self.relative_path)
+        self.version_id = version_id
+        self.delete_marker = True
+        self._stats = None
+        self.exists = False
+        return True
+
+    def _delete_version(self):
+        index = self.bucket.index
+        record = index.get_version(self.relative_path, self.version_id)
+        if not record:
+            return False
+        if record.is_latest and not record.delete_marker and os.path.exists(self.current_path):
+            os.remove(self.current_path)
+        version_file = self.bucket.version_file(self.relative_path, self.version_id)
+        if os.path.exists(version_file):
+            os.remove(version_file)
+        head = index.remove_version(self.relative_path, self.version_id)
+        previous_file = self.bucket.version_file(self.relative_path, head.version_id) if head else None
+        if record.is_latest and head and not head.delete_marker and os.path.exists(previous_file):
+            # Promote the previous version back to the object path.
+            temp_path = self._temp_file()
+            os.remove(temp_path)
+            link_or_copy(previous_file, temp_path)
+            os.makedirs(os.path.dirname(self.current_path), exist_ok=True)
+            os.replace(temp_path, self.current_path)
+        replication.record(self.region, self.bucket.name, self.relative_path, self.version_id)
+        self._stats = None
+        self.exists = False
+        return True
 
     def set_metadata(self, metadata):
         self.bucket.meta_manager.set(self.relative_path, metadata)
+        replication.record(self.region, self.bucket.name, self.relative_path)
 
     def get_metadata(self):
         return self.bucket.meta_manager.get(self.relative_path)
@@ -366,26 +1014,36 @@ class MetaManager:
             return {}
 
     def _write(self, data):
-        with open(self.metafile, "w") as fp:
+        # Readers in other workers must never see a half written file.
+        temp_path = "{}.{}.tmp".format(self.metafile, os.getpid())
+        with open(temp_path, "w") as fp:
             json.dump(data, fp)
+        os.replace(temp_path, self.metafile)
+
+    def lock(self):
+        return file_lock("meta:" + self.metafile)
 
     def get(self, object_name):
         return self._read().get(object_name, {})
 
     def set(self, object_name, meta):
-        data = self._read()
-        data[object_name] = meta
-        self._write(data)
+        with self.lock():
+            data = self._read()
+            data[object_name] = meta
+            self._write(data)
 
     def delete(self, object_name):
-        data = self._read()
-        if data.get(object_name, None):
-            del data[object_name]
-        self._write(data)
+        with self.lock():
+            data = self._read()
+            if data.get(object_name, None):
+                del data[object_name]
+            self._write(data)
 
     def move(self, old_object, new_object):
-        data = self._read()
-        if data.get(old_object, None):
-            data[new_object] = data[old_object]
-            del data[old_object]
-        self._write(data)
+        with self.lock():
+            data = self._read()
+            if data.get(old_object, None):
+                data[new_object] = data[old_object]
+                del data[old_object]
+            self._write(data)
+        replication.record(self.region, self.bucket.name, new_object)
@@ -0,0 +1,291 @@
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+from urllib.parse import parse_qsl, quote, urlencode, urlsplit, urlunsplit
+
+from .settings import settings
+from .utils import get_secret_key, get_signature, get_signing_key
+
+
+SIGV4_ALGORITHM = "AWS4-HMAC-SHA256"
+SIGV4_MAX_EXPIRES = 7 * 24 * 3600
+AMZ_DATE_FMT = "%Y%m%dT%H%M%SZ"
+
+# Query parameters that are part of the SigV2 canonical resource.
+SUBRESOURCES = {
+    "acl", "delete", "lifecycle", "location", "partNumber", "policy", "tagging", "uploadId", "uploads",
+    "versionId", "versioning", "versions", "response-cache-control", "response-content-disposition",
+    "response-content-encoding", "response-content-language", "response-content-type", "response-expires",
+}
+# Form fields a POST policy does not have to mention.
+UNSIGNED_FIELDS = {"awsaccesskeyid", "signature", "x-amz-signature", "policy", "file"}
+
+
+class PresignError(Exception):
+    pass
+
+
+class InvalidAccessKey(PresignError):
+    def __init__(self, access_key):
+        super().__init__(access_key)
+        self.access_key = access_key
+
+
+class SignatureMismatch(PresignError):
+    def __init__(self, access_key, string_to_sign, signature):
+        super().__init__(access_key)
+        self.access_key = access_key
+        self.string_to_sign = string_to_sign
+        self.signature = signature
+
+
+class RequestExpired(PresignError):
+    def __init__(self, expiry):
+        super().__init__(expiry)
+        self.expiry = expiry
+
+
+class MalformedRequest(PresignError):
+    pass
+
+
+class PolicyViolation(PresignError):
+    pass
+
+
+class EntitySizeError(PresignError):
+    def __init__(self, code, size, limit_name, limit):
+        super().__init__(code)
+        self.code = code
+        self.size = size
+        self.limit_name = limit_name
+        self.limit = limit
+
+
+def _now():
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+def _secret_key(access_key):
+    secret_key = get_secret_key(access_key)
+    if not secret_key:
+        raise InvalidAccessKey(access_key)
+    return secret_key
+
+
+def _check_signature(expected, provided, access_key, string_to_sign):
+    if settings.validate_signature and not hmac.compare_digest(expected, provided or ""):
+        raise SignatureMismatch(access_key, string_to_sign, provided)
+
+
+def _sigv4_scope(credential):
+    try:
+        access_key, date, region, service, request_type = credential.split("/")
+    except (AttributeError, ValueError):
+        raise MalformedRequest("Error parsing the X-Amz-Credential parameter")
+    return access_key, date, region, service, request_type
+
+
+def _parse_amz_date(value):
+    try:
+        return datetime.datetime.strptime(value, AMZ_DATE_FMT).replace(tzinfo=datetime.timezone.utc)
+    except (TypeError, ValueError):
+        raise MalformedRequest("X-Amz-Date must be in the ISO8601 Long Format \"yyyyMMdd'T'HHmmss'Z'\"")
+
+
+def is_presigned(params):
+    return "X-Amz-Signature" in params or ("Signature" in params and "Expires" in params)
+
+
+def sigv2_string_to_sign(method, path, expires, params, headers):
+    amz_headers = "".join("{}:{}\n".format(k, headers[k].strip()) for k in sorted(headers.keys()) if k.startswith("x-amz-"))
+    # Like botocore's HmacV1 signer, bucket level resources keep the
+    # trailing slash: "/bucket/" and "/bucket/?versioning".
+    bucket, _, key = path.lstrip("/").partition("/")
+    resource = quote("/{}/{}".format(bucket, key) if bucket else "/", safe="/~")
+    subresources = sorted((k, v) for k, v in params if k in SUBRESOURCES)
+    if subresources:
+        resource += "?" + "&".join(k if v == "" else "{}={}".format(k, v) for k, v in subresources)
+    return "\n".join([method, headers.get("content-md5", ""), headers.get("content-type", ""), str(expires), amz_headers + resource])
+
+
+def sigv4_canonical_request(method, raw_path, params, headers, signed_headers):
+    query = sorted((quote(k, safe="-_.~"), quote(v, safe="-_.~")) for k, v in params if k != "X-Amz-Signature")
+    canonical_headers = "".join("{}:{}\n".format(h, " ".join(headers.get(h, "").split())) for h in signed_headers)
+    payload = dict(params).get("X-Amz-Content-Sha256", "UNSIGNED-PAYLOAD")
+    return "\n".join([method, raw_path, "&".join("{}={}".format(k, v) for k, v in query),
+                      canonical_headers, ";".join(signed_headers), payload])
+
+
+def sigv4_signature(secret_key, amz_date, scope, canonical):
+    date, region, service, request_type = scope
+    string_to_sign = "\n".join([SIGV4_ALGORITHM, amz_date, "/".join(scope), hashlib.sha256(canonical.encode("utf-8")).hexdigest()])
+    signing_key = get_signing_key(secret_key, date, region, service, request_type)
+    return string_to_sign, hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def verify_sigv2_query(method, path, params, headers, now=None):
+    args = dict(params)
+    access_key = args.get("AWSAccessKeyId")
+    secret_key = _secret_key(access_key)
+    try:
+        expires = int(args["Expires"])
+    except ValueError:
+        raise MalformedRequest("Invalid Expires parameter")
+    string_to_sign = sigv2_string_to_sign(method, path, expires, params, headers)
+    _check_signature(get_signature(string_to_sign, secret_key, url_encoded=False), args.get("Signature"), access_key, string_to_sign)
+    expiry = datetime.datetime.fromtimestamp(expires, datetime.timezone.utc)
+    if expiry < (now or _now()):
+        raise RequestExpired(expiry)
+
+
+def verify_sigv4_query(method, raw_path, params, headers, now=None):
+    args = dict(params)
+    if args.get("X-Amz-Algorithm") != SIGV4_ALGORITHM:
+        raise MalformedRequest("X-Amz-Algorithm only supports \"{}\"".format(SIGV4_ALGORITHM))
+    access_key, date, region, service, request_type = _sigv4_scope(args.get("X-Amz-Credential"))
+    secret_key = _secret_key(access_key)
+    issued = _parse_amz_date(args.get("X-Amz-Date"))
+    try:
+        expires = int(args.get("X-Amz-Expires", ""))
+    except ValueError:
+        raise MalformedRequest("X-Amz-Expires should be a number")
+    if not 0 <= expires <= SIGV4_MAX_EXPIRES:
+        raise MalformedRequest("X-Amz-Expires must be less than a week (in seconds) that is 604800")
+    signed_headers = args.get("X-Amz-SignedHeaders", "host").split(";")
+    canonical = sigv4_canonical_request(method, raw_path, params, headers, signed_headers)
+    string_to_sign, expected = sigv4_signature(secret_key, args["X-Amz-Date"], (date, region, service, request_type), canonical)
+    _check_signature(expected, args.get("X-Amz-Signature"), access_key, string_to_sign)
+    expiry = issued + datetime.timedelta(seconds=expires)
+    if expiry < (now or _now()):
+        raise RequestExpired(expiry)
+    return region
+
+
+def verify_query(method, path, raw_path, params, headers, now=None):
+    """
+    Validate a presigned URL. params are the decoded query items, path the
+    decoded /bucket/key path and raw_path the path exactly as the client
+    sent it. Returns the region of a SigV4 credential scope, None for SigV2
+    which has no region. Raises a PresignError subclass when the request
+    must be rejected.
+    """
+    if "X-Amz-Signature" in dict(params):
+        return verify_sigv4_query(method, raw_path, params, headers, now)
+    verify_sigv2_query(method, path, params, headers, now)
+    return None
+
+
+def presign_url(method, url, access_key, secret_key, region, expires=3600, now=None):
+    """SigV4 query signed version of url, as accepted by verify_query."""
+    split = urlsplit(url)
+    now = now or _now()
+    amz_date = now.strftime(AMZ_DATE_FMT)
+    scope = (now.strftime("%Y%m%d"), region, "s3", "aws4_request")
+    params = parse_qsl(split.query, keep_blank_values=True) + [
+        ("X-Amz-Algorithm", SIGV4_ALGORITHM),
+        ("X-Amz-Credential", "/".join((access_key,) + scope)),
+        ("X-Amz-Date", amz_date),
+        ("X-Amz-Expires", str(expires)),
+        ("X-Amz-SignedHeaders", "host"),
+    ]
+    canonical = sigv4_canonical_request(method, split.path, params, {"host": split.netloc}, ["host"])
+    string_to_sign, signature = sigv4_signature(secret_key, amz_date, scope, canonical)
+    query = urlencode(params + [("X-Amz-Signature", signature)], safe="~", quote_via=quote)
+    return urlunsplit((split.scheme, split.netloc, split.path, query, ""))
+
+
+def _policy_expiry(policy):
+    try:
+        return datetime.datetime.fromisoformat(policy["expiration"].replace("Z", "+00:00"))
+    except (KeyError, AttributeError, TypeError, ValueError):
+        raise PolicyViolation("Invalid Policy: Invalid 'expiration' value")
+
+
+def _check_condition(condition, fields, bucket):
+    """Returns the name of the field the condition covers."""
+    if isinstance(condition, dict):
+        if len(condition) != 1:
+            raise PolicyViolation("Invalid Policy: Invalid Simple-Condition: Simple-Conditions must have exactly one property specified.")
+        (name, value), = condition.items()
+        operator = "eq"
+    elif isinstance(condition, list) and len(condition) == 3:
+        operator, name, value = str(condition[0]).lower(), str(condition[1]), condition[2]
+        if not name.startswith("$"):
+            raise PolicyViolation("Invalid Policy: Invalid Condition: Field names must start with '$'")
+        name = name[1:]
+    else:
+        raise PolicyViolation("Invalid Policy: Invalid Condition: {}".format(json.dumps(condition)))
+    if not isinstance(value, str):
+        raise PolicyViolation("Invalid Policy: Invalid Condition: {}".format(json.dumps(condition)))
+    name = name.lower()
+    actual = bucket if name == "bucket" else fields.get(name, "")
+    if operator == "eq":
+        matched = actual == value
+    elif operator == "starts-with":
+        matched = actual.startswith(value)
+    else:
+        raise PolicyViolation("Invalid Policy: Invalid Condition: Unknown operation '{}'".format(operator))
+    if not matched:
+        raise PolicyViolation("Invalid according to Policy: Policy Condition failed: {}".format(json.dumps(condition)))
+    return name
+
+
+def verify_post_policy(fields, bucket, now=None):
+    """
+    Validate the signature and conditions of a browser POST upload. fields
+    maps the lowercased form field names to their values, with ${filename}
+    already substituted in the key. Returns the (min, max) content length
+    range the policy allows, or None when it has no such condition; the
+    caller checks it once the size of the file is known.
+    """
+    encoded_policy = fields.get("policy")
+    if not encoded_policy:
+        raise PolicyViolation("Bucket POST must contain a field named 'policy'")
+    if "x-amz-signature" in fields:
+        if fields.get("x-amz-algorithm") != SIGV4_ALGORITHM:
+            raise PolicyViolation("Invalid according to Policy: x-amz-algorithm must be {}".format(SIGV4_ALGORITHM))
+        access_key, date, region, service, request_type = _sigv4_scope(fields.get("x-amz-credential"))
+        signing_key = get_signing_key(_secret_key(access_key), date, region, service, request_type)
+        expected = hmac.new(signing_key, encoded_policy.encode("utf-8"), hashlib.sha256).hexdigest()
+        _check_signature(expected, fields["x-amz-signature"], access_key, encoded_policy)
+    else:
+        access_key = fields.get("awsaccesskeyid")
+        expected = get_signature(encoded_policy, _secret_key(access_key), url_encoded=False)
+        _check_signature(expected, fields.get("signature"), access_key, encoded_policy)
+
+    try:
+        policy = json.loads(base64.b64decode(encoded_policy))
+    except ValueError:
+        raise PolicyViolation("Invalid Policy: Invalid JSON.")
+    expiry = _policy_expiry(policy)
+    if expiry < (now or _now()):
+        raise RequestExpired(expiry)
+
+    conditions = policy.get("conditions", [])
+    if not isinstance(conditions, list):
+        raise PolicyViolation("Invalid Policy: Invalid 'conditions' value")
+    covered, length_range = set(), None
+    for condition in conditions:
+        if isinstance(condition, list) and condition and str(condition[0]).lower() == "content-length-range":
+            try:
+                length_range = (int(condition[1]), int(condition[2]))
+            except (IndexError, TypeError, ValueError):
+                raise PolicyViolation("Invalid Policy: Invalid content-length-range: {}".format(json.dumps(condition)))
+            continue
+        covered.add(_check_condition(condition, fields, bucket))
+    extra = [i for i in fields if i not in covered and i not in UNSIGNED_FIELDS and not i.startswith("x-ignore-")]
+    if extra:
+        raise PolicyViolation("Invalid according to Policy: Extra input fields: {}".format(", ".join(sorted(extra))))
+    return length_range
+
+
+def check_content_length(length_range, size):
+    if not length_range:
+        return
+    if size < length_range[0]:
+        raise EntitySizeError("EntityTooSmall", size, "MinSizeAllowed", length_range[0])
+    if size > length_range[1]:
+        raise EntitySizeError("EntityTooLarge", size, "MaxSizeAllowed", length_range[1])
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Rebuild the usage counters of buckets from their index and pending
+multipart uploads. Safe to run while the server is up.
+
+    python -m app.reconcile [bucket ...]
+"""
+
+import argparse
+import importlib
+import json
+
+from .settings import settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("buckets", nargs="*", help="buckets to reconcile, all of them by default")
+    args = parser.parse_args()
+
+    model = importlib.import_module("app.{}".format(settings.model))
+    for name, region in sorted(model.S3().buckets.items()):
+        if args.buckets and name not in args.buckets:
+            continue
+        bucket = model.S3Bucket(name, region)
+        before = bucket.usage
+        after = bucket.reconcile_usage()
+        print(json.dumps({"bucket": name, "before": before, "after": after}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,524 @@
+import asyncio
+import datetime
+import http.client
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from urllib.parse import quote, urlsplit
+
+from . import aio, compression, serializer
+from .lifecycle import lifecycle_configuration
+from .locks import LeaderLock, file_lock
+from .presign import presign_url
+from .settings import settings
+
+
+COPY_CHUNK_SIZE = 1024 * 1024
+# The active log segment is sealed once it grew past this.
+SEGMENT_SIZE = 64 * 1024 * 1024
+MAX_BACKOFF = 60
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicationError(Exception):
+    pass
+
+
+class ChangeLog:
+    """
+    Append only log of the keys and buckets that changed, shared by every
+    worker using the data root. Entries only name what changed, the
+    replicator reads the current state when it ships them, so replaying an
+    entry twice is harmless.
+
+    The log is split in numbered segments. Workers append to changes.log,
+    the replicator renames it to changes.<n>.log once it grew past
+    SEGMENT_SIZE and deletes sealed segments once every entry in them was
+    shipped, so the log stays bounded under a steady stream of writes. The
+    active segment's number is one past the newest sealed one. The cursor,
+    a segment number and an offset in it, is kept next to the log and
+    survives restarts.
+    """
+
+    def __init__(self, root=None):
+        self.dir = os.path.join(root or settings.data_root, ".replication")
+        self.path = os.path.join(self.dir, "changes.log")
+        self.cursor_path = os.path.join(self.dir, "cursor")
+
+    def append(self, event):
+        line = (json.dumps(event, separators=(",", ":")) + "\n").encode("utf-8")
+        with file_lock("replication:log"):
+            os.makedirs(self.dir, exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+    def size(self):
+        return file_size(self.path)
+
+    def sealed(self):
+        """Numbers of the sealed segments, oldest first."""
+        try:
+            names = os.listdir(self.dir)
+        except FileNotFoundError:
+            return []
+        return sorted(int(match.group(1)) for match in map(_SEALED_SEGMENT.match, names) if match)
+
+    def sealed_path(self, number):
+        return os.path.join(self.dir, "changes.{}.log".format(number))
+
+    def active_number(self, cursor):
+        sealed = self.sealed()
+        return max(sealed[-1] + 1 if sealed else 1, cursor[0])
+
+    def _segment_path(self, number, active):
+        return self.path if number == active else self.sealed_path(number)
+
+    def read(self, cursor, limit):
+        """Up to limit complete entries after cursor, and the cursor following them."""
+        number, offset = cursor
+        active = self.active_number(cursor)
+        events = []
+        while len(events) < limit:
+            try:
+                fp = open(self._segment_path(number, active), "rb")
+            except FileNotFoundError:
+                if number < active:
+                    # Deleted once shipped.
+                    number, offset = number + 1, 0
+                    continue
+                break
+            with fp:
+                if offset > os.fstat(fp.fileno()).st_size:
+                    # The log was truncated after the cursor was written.
+                    offset = 0
+                fp.seek(offset)
+                while len(events) < limit:
+                    line = fp.readline()
+                    if not line.endswith(b"\n"):
+                        # Nothing more, or an entry still being written.
+                        break
+                    offset += len(line)
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        logger.warning("Skipping corrupt change log entry ending at offset %d of segment %d", offset, number)
+            if number == active or len(events) >= limit:
+                break
+            # Sealed segments never grow, move on to the next one.
+            number, offset = number + 1, 0
+        return events, (number, offset)
+
+    def lag(self, cursor):
+        """Bytes of entries after cursor."""
+        number, offset = cursor
+        active = self.active_number(cursor)
+        total = max(file_size(self._segment_path(number, active)) - offset, 0)
+        for later in range(number + 1, active + 1):
+            total += file_size(self._segment_path(later, active))
+        return total
+
+    def load_cursor(self):
+        try:
+            with open(self.cursor_path) as fp:
+                fields = fp.read().split()
+        except OSError:
+            return 1, 0
+        try:
+            if len(fields) == 1:
+                # Written before the log had segments.
+                return 1, int(fields[0])
+            return int(fields[0]), int(fields[1])
+        except (IndexError, ValueError):
+            return 1, 0
+
+    def save_cursor(self, cursor):
+        os.makedirs(self.dir, exist_ok=True)
+        temp_path = "{}.{}.tmp".format(self.cursor_path, os.getpid())
+        with open(temp_path, "w") as fp:
+            fp.write("{} {}".format(*cursor))
+        os.replace(temp_path, self.cursor_path)
+
+    def compact(self, cursor):
+        """Seal the active segment once it is large enough and drop the segments before cursor."""
+        with file_lock("replication:log"):
+            if self.size() >= SEGMENT_SIZE:
+                os.rename(self.path, self.sealed_path(self.active_number(cursor)))
+        for number in self.sealed():
+            if number < cursor[0]:
+                remove_file(self.sealed_path(number))
+
+
+_SEALED_SEGMENT = re.compile(r"^changes\.(\d+)\.log$")
+_changelog = None
+
+
+def changelog():
+    global _changelog
+    if _changelog is None:
+        _changelog = ChangeLog()
+    return _changelog
+
+
+def record(region, bucket, key=None, version_id=None):
+    """
+    Note a change to a key, or to the bucket itself when key is None.
+    version_id names a version that was removed. A no-op unless replication
+    is configured.
+    """
+    if not settings.replication_target:
+        return
+    changelog().append({"region": str(region), "bucket": bucket, "key": key, "version_id": version_id,
+                        "time": datetime.datetime.now(tz=datetime.timezone.utc).timestamp()})
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def stat_or_none(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def copy_file(source, target, temp_dir):
+    """Atomically copy source over target keeping its mtime, unless target already matches."""
+    try:
+        src = open(source, "rb")
+    except FileNotFoundError:
+        return False
+    with src:
+        stats = os.fstat(src.fileno())
+        existing = stat_or_none(target)
+        if existing and existing.st_size == stats.st_size and existing.st_mtime_ns == stats.st_mtime_ns:
+            return False
+        os.makedirs(temp_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir, prefix=".repl-")
+        try:
+            with os.fdopen(fd, "wb") as dst:
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+            # Index records are checked against the mtime of the file.
+            os.utime(temp_path, ns=(stats.st_atime_ns, stats.st_mtime_ns))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(temp_path, target)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    return True
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class DirectoryTarget:
+    """
+    Mirrors the data root layout into another directory, including version
+    files, metadata and a snapshot of each bucket index, so the copy can be
+    served by pointing BUCKET_PATH at it. Object files are copied as they
+    change, the index of a changed bucket at most once per snapshot_interval
+    (and right away when the bucket configuration changed); fsck --repair
+    on the copy brings the index up to date with the files it holds.
+    """
+
+    def __init__(self, root, snapshot_interval=None):
+        self.root = root
+        if os.path.realpath(root) == os.path.realpath(settings.data_root):
+            raise ValueError("Replication target must not be the data root")
+        self.snapshot_interval = settings.replication_snapshot_interval if snapshot_interval is None else snapshot_interval
+        # (region, name) -> bucket changed since its last snapshot
+        self.stale = {}
+        # (region, name) -> time.monotonic() of the last snapshot
+        self.snapshots = {}
+
+    def bucket_path(self, bucket):
+        return os.path.join(self.root, bucket.region.name, bucket.name)
+
+    def prepare_bucket(self, bucket, changed):
+        if bucket.exists:
+            os.makedirs(self.bucket_path(bucket), exist_ok=True)
+
+    def sync_key(self, bucket, obj, removed_versions):
+        if not bucket.exists:
+            # finish_bucket drops the whole copy.
+            return
+        target = self.bucket_path(bucket)
+        temp_dir = os.path.join(target, ".tmp")
+        current = None
+        for version in bucket.index.key_versions(obj.relative_path):
+            if version.delete_marker:
+                continue
+            if version.is_latest:
+                current = version
+                copy_file(obj.current_path, os.path.join(target, obj.relative_path), temp_dir)
+            else:
+                path = bucket.version_file(obj.relative_path, version.version_id)
+                copy_file(path, os.path.join(target, os.path.relpath(path, bucket.path)), temp_dir)
+        if current is None:
+            remove_file(os.path.join(target, obj.relative_path))
+        for version_id in removed_versions:
+            if not bucket.index.get_version(obj.relative_path, version_id):
+                path = bucket.version_file(obj.relative_path, version_id)
+                remove_file(os.path.join(target, os.path.relpath(path, bucket.path)))
+
+    def finish_bucket(self, bucket, changed):
+        target = self.bucket_path(bucket)
+        name = (bucket.region.name, bucket.name)
+        if not bucket.exists:
+            shutil.rmtree(target, ignore_errors=True)
+            self.stale.pop(name, None)
+            return
+        copy_file(bucket.meta_manager.metafile, os.path.join(target, ".metadata.json"), os.path.join(target, ".tmp"))
+        self.stale[name] = bucket
+        if changed:
+            # Versioning, compression and lifecycle live in the index.
+            self.snapshots.pop(name, None)
+
+    def flush(self, force=False):
+        """Snapshot the index of the changed buckets whose last snapshot is old enough."""
+        now = time.monotonic()
+        for name, bucket in list(self.stale.items()):
+            last = self.snapshots.get(name)
+            if force or last is None or now - last >= self.snapshot_interval:
+                del self.stale[name]
+                if bucket.exists:
+                    self.snapshot(bucket)
+                self.snapshots[name] = now
+
+    def snapshot(self, bucket):
+        target = self.bucket_path(bucket)
+        temp_dir = os.path.join(target, ".tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir, prefix=".repl-")
+        os.close(fd)
+        try:
+            bucket.index.backup(temp_path)
+            index_path = os.path.join(target, os.path.basename(bucket.index.path))
+            for suffix in ("-wal", "-shm"):
+                remove_file(index_path + suffix)
+            os.replace(temp_path, index_path)
+        except BaseException:
+            remove_file(temp_path)
+            raise
+
+
+def _frames(path):
+    with open(path, "rb") as fp:
+        reader = compression.FrameReader(fp.fileno())
+        for frame_no, lo, hi in reader.frames_for(0, None):
+            yield reader.read_frame(frame_no)[lo:hi]
+
+
+class HttpTarget:
+    """
+    Ships the current state of every changed key and bucket to another
+    pseudo-s3 (or S3 compatible) endpoint using presigned requests. Only the
+    latest version of each key is carried over. Server errors are retried,
+    a 4xx answer is logged and the change skipped.
+    """
+
+    def __init__(self, url, access_key=None, secret_key=None, timeout=60):
+        self.url = url.rstrip("/")
+        self.access_key = access_key or settings.replication_access_key
+        self.secret_key = secret_key or settings.replication_secret_key
+        self.timeout = timeout
+
+    def request(self, method, region, path, query="", body=None, headers=None):
+        url = presign_url(method, "{}{}{}".format(self.url, quote(path, safe="/~"), query), self.access_key, self.secret_key, region)
+        split = urlsplit(url)
+        connection_class = http.client.HTTPSConnection if split.scheme == "https" else http.client.HTTPConnection
+        conn = connection_class(split.netloc, timeout=self.timeout, blocksize=COPY_CHUNK_SIZE)
+        try:
+            conn.request(method, "{}?{}".format(split.path, split.query), body=body, headers=headers or {})
+            response = conn.getresponse()
+            content = response.read()
+        except OSError as error:
+            raise ReplicationError("{} {}: {}".format(method, path, error))
+        finally:
+            conn.close()
+        if response.status >= 500:
+            raise ReplicationError("{} {} failed with {}".format(method, path, response.status))
+        return response.status, content
+
+    def _check(self, method, path, status, content, allowed=()):
+        if status >= 300 and status not in allowed:
+            logger.warning("Replication %s %s rejected with %d: %s", method, path, status, content[:200])
+
+    def prepare_bucket(self, bucket, changed):
+        if not (changed and bucket.exists):
+            return
+        region, path = bucket.region.name, "/" + bucket.name
+        status, content = self.request("PUT", region, path)
+        if b"BucketAlreadyOwnedByYou" not in content:
+            self._check("PUT", path, status, content)
+        if bucket.versioning:
+            status, content = self.request("PUT", region, path, "?versioning", serializer.to_xml(bucket.get_versioning()))
+            self._check("PUT", path + "?versioning", status, content)
+        for name, config in (("lifecycle", bucket.lifecycle_rules and lifecycle_configuration(bucket.lifecycle_rules)),
+                             ("compression", bucket.compression and bucket.get_compression())):
+            if config:
+                status, content = self.request("PUT", region, path, "?" + name, serializer.to_xml(config))
+            else:
+                status, content = self.request("DELETE", region, path, "?" + name)
+            self._check("PUT", "{}?{}".format(path, name), status, content, (404,))
+
+    def sync_key(self, bucket, obj, removed_versions):
+        path = "/{}/{}".format(bucket.name, obj.relative_path)
+        if not obj.exists:
+            status, content = self.request("DELETE", bucket.region.name, path)
+            self._check("DELETE", path, status, content, (404,))
+            return
+        headers = dict(obj.get_metadata())
+        if obj.encoding:
+            # Stored compressed, sent as the original bytes. A length keeps
+            # the target from falling back to chunked transfer encoding.
+            headers["Content-Length"] = str(obj.size)
+            status, content = self.request("PUT", bucket.region.name, path, body=_frames(obj.path), headers=headers)
+        else:
+            with open(obj.path, "rb") as fp:
+                headers["Content-Length"] = str(os.fstat(fp.fileno()).st_size)
+                status, content = self.request("PUT", bucket.region.name, path, body=fp, headers=headers)
+        self._check("PUT", path, status, content)
+
+    def finish_bucket(self, bucket, changed):
+        if changed and not bucket.exists:
+            path = "/" + bucket.name
+            status, content = self.request("DELETE", bucket.region.name, path)
+            self._check("DELETE", path, status, content, (404,))
+
+    def flush(self, force=False):
+        pass
+
+
+def make_target(target):
+    if target.startswith(("http://", "https://")):
+        return HttpTarget(target)
+    return DirectoryTarget(target)
+
+
+class Replicator:
+    """
+    Background task shipping the change log to the replication target. It
+    pulls at its own pace, a batch of entries at a time with a bounded number
+    of keys in flight, so request handlers only ever pay for appending one
+    line to the log and a slow or unreachable target shows up as growing lag
+    instead of slower writes. The cursor only moves once a whole batch has
+    been shipped; after a crash or a failed batch the entries are shipped
+    again. When several workers share a data root only the leader runs it.
+    """
+
+    def __init__(self, storage, bucket_class, object_class, target=None, interval=None, batch_size=None, concurrency=None):
+        self.storage = storage
+        self.bucket_class = bucket_class
+        self.object_class = object_class
+        self.target_url = settings.replication_target if target is None else target
+        self.interval = settings.replication_interval if interval is None else interval
+        self.batch_size = settings.replication_batch_size if batch_size is None else batch_size
+        self.concurrency = settings.replication_concurrency if concurrency is None else concurrency
+        self.log = ChangeLog()
+        self.target = None
+        self.task = None
+        self.leader = LeaderLock("replication")
+
+    @property
+    def enabled(self):
+        return bool(self.target_url)
+
+    def start(self):
+        if self.enabled and self.task is None:
+            self.target = make_target(self.target_url)
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            await aio.run(self.target.flush, True)
+        self.leader.release()
+
+    def status(self):
+        segment, offset = cursor = self.log.load_cursor()
+        return {"enabled": self.enabled, "target": self.target_url, "cursor": {"segment": segment, "offset": offset},
+                "lag_bytes": self.log.lag(cursor) if self.enabled else 0}
+
+    async def run(self):
+        failures = 0
+        while True:
+            shipped = 0
+            try:
+                if self.leader.acquire():
+                    shipped = await self.run_once()
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                failures += 1
+                logger.exception("Replication batch failed, retrying")
+                await asyncio.sleep(min(self.interval * 2 ** failures, MAX_BACKOFF))
+                continue
+            if shipped < self.batch_size:
+                await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        cursor = await aio.run(self.log.load_cursor)
+        events, next_cursor = await aio.run(self.log.read, cursor, self.batch_size)
+        if events:
+            await self.ship(events)
+        if next_cursor != cursor:
+            await aio.run(self.log.save_cursor, next_cursor)
+        await aio.run(self.log.compact, next_cursor)
+        await aio.run(self.target.flush)
+        return len(events)
+
+    async def ship(self, events):
+        """
+        Coalesce a batch into one sync per touched key. Buckets are prepared
+        before their keys and finished after them, so a new bucket exists on
+        the target before its objects arrive and a dropped one is removed
+        once its objects are gone.
+        """
+        buckets, keys = {}, {}
+        for event in events:
+            name = (event["bucket"], event["region"])
+            buckets[name] = buckets.get(name, False) or event["key"] is None
+            if event["key"] is not None:
+                removed = keys.setdefault(name + (event["key"],), set())
+                if event.get("version_id"):
+                    removed.add(event["version_id"])
+
+        instances = {}
+        for (name, region), changed in buckets.items():
+            instances[name, region] = bucket = await aio.run(self.bucket_class, name, region)
+            await aio.run(self.target.prepare_bucket, bucket, changed)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def sync(name, region, key, removed):
+            async with semaphore:
+                bucket = instances[name, region]
+                obj = await aio.run(self.object_class, key, bucket, bucket.region)
+                await aio.run(self.target.sync_key, bucket, obj, removed)
+
+        await asyncio.gather(*(sync(name, region, key, removed) for (name, region, key), removed in keys.items()))
+
+        for (name, region), changed in buckets.items():
+            await aio.run(self.target.finish_bucket, instances[name, region], changed)
@@ -0,0 +1,1013 @@
+"""
+SelectObjectContent: a subset of S3 Select SQL over CSV and JSON objects.
+
+    SELECT * | expr [AS name], ... FROM S3Object[*] [alias] [WHERE expr] [LIMIT n]
+
+with comparisons, AND/OR/NOT, IS [NOT] NULL, [NOT] LIKE, [NOT] IN, [NOT]
+BETWEEN, arithmetic, CAST, a few string functions and COUNT/SUM/AVG/MIN/MAX
+without GROUP BY. The object is parsed one chunk at a time and expressions
+are evaluated a column at a time over every record of the chunk, so the
+interpreter dispatches once per chunk instead of once per record and row.
+Results are framed as an AWS event stream.
+"""
+
+import bz2
+import codecs
+import csv
+import io
+import json
+import operator
+import re
+import struct
+import zlib
+from collections import namedtuple
+from xml.parsers.expat import ExpatError
+
+import xmltodict
+
+from . import aio
+
+
+class SelectError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+SelectRequest = namedtuple("SelectRequest", ["query", "input_format", "input", "compression", "output_format",
+                                             "output", "progress"])
+Query = namedtuple("Query", ["items", "alias", "where", "limit"])
+
+
+# Event stream framing
+
+def _header(name, value):
+    name, value = name.encode(), value.encode()
+    return struct.pack("!B", len(name)) + name + struct.pack("!BH", 7, len(value)) + value
+
+
+def event_message(headers, payload=b""):
+    """One message of the application/vnd.amazon.eventstream format."""
+    headers = b"".join(_header(name, value) for name, value in headers)
+    prelude = struct.pack("!II", 16 + len(headers) + len(payload), len(headers))
+    message = prelude + struct.pack("!I", zlib.crc32(prelude)) + headers + payload
+    return message + struct.pack("!I", zlib.crc32(message))
+
+
+def records_event(payload):
+    return event_message([(":message-type", "event"), (":event-type", "Records"),
+                          (":content-type", "application/octet-stream")], payload)
+
+
+def stats_event(event_type, scanned, processed, returned):
+    payload = ("<{0}><BytesScanned>{1}</BytesScanned><BytesProcessed>{2}</BytesProcessed>"
+               "<BytesReturned>{3}</BytesReturned></{0}>").format(event_type, scanned, processed, returned)
+    return event_message([(":message-type", "event"), (":event-type", event_type),
+                          (":content-type", "text/xml")], payload.encode())
+
+
+def end_event():
+    return event_message([(":message-type", "event"), (":event-type", "End")])
+
+
+def error_event(code, message):
+    return event_message([(":message-type", "error"), (":error-code", code), (":error-message", message)])
+
+
+# SQL parsing
+
+_TOKEN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<quoted>"(?:[^"]|"")*")
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op><=|>=|<>|!=|\|\||[-+*/%=<>(),.\[\]])
+""", re.X)
+
+_CLAUSES = {"FROM", "WHERE", "LIMIT", "AS"}
+_COMPARISONS = {"=", "!=", "<>", "<", "<=", ">", ">="}
+_AGGREGATES = {"COUNT", "SUM", "AVG", "MIN", "MAX"}
+_FUNCTIONS = {"LOWER", "UPPER", "TRIM", "CHAR_LENGTH", "CHARACTER_LENGTH", "COALESCE"}
+_CASTS = {"INT": "int", "INTEGER": "int", "BIGINT": "int", "FLOAT": "float", "DOUBLE": "float", "REAL": "float",
+          "DECIMAL": "float", "NUMERIC": "float", "STRING": "str", "VARCHAR": "str", "CHAR": "str",
+          "BOOL": "bool", "BOOLEAN": "bool"}
+
+
+def tokenize(text):
+    tokens, pos = [], 0
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if not match:
+            raise SelectError("ParseInvalidTokenError", "Invalid token at position {}".format(pos))
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group()
+        if kind == "string":
+            value = value[1:-1].replace("''", "'")
+        elif kind == "quoted":
+            value = value[1:-1].replace('""', '"')
+        if kind != "space":
+            tokens.append((kind, value))
+    tokens.append(("end", None))
+    return tokens
+
+
+class Parser:
+    """Recursive descent parser producing a Query of nested tuples."""
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def keyword(self, *words):
+        kind, value = self.peek()
+        if kind == "name" and value.upper() in words:
+            self.pos += 1
+            return value.upper()
+        return None
+
+    def op(self, *ops):
+        kind, value = self.peek()
+        if kind == "op" and value in ops:
+            self.pos += 1
+            return value
+        return None
+
+    def unexpected(self):
+        kind, value = self.peek()
+        if kind == "end":
+            return SelectError("ParseUnexpectedTerm", "Unexpected end of expression")
+        return SelectError("ParseUnexpectedToken", "Unexpected token {!r}".format(value))
+
+    def expect_keyword(self, word):
+        if not self.keyword(word):
+            raise self.unexpected()
+
+    def expect_op(self, op):
+        if not self.op(op):
+            raise self.unexpected()
+
+    def name(self):
+        kind, value = self.peek()
+        if kind == "quoted" or (kind == "name" and value.upper() not in _CLAUSES):
+            self.pos += 1
+            return value
+        raise self.unexpected()
+
+    def query(self):
+        self.expect_keyword("SELECT")
+        items = None if self.op("*") else self.select_list()
+        self.expect_keyword("FROM")
+        if self.name().upper() != "S3OBJECT":
+            raise SelectError("ParseUnsupportedSyntax", "Only FROM S3Object is supported")
+        if self.op("["):
+            self.expect_op("*")
+            self.expect_op("]")
+        alias = None
+        if self.keyword("AS") or self.peek()[0] == "quoted" or (self.peek()[0] == "name" and self.peek()[1].upper() not in _CLAUSES):
+            alias = self.name()
+        where = self.expr() if self.keyword("WHERE") else None
+        limit = None
+        if self.keyword("LIMIT"):
+            kind, value = self.next()
+            if kind != "number" or not value.isdigit():
+                raise SelectError("ParseUnexpectedToken", "LIMIT takes a non negative integer")
+            limit = int(value)
+        if self.peek()[0] != "end":
+            raise self.unexpected()
+        return Query(items, alias, where, limit)
+
+    def select_list(self):
+        items = []
+        while True:
+            expr = self.expr()
+            name = None
+            if self.keyword("AS") or self.peek()[0] == "quoted":
+                name = self.name()
+            elif self.peek()[0] == "name" and self.peek()[1].upper() not in _CLAUSES:
+                name = self.name()
+            if name is None:
+                name = expr[1][-1] if expr[0] == "col" else "_{}".format(len(items) + 1)
+            items.append((name, expr))
+            if not self.op(","):
+                return items
+
+    def expr(self):
+        node = self.conjunction()
+        while self.keyword("OR"):
+            node = ("or", node, self.conjunction())
+        return node
+
+    def conjunction(self):
+        node = self.negation()
+        while self.keyword("AND"):
+            node = ("and", node, self.negation())
+        return node
+
+    def negation(self):
+        if self.keyword("NOT"):
+            return ("not", self.negation())
+        return self.predicate()
+
+    def predicate(self):
+        node = self.additive()
+        op = self.op(*_COMPARISONS)
+        if op:
+            return ("cmp", op, node, self.additive())
+        if self.keyword("IS"):
+            negate = bool(self.keyword("NOT"))
+            self.expect_keyword("NULL")
+            return ("isnull", node, negate)
+        negate = bool(self.keyword("NOT"))
+        if self.keyword("LIKE"):
+            kind, pattern = self.next()
+            if kind != "string":
+                raise SelectError("ParseUnsupportedSyntax", "LIKE needs a string pattern")
+            return ("like", node, pattern, negate)
+        if self.keyword("IN"):
+            self.expect_op("(")
+            values = [self.additive()]
+            while self.op(","):
+                values.append(self.additive())
+            self.expect_op(")")
+            return ("in", node, values, negate)
+        if self.keyword("BETWEEN"):
+            low = self.additive()
+            self.expect_keyword("AND")
+            return ("between", node, low, self.additive(), negate)
+        if negate:
+            raise self.unexpected()
+        return node
+
+    def additive(self):
+        node = self.multiplicative()
+        while True:
+            op = self.op("+", "-", "||")
+            if not op:
+                return node
+            node = ("arith", op, node, self.multiplicative())
+
+    def multiplicative(self):
+        node = self.unary()
+        while True:
+            op = self.op("*", "/", "%")
+            if not op:
+                return node
+            node = ("arith", op, node, self.unary())
+
+    def unary(self):
+        if self.op("-"):
+            return ("arith", "-", ("lit", 0), self.unary())
+        return self.primary()
+
+    def primary(self):
+        kind, value = self.peek()
+        if kind == "number":
+            self.pos += 1
+            return ("lit", float(value) if any(i in value for i in ".eE") else int(value))
+        if kind == "string":
+            self.pos += 1
+            return ("lit", value)
+        if self.op("("):
+            node = self.expr()
+            self.expect_op(")")
+            return node
+        if kind == "name":
+            word = value.upper()
+            if word in ("TRUE", "FALSE"):
+                self.pos += 1
+                return ("lit", word == "TRUE")
+            if word == "NULL":
+                self.pos += 1
+                return ("lit", None)
+            if self.tokens[self.pos + 1] == ("op", "("):
+                self.pos += 2
+                return self.call(word)
+        path = [self.name()]
+        while self.op("."):
+            path.append(self.name())
+        return ("col", path)
+
+    def call(self, word):
+        if word == "CAST":
+            node = self.expr()
+            self.expect_keyword("AS")
+            kind, target = self.next()
+            if kind != "name" or target.upper() not in _CASTS:
+                raise SelectError("ParseUnsupportedSyntax", "Unsupported CAST type {!r}".format(target))
+            self.expect_op(")")
+            return ("cast", node, _CASTS[target.upper()])
+        if word in _AGGREGATES:
+            arg = None if word == "COUNT" and self.op("*") else self.expr()
+            self.expect_op(")")
+            return ("agg", word, arg)
+        if word not in _FUNCTIONS:
+            raise SelectError("ParseUnsupportedSyntax", "Unsupported function {}".format(word))
+        args = [self.expr()]
+        while self.op(","):
+            args.append(self.expr())
+        self.expect_op(")")
+        return ("func", word, args)
+
+
+def parse_sql(text):
+    query = Parser(text).query()
+    aggregates = [expr[0] == "agg" for name, expr in query.items or []]
+    if any(aggregates) and not all(aggregates):
+        raise SelectError("ParseUnsupportedSyntax", "Aggregates can not be mixed with columns without GROUP BY")
+    return query
+
+
+# Vectorized evaluation: every compiled node maps a batch of records to the
+# list of its values for those records.
+
+class Batch:
+    __slots__ = ("records", "columns")
+
+    def __init__(self, records):
+        self.records = records
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def column(self, key, extract):
+        values = self.columns.get(key)
+        if values is None:
+            values = self.columns[key] = extract(self.records)
+        return values
+
+    def subset(self, positions):
+        return Batch([self.records[i] for i in positions])
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+def _coerce(a, b):
+    """Bring two values of different types to a comparable pair, (None, None) if they are not."""
+    if isinstance(a, str) and not isinstance(b, str):
+        b, a = _coerce(b, a)
+        return a, b
+    if isinstance(a, bool) or isinstance(b, bool):
+        if isinstance(b, str) and b.lower() in ("true", "false"):
+            return a, b.lower() == "true"
+        return (a, b) if isinstance(a, bool) and isinstance(b, bool) else (None, None)
+    if isinstance(a, (int, float)):
+        b = _number(b)
+        return (a, b) if b is not None else (None, None)
+    return None, None
+
+
+def _compare(fn, a, b):
+    if a is None or b is None:
+        return None
+    if type(a) is not type(b):
+        a, b = _coerce(a, b)
+        if a is None:
+            return None
+    try:
+        return fn(a, b)
+    except TypeError:
+        return None
+
+
+def _truth(value):
+    return value if isinstance(value, bool) else None
+
+
+def _and(a, b):
+    a, b = _truth(a), _truth(b)
+    if a is False or b is False:
+        return False
+    return None if a is None or b is None else True
+
+
+def _or(a, b):
+    a, b = _truth(a), _truth(b)
+    if a is True or b is True:
+        return True
+    return None if a is None or b is None else False
+
+
+def _cast(value, target):
+    if value is None:
+        return None
+    try:
+        if target == "str":
+            return json.dumps(value) if isinstance(value, (dict, list)) else ("true" if value is True else "false" if value is False else str(value))
+        if target == "bool":
+            if isinstance(value, bool):
+                return value
+            if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+                return value.strip().lower() == "true"
+            raise ValueError(value)
+        number = _number(value.strip() if isinstance(value, str) else value)
+        if number is None:
+            raise ValueError(value)
+        return int(number) if target == "int" else float(number)
+    except (ValueError, OverflowError):
+        raise SelectError("CastFailed", "Attempt to convert from one data type to another failed: {!r}".format(value))
+
+
+def _arith(op, a, b):
+    if a is None or b is None:
+        return None
+    if op == "||":
+        return "{}{}".format(a, b) if isinstance(a, str) and isinstance(b, str) else None
+    a, b = _number(a), _number(b)
+    if a is None or b is None:
+        return None
+    try:
+        return _ARITHMETIC[op](a, b)
+    except ZeroDivisionError:
+        raise SelectError("DivisionByZero", "Division by zero")
+
+
+_COMPARE = {"=": operator.eq, "!=": operator.ne, "<>": operator.ne, "<": operator.lt, "<=": operator.le,
+            ">": operator.gt, ">=": operator.ge}
+_ARITHMETIC = {"+": operator.add, "-": operator.sub, "*": operator.mul, "/": operator.truediv, "%": operator.mod}
+
+
+def _like_pattern(pattern):
+    parts = ["." if i == "_" else ".*" if i == "%" else re.escape(i) for i in pattern]
+    return re.compile("".join(parts), re.S)
+
+
+class Compiler:
+    """Turns query nodes into batch functions, resolving columns against the input format."""
+
+    def __init__(self, alias, resolve):
+        self.alias = alias
+        self.resolve = resolve
+
+    def column_path(self, path):
+        if len(path) > 1 and path[0].lower() == (self.alias or "s3object").lower():
+            path = path[1:]
+        return tuple(path)
+
+    def compile(self, node):
+        return getattr(self, "_" + node[0])(*node[1:])
+
+    def _lit(self, value):
+        return lambda batch: [value] * len(batch)
+
+    def _col(self, path):
+        path = self.column_path(path)
+        extract = self.resolve(path)
+        return lambda batch: batch.column(path, extract)
+
+    def _cmp(self, op, left, right):
+        fn = _COMPARE[op]
+        if right[0] == "lit" and right[1] is not None:
+            # Column against a constant, the common case.
+            left, value, kind = self.compile(left), right[1], type(right[1])
+            return lambda batch: [fn(a, value) if type(a) is kind else _compare(fn, a, value) for a in left(batch)]
+        left, right = self.compile(left), self.compile(right)
+
+        def evaluate(batch):
+            return [fn(a, b) if a is not None and type(a) is type(b) else _compare(fn, a, b)
+                    for a, b in zip(left(batch), right(batch))]
+        return evaluate
+
+    def _and(self, left, right):
+        left, right = self.compile(left), self.compile(right)
+
+        def evaluate(batch):
+            lefts = left(batch)
+            # Only evaluate the right side for the records still in the running.
+            positions = [i for i, v in enumerate(lefts) if v is not False]
+            if len(positions) == len(lefts):
+                rights = right(batch)
+            else:
+                rights = [False] * len(lefts)
+                for i, v in zip(positions, right(batch.subset(positions)) if positions else []):
+                    rights[i] = v
+            return [True if a is True and b is True else False if a is False or b is False else None
+                    for a, b in zip(lefts, rights)]
+        return evaluate
+
+    def _or(self, left, right):
+        left, right = self.compile(left), self.compile(right)
+        return lambda batch: [_or(a, b) for a, b in zip(left(batch), right(batch))]
+
+    def _not(self, node):
+        node = self.compile(node)
+        return lambda batch: [None if v is None else not v if isinstance(v, bool) else None for v in node(batch)]
+
+    def _isnull(self, node, negate):
+        node = self.compile(node)
+        return lambda batch: [(v is None) != negate for v in node(batch)]
+
+    def _like(self, node, pattern, negate):
+        node, pattern = self.compile(node), _like_pattern(pattern)
+        return lambda batch: [None if v is None else (pattern.fullmatch(str(v)) is not None) != negate for v in node(batch)]
+
+    def _in(self, node, values, negate):
+        node, values = self.compile(node), [self.compile(i) for i in values]
+
+        def evaluate(batch):
+            options = list(zip(*[i(batch) for i in values]))
+            return [None if v is None else any(_compare(operator.eq, v, i) for i in row) != negate
+                    for v, row in zip(node(batch), options)]
+        return evaluate
+
+    def _between(self, node, low, high, negate):
+        node, low, high = self.compile(node), self.compile(low), self.compile(high)
+
+        def evaluate(batch):
+            result = [_and(_compare(operator.ge, v, a), _compare(operator.le, v, b))
+                      for v, a, b in zip(node(batch), low(batch), high(batch))]
+            return [None if v is None else v != negate for v in result] if negate else result
+        return evaluate
+
+    def _arith(self, op, left, right):
+        left, right = self.compile(left), self.compile(right)
+        return lambda batch: [_arith(op, a, b) for a, b in zip(left(batch), right(batch))]
+
+    def _cast(self, node, target):
+        node = self.compile(node)
+        convert = {"int": int, "float": float}.get(target)
+
+        def evaluate(batch):
+            values = node(batch)
+            if convert is not None:
+                try:
+                    return [convert(v) for v in values]
+                except (TypeError, ValueError):
+                    pass
+            return [_cast(v, target) for v in values]
+        return evaluate
+
+    def _func(self, name, args):
+        args = [self.compile(i) for i in args]
+        if name == "COALESCE":
+            return lambda batch: [next((v for v in row if v is not None), None) for row in zip(*[i(batch) for i in args])]
+        if len(args) != 1:
+            raise SelectError("IncorrectSqlFunctionArgumentType", "{} takes one argument".format(name))
+        fn = {"LOWER": str.lower, "UPPER": str.upper, "TRIM": str.strip, "CHAR_LENGTH": len, "CHARACTER_LENGTH": len}[name]
+        arg = args[0]
+        return lambda batch: [fn(v) if isinstance(v, str) else None for v in arg(batch)]
+
+    def _agg(self, name, arg):
+        raise SelectError("ParseUnsupportedSyntax", "Aggregates are only allowed in the SELECT list")
+
+
+class Aggregate:
+    def __init__(self, name, arg):
+        self.name = name
+        self.arg = arg
+        self.count = 0
+        self.value = None
+
+    def update(self, batch):
+        if self.arg is None:
+            self.count += len(batch)
+            return
+        values = [v for v in self.arg(batch) if v is not None]
+        if self.name == "COUNT":
+            self.count += len(values)
+            return
+        # CSV fields are strings, aggregate whatever reads as a number.
+        numbers = [v for v in map(_number, values) if v is not None]
+        if not numbers:
+            return
+        self.count += len(numbers)
+        if self.name in ("SUM", "AVG"):
+            self.value = sum(numbers, self.value or 0)
+        else:
+            best = (min if self.name == "MIN" else max)(numbers)
+            self.value = best if self.value is None else (min if self.name == "MIN" else max)(self.value, best)
+
+    def result(self):
+        if self.name == "COUNT":
+            return self.count
+        if self.name == "AVG":
+            return self.value / self.count if self.count else None
+        return self.value
+
+
+# Input and output formats
+
+def _option(options, name, default):
+    value = (options or {}).get(name)
+    return default if value is None else value
+
+
+class CsvInput:
+    def __init__(self, options):
+        self.header_info = _option(options, "FileHeaderInfo", "NONE").strip().upper()
+        self.delimiter = _option(options, "FieldDelimiter", ",")
+        self.quote = _option(options, "QuoteCharacter", '"')
+        self.escape = _option(options, "QuoteEscapeCharacter", '"')
+        self.comments = _option(options, "Comments", None)
+        if _option(options, "RecordDelimiter", "\n") not in ("\n", "\r\n"):
+            raise SelectError("UnsupportedRecordDelimiter", "Only newline record delimiters are supported")
+        self.header = None
+        # Text after the last complete record, kept as chunks so a record
+        # spanning many of them is joined once.
+        self.pending = []
+        # Whether the end of pending is inside a quoted field.
+        self.quoted = False
+
+    def _cut(self, text):
+        # Offset in text after its last newline outside of a quoted field, 0
+        # if there is none. The quote parity of pending is carried over, so
+        # every character is looked at once.
+        quoted = self.quoted ^ bool(text.count(self.quote) % 2)
+        self.quoted, end = quoted, len(text)
+        cut = text.rfind("\n")
+        while cut >= 0:
+            quoted ^= bool(text.count(self.quote, cut, end) % 2)
+            if not quoted:
+                return cut + 1
+            end = cut
+            cut = text.rfind("\n", 0, cut)
+        return 0
+
+    def records(self, text, final=False):
+        cut = len(text) if final else self._cut(text)
+        if not cut and not final:
+            self.pending.append(text)
+            return []
+        self.pending.append(text[:cut])
+        text, self.pending = "".join(self.pending), [text[cut:]]
+        reader = csv.reader(io.StringIO(text), delimiter=self.delimiter, quotechar=self.quote,
+                            doublequote=self.escape == self.quote,
+                            escapechar=None if self.escape == self.quote else self.escape)
+        try:
+            rows = [i for i in reader if i]
+            if self.comments:
+                rows = [i for i in rows if not i[0].startswith(self.comments)]
+        except csv.Error as error:
+            raise SelectError("CSVParsingError", str(error))
+        if rows and self.header is None and self.header_info in ("USE", "IGNORE"):
+            self.header = rows.pop(0)
+        return rows
+
+    def resolver(self):
+        names = {}
+        for position, name in enumerate((self.header or []) if self.header_info == "USE" else []):
+            names.setdefault(name, position)
+            names.setdefault(name.lower(), position)
+
+        def resolve(path):
+            if len(path) != 1:
+                raise SelectError("InvalidColumnIndex", "CSV columns can not have a path: {}".format(".".join(path)))
+            name = path[0]
+            if name in names or name.lower() in names:
+                index = names.get(name, names.get(name.lower()))
+            elif re.match(r"^_\d+$", name) and int(name[1:]) > 0:
+                index = int(name[1:]) - 1
+            else:
+                raise SelectError("InvalidColumnIndex", "Unknown column {}".format(name))
+
+            def extract(rows):
+                try:
+                    return [row[index] for row in rows]
+                except IndexError:
+                    return [row[index] if index < len(row) else None for row in rows]
+            return extract
+        return resolve
+
+    def field_names(self, count):
+        if self.header_info == "USE" and self.header:
+            return self.header[:count] + ["_{}".format(i + 1) for i in range(len(self.header), count)]
+        return ["_{}".format(i + 1) for i in range(count)]
+
+    def values(self, record):
+        return record
+
+    def as_dict(self, record):
+        return dict(zip(self.field_names(len(record)), record))
+
+
+_JSON_BRACKET = re.compile(r'[\[\]{}"]')
+_JSON_STRING_END = re.compile(r'["\\]')
+
+
+class JsonInput:
+    def __init__(self, options):
+        self.type = _option(options, "Type", "DOCUMENT").strip().upper()
+        self.decoder = json.JSONDecoder()
+        # Text after the last complete record, kept as chunks so a document
+        # spanning many of them is joined and decoded once.
+        self.pending = []
+        # Bracket scan state at the end of pending.
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def _scan(self, text):
+        # Advance the bracket scan over text, True when every document may
+        # be complete at its end.
+        pos, depth, in_string = 0, self.depth, self.in_string
+        if self.escaped and text:
+            pos, self.escaped = 1, False
+        while True:
+            match = (_JSON_STRING_END if in_string else _JSON_BRACKET).search(text, pos)
+            if not match:
+                break
+            char, pos = match.group(), match.end()
+            if char == "\\":
+                if pos == len(text):
+                    self.escaped = True
+                    break
+                pos += 1
+            elif char == '"':
+                in_string = not in_string
+            elif char in "[{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth < 0:
+                    raise ValueError("Unexpected '{}'".format(char))
+        self.depth, self.in_string = depth, in_string
+        return depth == 0 and not in_string and not self.escaped
+
+    def records(self, text, final=False):
+        try:
+            if self.type == "LINES":
+                cut = len(text) if final else text.rfind("\n") + 1
+                if not cut and not final:
+                    self.pending.append(text)
+                    return []
+                self.pending.append(text[:cut])
+                text, self.pending = "".join(self.pending), [text[cut:]]
+                return [json.loads(i) for i in text.split("\n") if i.strip()]
+            self.pending.append(text)
+            if not self._scan(text) and not final:
+                return []
+            text = "".join(self.pending)
+            records, pos = [], 0
+            while True:
+                while pos < len(text) and text[pos].isspace():
+                    pos += 1
+                if pos == len(text):
+                    break
+                try:
+                    value, end = self.decoder.raw_decode(text, pos)
+                except ValueError:
+                    if final:
+                        raise
+                    break
+                if end == len(text) and not final:
+                    # A number could go on in the next chunk.
+                    break
+                pos = end
+                records.extend(value if isinstance(value, list) else [value])
+            # What is left holds no open bracket or string, the scan state
+            # is unchanged.
+            self.pending = [text[pos:]]
+            return records
+        except ValueError as error:
+            raise SelectError("JSONParsingError", str(error))
+
+    def resolver(self):
+        def resolve(path):
+            def get(record):
+                for name in path:
+                    if not isinstance(record, dict):
+                        return None
+                    record = record.get(name)
+                return record
+            if len(path) == 1:
+                name = path[0]
+                return lambda records: [i.get(name) if type(i) is dict else None for i in records]
+            return lambda records: [get(i) for i in records]
+        return resolve
+
+    def values(self, record):
+        return list(record.values()) if isinstance(record, dict) else [record]
+
+    def as_dict(self, record):
+        return record if isinstance(record, dict) else {"_1": record}
+
+
+def _text(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+class CsvOutput:
+    def __init__(self, options):
+        self.options = dict(delimiter=_option(options, "FieldDelimiter", ","), quotechar=_option(options, "QuoteCharacter", '"'),
+                            lineterminator=_option(options, "RecordDelimiter", "\n"))
+        escape = _option(options, "QuoteEscapeCharacter", self.options["quotechar"])
+        if escape != self.options["quotechar"]:
+            self.options.update(escapechar=escape, doublequote=False)
+        always = _option(options, "QuoteFields", "ASNEEDED").strip().upper() == "ALWAYS"
+        self.options["quoting"] = csv.QUOTE_ALL if always else csv.QUOTE_MINIMAL
+
+    def write(self, names, rows, plain=False):
+        """plain rows only hold strings and None, as read from CSV."""
+        buffer = io.StringIO()
+        csv.writer(buffer, **self.options).writerows(rows if plain else ([_text(v) for v in row] for row in rows))
+        return buffer.getvalue()
+
+
+class JsonOutput:
+    def __init__(self, options):
+        self.delimiter = _option(options, "RecordDelimiter", "\n")
+
+    def write(self, names, rows, plain=False):
+        if names is None:
+            return "".join(json.dumps(row) + self.delimiter for row in rows)
+        return "".join(json.dumps(dict(zip(names, row))) + self.delimiter for row in rows)
+
+
+# Request handling
+
+def _section(data, name):
+    section = data.get(name)
+    if not isinstance(section, dict):
+        raise SelectError("MissingRequiredParameter", "{} is required".format(name))
+    return section
+
+
+def _format(section, formats, name):
+    found = [i for i in formats if i in section]
+    if len(found) != 1:
+        raise SelectError("InvalidRequestParameter", "{} must name exactly one of {}".format(name, ", ".join(formats)))
+    return found[0], section[found[0]] or {}
+
+
+def parse_request(body):
+    """Parse a SelectObjectContentRequest document, raising SelectError when it is not supported."""
+    try:
+        # Record delimiters are whitespace, keep it.
+        data = xmltodict.parse(body, strip_whitespace=False)["SelectObjectContentRequest"]
+    except (ExpatError, KeyError, TypeError):
+        raise SelectError("MalformedXML", "The XML you provided was not well-formed or did not validate against our published schema.")
+    if (data.get("ExpressionType") or "SQL").strip().upper() != "SQL":
+        raise SelectError("InvalidExpressionType", "The ExpressionType is invalid. Only SQL expressions are supported.")
+    if not (data.get("Expression") or "").strip():
+        raise SelectError("MissingRequiredParameter", "Expression is required")
+    if data.get("ScanRange"):
+        raise SelectError("UnsupportedScanRangeInput", "ScanRange is not supported")
+    input_section, output_section = _section(data, "InputSerialization"), _section(data, "OutputSerialization")
+    input_format, input_options = _format(input_section, ["CSV", "JSON"], "InputSerialization")
+    output_format, output_options = _format(output_section, ["CSV", "JSON"], "OutputSerialization")
+    compression = (input_section.get("CompressionType") or "NONE").strip().upper()
+    if compression not in ("NONE", "GZIP", "BZIP2"):
+        raise SelectError("InvalidCompressionFormat", "Unsupported CompressionType {}".format(compression))
+    progress = ((data.get("RequestProgress") or {}).get("Enabled") or "").strip().lower() == "true"
+    return SelectRequest(parse_sql(data["Expression"].strip()), input_format, input_options, compression,
+                         output_format, output_options, progress)
+
+
+def _decompressor(compression):
+    return bz2.BZ2Decompressor() if compression == "BZIP2" else zlib.decompressobj(31)
+
+
+class Selector:
+    """
+    Runs one SelectRequest over the chunks of an object. feed and finish
+    return the event stream messages to send for the data seen so far.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.query = request.query
+        self.input = (CsvInput if request.input_format == "CSV" else JsonInput)(request.input)
+        self.output = (CsvOutput if request.output_format == "CSV" else JsonOutput)(request.output)
+        self.decompressor = _decompressor(request.compression) if request.compression != "NONE" else None
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.compiled = False
+        self.aggregates = []
+        self.has_aggregates = any(expr[0] == "agg" for name, expr in self.query.items or [])
+        self.remaining = self.query.limit
+        self.scanned = self.processed = self.returned = 0
+
+    @property
+    def done(self):
+        return self.remaining == 0 and not self.has_aggregates
+
+    def _compile(self):
+        compiler = Compiler(self.query.alias, self.input.resolver())
+        self.where = compiler.compile(self.query.where) if self.query.where else None
+        items = self.query.items or []
+        self.aggregates = [Aggregate(expr[1], compiler.compile(expr[2]) if expr[2] else None)
+                           for name, expr in items if expr[0] == "agg"]
+        self.projection = None if self.aggregates or not items else [compiler.compile(expr) for name, expr in items]
+        self.names = [name for name, expr in items]
+        self.compiled = True
+
+    def _inflate(self, data):
+        if self.decompressor is None:
+            return data
+        out = []
+        try:
+            while data:
+                out.append(self.decompressor.decompress(data))
+                if not self.decompressor.eof:
+                    break
+                # Concatenated gzip members.
+                data = self.decompressor.unused_data
+                self.decompressor = _decompressor(self.request.compression)
+        except (zlib.error, OSError, EOFError) as error:
+            raise SelectError("InvalidCompressionFormat", str(error))
+        return b"".join(out)
+
+    def _evaluate(self, records):
+        if not records:
+            return b""
+        if not self.compiled:
+            self._compile()
+        batch = Batch(records)
+        if self.where is not None:
+            records = [r for r, keep in zip(records, self.where(batch)) if keep is True]
+            batch = Batch(records)
+        if self.aggregates:
+            for aggregate in self.aggregates:
+                aggregate.update(batch)
+            return b""
+        if self.remaining is not None:
+            records = records[:self.remaining]
+            batch = Batch(records) if len(records) < len(batch) else batch
+            self.remaining -= len(records)
+        if not records:
+            return b""
+        if self.projection is not None:
+            rows = zip(*[fn(batch) for fn in self.projection])
+            return self.output.write(self.names, rows).encode()
+        if isinstance(self.output, JsonOutput):
+            return self.output.write(None, [self.input.as_dict(r) for r in records]).encode()
+        if isinstance(self.input, CsvInput):
+            return self.output.write(None, records, plain=True).encode()
+        return self.output.write(None, [self.input.values(r) for r in records]).encode()
+
+    def _messages(self, payload):
+        messages = []
+        if payload:
+            self.returned += len(payload)
+            messages.append(records_event(payload))
+        if self.request.progress:
+            messages.append(stats_event("Progress", self.scanned, self.processed, self.returned))
+        return messages
+
+    def feed(self, data):
+        if self.done:
+            return []
+        self.scanned += len(data)
+        data = self._inflate(data)
+        self.processed += len(data)
+        return self._messages(self._evaluate(self.input.records(self.decoder.decode(data))))
+
+    def finish(self):
+        payload = b""
+        if not self.done:
+            payload = self._evaluate(self.input.records(self.decoder.decode(b"", final=True), final=True))
+        if self.has_aggregates:
+            if not self.compiled:
+                self._compile()
+            payload = self.output.write(self.names, [[i.result() for i in self.aggregates]]).encode()
+        messages = self._messages(payload) if payload else []
+        messages.append(stats_event("Stats", self.scanned, self.processed, self.returned))
+        messages.append(end_event())
+        return messages
+
+
+async def stream(request, chunks):
+    """Event stream of the results of request over an async iterator of object chunks."""
+    selector = Selector(request)
+    try:
+        async for chunk in chunks:
+            for message in await aio.run(selector.feed, chunk):
+                yield message
+            if selector.done:
+                break
+        for message in await aio.run(selector.finish):
+            yield message
+    except SelectError as error:
+        # Headers are gone already, errors past this point are events.
+        yield error_event(error.code, str(error))
+    finally:
+        await chunks.aclose()
@@ -0,0 +1,149 @@
+import time
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+from .settings import settings
+
+
+XML_HEADER = '<?xml version="1.0" encoding="utf-8"?>\n'
+XMLNS = "http://s3.amazonaws.com/doc/2006-03-01"
+
+OWNER = "<Owner><ID>{}</ID><DisplayName>{}</DisplayName></Owner>".format(escape(settings.owner_id), escape(settings.name))
+
+ERROR = XML_HEADER + "<Error><Code>{code}</Code><Message>{message}</Message>{extra}</Error>"
+INITIATE_MULTIPART = (XML_HEADER + '<InitiateMultipartUploadResult xmlns="' + XMLNS + '">'
+                      "<Bucket>{bucket}</Bucket><Key>{key}</Key><UploadId>{upload_id}</UploadId>"
+                      "</InitiateMultipartUploadResult>")
+COMPLETE_MULTIPART = (XML_HEADER + '<CompleteMultipartUploadResult xmlns="' + XMLNS + '">'
+                      "<Location>{location}</Location><Bucket>{bucket}</Bucket><Key>{key}</Key><ETag>&quot;{etag}&quot;</ETag>"
+                      "</CompleteMultipartUploadResult>")
+
+CONTENTS = ("<Contents><Key>{}</Key><LastModified>{}</LastModified><ETag>&quot;{}&quot;</ETag>"
+            "<Size>{}</Size><StorageClass>STANDARD</StorageClass>" + OWNER + "</Contents>")
+CONTENTS_V2 = ("<Contents><Key>{}</Key><LastModified>{}</LastModified><ETag>&quot;{}&quot;</ETag>"
+               "<Size>{}</Size><StorageClass>STANDARD</StorageClass></Contents>")
+VERSION = ("<Version><Key>{}</Key><VersionId>{}</VersionId><IsLatest>{}</IsLatest><LastModified>{}</LastModified>"
+           "<ETag>&quot;{}&quot;</ETag><Size>{}</Size><StorageClass>STANDARD</StorageClass>" + OWNER + "</Version>")
+DELETE_MARKER = ("<DeleteMarker><Key>{}</Key><VersionId>{}</VersionId><IsLatest>{}</IsLatest>"
+                 "<LastModified>{}</LastModified>" + OWNER + "</DeleteMarker>")
+COMMON_PREFIX = "<CommonPrefixes><Prefix>{}</Prefix></CommonPrefixes>"
+
+
+def text(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return escape(str(value))
+
+
+def timestamp(mtime):
+    return time.strftime(settings.date_fmt, time.gmtime(mtime))
+
+
+def _append(parts, name, value, attrs=""):
+    if isinstance(value, list):
+        for item in value:
+            _append(parts, name, item)
+    elif isinstance(value, dict):
+        parts.append("<{}{}>".format(name, attrs))
+        for key, item in value.items():
+            _append(parts, key, item)
+        parts.append("</{}>".format(name))
+    else:
+        parts.append("<{0}{1}>{2}</{0}>".format(name, attrs, text(value)))
+
+
+def to_xml(data, xmlns=False):
+    """
+    Serialize a single rooted dict the way xmltodict.unparse would: lists
+    repeat their element, None is an empty element and booleans are
+    lowercase. Used for the small, irregular responses.
+    """
+    (root, value), = data.items()
+    parts = [XML_HEADER]
+    _append(parts, root, value, ' xmlns="{}"'.format(XMLNS) if xmlns else "")
+    return "".join(parts)
+
+
+def error(code, message, extra_args=None):
+    parts = []
+    for key, value in (extra_args or {}).items():
+        _append(parts, key, value)
+    return ERROR.format(code=text(code), message=text(message), extra="".join(parts))
+
+
+def _encoder(encoding_type):
+    if encoding_type == "url":
+        return lambda value: escape(quote(value, safe="/~"))
+    return escape
+
+
+def _fields(parts, fields):
+    for name, value in fields:
+        if value is not None:
+            parts.append("<{0}>{1}</{0}>".format(name, text(value)))
+
+
+def list_objects(name, page, encoding_type=None, prefix=None, marker=None, delimiter=None, max_keys=1000):
+    encode = _encoder(encoding_type)
+    parts = [XML_HEADER, '<ListBucketResult xmlns="{}">'.format(XMLNS)]
+    _fields(parts, [("Name", name), ("Prefix", prefix or ""), ("Marker", marker or ""), ("MaxKeys", max_keys),
+                    ("Delimiter", delimiter), ("EncodingType", encoding_type), ("IsTruncated", page.is_truncated)])
+    if page.is_truncated:
+        parts.append("<NextMarker>{}</NextMarker>".format(encode(page.next_marker)))
+    for i in page.entries:
+        parts.append(CONTENTS.format(encode(i.key), timestamp(i.mtime), i.etag, i.size))
+    for i in page.common_prefixes:
+        parts.append(COMMON_PREFIX.format(encode(i)))
+    parts.append("</ListBucketResult>")
+    return "".join(parts)
+
+
+def list_objects_v2(name, page, encoding_type=None, prefix=None, continuation_token=None, start_after=None,
+                    delimiter=None, max_keys=1000):
+    encode = _encoder(encoding_type)
+    parts = [XML_HEADER, '<ListBucketResult xmlns="{}">'.format(XMLNS)]
+    _fields(parts, [("Name", name), ("Prefix", prefix or ""), ("MaxKeys", max_keys), ("Delimiter", delimiter),
+                    ("EncodingType", encoding_type), ("ContinuationToken", continuation_token),
+                    ("StartAfter", start_after), ("KeyCount", len(page.entries) + len(page.common_prefixes)),
+                    ("IsTruncated", page.is_truncated)])
+    if page.is_truncated:
+        parts.append("<NextContinuationToken>{}</NextContinuationToken>".format(escape(page.next_marker)))
+    for i in page.entries:
+        parts.append(CONTENTS_V2.format(encode(i.key), timestamp(i.mtime), i.etag, i.size))
+    for i in page.common_prefixes:
+        parts.append(COMMON_PREFIX.format(encode(i)))
+    parts.append("</ListBucketResult>")
+    return "".join(parts)
+
+
+def list_object_versions(name, page, encoding_type=None, prefix=None, key_marker=None, version_id_marker=None,
+                         delimiter=None, max_keys=1000):
+    encode = _encoder(encoding_type)
+    parts = [XML_HEADER, '<ListVersionsResult xmlns="{}">'.format(XMLNS)]
+    _fields(parts, [("Name", name), ("Prefix", prefix or ""), ("KeyMarker", key_marker or ""),
+                    ("VersionIdMarker", version_id_marker or ""), ("MaxKeys", max_keys), ("Delimiter", delimiter),
+                    ("EncodingType", encoding_type), ("IsTruncated", page.is_truncated)])
+    if page.is_truncated:
+        parts.append("<NextKeyMarker>{}</NextKeyMarker>".format(encode(page.next_marker)))
+        if page.next_version_id_marker:
+            parts.append("<NextVersionIdMarker>{}</NextVersionIdMarker>".format(escape(page.next_version_id_marker)))
+    for i in page.entries:
+        latest = "true" if i.is_latest else "false"
+        if i.delete_marker:
+            parts.append(DELETE_MARKER.format(encode(i.key), escape(i.version_id), latest, timestamp(i.mtime)))
+        else:
+            parts.append(VERSION.format(encode(i.key), escape(i.version_id), latest, timestamp(i.mtime), i.etag, i.size))
+    for i in page.common_prefixes:
+        parts.append(COMMON_PREFIX.format(encode(i)))
+    parts.append("</ListVersionsResult>")
+    return "".join(parts)
+
+
+def initiate_multipart_upload(bucket, key, upload_id):
+    return INITIATE_MULTIPART.format(bucket=text(bucket), key=text(key), upload_id=text(upload_id))
+
+
+def complete_multipart_upload(location, bucket, key, etag):
+    return COMPLETE_MULTIPART.format(location=text(location), bucket=text(bucket), key=text(key), etag=text(etag))
@@ -15,6 +15,28 @@ class Settings(BaseSettings):
     ]
     validate_signature = False if os.getenv("VALIDATE_SIGNATURE", "true").lower() == "false" else True
     owner_id = "randomOwnerID"
+    lifecycle_interval = int(os.getenv("LIFECYCLE_INTERVAL", "3600"))
+    lifecycle_rate = float(os.getenv("LIFECYCLE_RATE", "100"))
+    lifecycle_batch_size = int(os.getenv("LIFECYCLE_BATCH_SIZE", "1000"))
+    io_threads = int(os.getenv("IO_THREADS", "32"))
+    admin_api = os.getenv("ADMIN_API", "false").lower() == "true"
+    replication_target = os.getenv("REPLICATION_TARGET", "")
+    replication_access_key = os.getenv("REPLICATION_ACCESS_KEY", os.getenv("AWS_ACCESS_KEY", "pseudoS3AccessKey"))
+    replication_secret_key = os.getenv("REPLICATION_SECRET_KEY", os.getenv("AWS_SECRET_KEY", "pseudoS3SecretKey"))
+    replication_interval = float(os.getenv("REPLICATION_INTERVAL", "1"))
+    replication_batch_size = int(os.getenv("REPLICATION_BATCH_SIZE", "1000"))
+    replication_concurrency = int(os.getenv("REPLICATION_CONCURRENCY", "4"))
+    replication_snapshot_interval = float(os.getenv("REPLICATION_SNAPSHOT_INTERVAL", "60"))
+    fsck_on_startup = os.getenv("FSCK_ON_STARTUP", "").lower()
+    fsck_jobs = int(os.getenv("FSCK_JOBS", "0"))
+    fsck_temp_age = int(os.getenv("FSCK_TEMP_AGE", "3600"))
+    fsck_upload_age = int(os.getenv("FSCK_UPLOAD_AGE", "604800"))
+    rate_limit_read = float(os.getenv("RATE_LIMIT_READ", "0"))
+    rate_limit_write = float(os.getenv("RATE_LIMIT_WRITE", "0"))
+    rate_limit_list = float(os.getenv("RATE_LIMIT_LIST", "0"))
+    rate_limit_burst = float(os.getenv("RATE_LIMIT_BURST", "2"))
+    expensive_concurrency = int(os.getenv("EXPENSIVE_CONCURRENCY", "8"))
+    expensive_queue_timeout = float(os.getenv("EXPENSIVE_QUEUE_TIMEOUT", "2"))
 
 
 settings = Settings()
@@ -0,0 +1,175 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+
+from starlette.datastructures import Headers
+from starlette.requests import Request
+
+from . import aws_responses as AWSResponse
+from .settings import settings
+
+
+# Bucket level subresources that read configuration rather than list keys.
+BUCKET_CONFIG = {"versioning", "lifecycle", "compression", "location", "acl", "policy", "cors", "tagging"}
+
+
+class Throttled(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Please reduce your request rate.")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """Take a token, returns 0 or the seconds until the next one."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+def classify(method, path, query):
+    """
+    Operation class of a request for rate limiting, and whether it is
+    expensive enough to count against the concurrency cap. None for requests
+    that are never throttled.
+    """
+    bucket, _, key = path.lstrip("/").partition("/")
+    if bucket.startswith("_admin"):
+        return None, False
+    if method in ("GET", "HEAD"):
+        if bucket and not key and method == "GET" and not BUCKET_CONFIG.intersection(query):
+            return "list", True
+        return "read", False
+    if method == "POST" and "select" in query:
+        return "read", True
+    if method == "POST" and ("uploadId" in query or "delete" in query):
+        # Completing a multipart upload and bulk deletes touch many files.
+        return "write", True
+    return "write", False
+
+
+def access_key(headers, query, client, authenticated):
+    """
+    Access key of a request whose signature was verified, the client address
+    for every other one. An unverified credential is only a claim, keying on
+    it would let a client spread its requests over made up access keys or
+    spend someone else's budget.
+    """
+    if authenticated:
+        authorization = headers.get("authorization", "")
+        if "Credential=" in authorization:
+            return authorization.split("Credential=", 1)[1].split("/", 1)[0]
+        if authorization.startswith("AWS "):
+            return authorization[4:].split(":", 1)[0]
+        credential = query.get("X-Amz-Credential") or query.get("AWSAccessKeyId")
+        if credential:
+            return credential.split("/", 1)[0]
+    return "anonymous:{}".format(client)
+
+
+class AdmissionControl:
+    """
+    Admission control applied by the middleware before a request reaches its
+    handler. Every access key gets a token bucket per operation class, so a
+    client looping over listings runs out of list tokens without touching
+    its own or anyone else's GET/PUT budget. Listings, selects, multipart
+    completes and bulk deletes also need one of a fixed number of slots,
+    waiting up to queue_timeout for one. Rejected requests get a SlowDown.
+    State is per worker process.
+    """
+
+    def __init__(self, rates=None, burst=None, concurrency=None, queue_timeout=None, max_clients=10000):
+        if rates is None:
+            rates = {"read": settings.rate_limit_read, "write": settings.rate_limit_write, "list": settings.rate_limit_list}
+        self.rates = rates
+        self.burst = settings.rate_limit_burst if burst is None else burst
+        concurrency = settings.expensive_concurrency if concurrency is None else concurrency
+        self.queue_timeout = settings.expensive_queue_timeout if queue_timeout is None else queue_timeout
+        self.slots = asyncio.Semaphore(concurrency) if concurrency > 0 else None
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.throttled = 0
+
+    def check_rate(self, client, operation, now=None):
+        """Seconds the client has to wait before doing operation, 0 if it may go ahead."""
+        rate = self.rates.get(operation, 0)
+        if rate <= 0:
+            return 0
+        now = time.monotonic() if now is None else now
+        key = (client, operation)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate, max(rate * self.burst, 1), now)
+            if len(self.buckets) > self.max_clients:
+                # A full bucket is what a new client starts with anyway.
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket.take(now)
+
+    async def acquire(self, client, operation, expensive=False):
+        """Admit a request, returns the callable releasing it or raises Throttled."""
+        if operation is None:
+            return _noop
+        wait = self.check_rate(client, operation)
+        if wait:
+            self.throttled += 1
+            raise Throttled(math.ceil(wait))
+        if not expensive or self.slots is None:
+            return _noop
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.throttled += 1
+            raise Throttled(1)
+        return self.slots.release
+
+
+def _noop():
+    pass
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware admitting requests through an AdmissionControl. It has
+    to sit inside the middleware that checks signatures, which leaves
+    whether the request is authenticated in the scope state. The slot of an
+    expensive request is released once the app returns, that is after the
+    last body chunk went through send, or when the response is abandoned
+    and the app is cancelled before its body is ever iterated.
+    """
+
+    def __init__(self, app, admission):
+        self.app = app
+        self.admission = admission
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        state = scope.get("state", {})
+        query = Request(scope).query_params
+        operation, expensive = classify(scope["method"], scope["path"], query)
+        client = scope["client"][0] if scope.get("client") else ""
+        client = access_key(Headers(scope=scope), query, client, state.get("authenticated", False))
+        try:
+            release = await self.admission.acquire(client, operation, expensive)
+        except Throttled as error:
+            await AWSResponse.slow_down(error.retry_after, state.get("request_id"))(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            release()
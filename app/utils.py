@@ -1,4 +1,5 @@
 import base64
+import functools
 import hashlib
 import hmac
 import random
@@ -35,13 +36,16 @@ def get_upload_id():
     return ''.join(random.choices(string.ascii_uppercase + string.ascii_lowercase + string.digits, k=57))
 
 
-def string_to_bytes(string):
-    return " ".join(["{:X}".format(ord(i)) for i in string])
+def is_upload_id(name):
+    return len(name) == 57 and name.isalnum()
 
 
-def prepare_sign_string(method, file_path, expiry):
-    string_to_sign = "{0}\n\n\n{1}\n{2}".format(method.upper(), expiry, file_path)
-    return string_to_sign
+def get_version_id():
+    return ''.join(random.choices(string.ascii_letters + string.digits + "._", k=32))
+
+
+def string_to_bytes(string):
+    return " ".join(["{:X}".format(ord(i)) for i in string])
 
 
 def get_signature(string_to_sign, secret_key, url_encoded=True):
@@ -53,6 +57,25 @@ def get_signature(string_to_sign, secret_key, url_encoded=True):
     return signature
 
 
+def parse_range(header, size):
+    """
+    Turn a "bytes=start-end" Range header into a [start, end) slice of an
+    object of the given size. Returns None if the range can't be satisfied.
+    """
+    try:
+        low, high = header.split("=", 1)[1].split(",")[0].strip().split("-")
+        if not low:
+            start, end = max(size - int(high), 0), size
+        else:
+            start = int(low)
+            end = min(int(high) + 1, size) if high else size
+    except ValueError:
+        return None
+    if start >= size or start >= end:
+        return None
+    return start, end
+
+
 def get_etag(data):
     if type(data) == str:
         data = data.encode("utf-8")
@@ -65,6 +88,15 @@ def _sign(key, msg, hex=False):
     else:
         return hash.digest()
 
+@functools.lru_cache(maxsize=1024)
+def get_signing_key(secret_key, date, region, service, request_type="aws4_request"):
+    # The key only changes once a day per credential scope, cache it instead
+    # of running four HMACs on every request.
+    k_date = _sign(f"AWS4{secret_key}".encode(), date)
+    k_region = _sign(k_date, region)
+    k_service = _sign(k_region, service)
+    return _sign(k_service, request_type)
+
 def canonical_query_string(request):
     query_params = []
     for key, value in request.query_params.items():
@@ -117,8 +149,5 @@ def get_sha256_signature(request, auth_header):
     secret = f"{timestamp}/{region}/{service}/{request_type}"
     string_to_sign = "\n".join(["AWS4-HMAC-SHA256", request.headers["x-amz-date"], secret, canonical])
     secret_key = get_secret_key(access_key)
-    k_date = _sign(f"AWS4{secret_key}".encode(), timestamp)   
-    k_region = _sign(k_date, region)
-    k_service = _sign(k_region, service)
-    k_signing = _sign(k_service, request_type)
+    k_signing = get_signing_key(secret_key, timestamp, region, service, request_type)
     return _sign(k_signing, string_to_sign, hex=True)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Compare the CPU cost of rendering a 1000 key ListObjects page with the old
+dict + xmltodict.unparse path against app.serializer.
+
+    python benchmarks/bench_listing.py --keys 1000 --rounds 200
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import xmltodict  # noqa: E402
+
+from app import serializer  # noqa: E402
+from app.models.bucket_index import VersionRecord  # noqa: E402
+from app.models.disk_storage import ListingPage  # noqa: E402
+from app.settings import settings  # noqa: E402
+
+
+def make_page(keys):
+    now = time.time()
+    entries = [VersionRecord("photos/2023/{:06d}.jpg".format(i), "null", i, 1024 + i, now, "d41d8cd98f00b204e9800998ecf8427e", 0, 1, None)
+               for i in range(keys)]
+    return ListingPage(entries, [], True, entries[-1].key, None)
+
+
+def render_xmltodict(page):
+    contents = []
+    for i in page.entries:
+        contents.append({
+            "Key": i.key,
+            "LastModified": datetime.datetime.fromtimestamp(i.mtime, tz=datetime.timezone.utc).strftime(settings.date_fmt),
+            "ETag": "\"{}\"".format(i.etag),
+            "Size": i.size,
+            "StorageClass": "STANDARD",
+            "Owner": {"ID": settings.owner_id, "DisplayName": settings.name},
+        })
+    data = {
+        "ListBucketResult": {
+            "@xmlns": serializer.XMLNS,
+            "Name": "bench",
+            "MaxKeys": len(page.entries),
+            "IsTruncated": page.is_truncated,
+            "Marker": None,
+            "Contents": contents,
+            "CommonPrefixes": [],
+            "NextMarker": page.next_marker,
+        }
+    }
+    return xmltodict.unparse(data)
+
+
+def render_serializer(page):
+    return serializer.list_objects("bench", page, max_keys=len(page.entries))
+
+
+def measure(render, page, rounds):
+    start = time.process_time()
+    for _ in range(rounds):
+        render(page)
+    return (time.process_time() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    page = make_page(args.keys)
+    baseline = measure(render_xmltodict, page, args.rounds)
+    fast = measure(render_serializer, page, args.rounds)
+    print("renderer     ms/page   speedup")
+    print("{:<12} {:<9.2f} {:.2f}x".format("xmltodict", baseline * 1000, 1.0))
+    print("{:<12} {:<9.2f} {:.2f}x".format("serializer", fast * 1000, baseline / fast))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Measure the throughput of SelectObjectContent evaluation over a generated
+CSV object and how many bytes a filter sends back compared to the object.
+The per-row column evaluates every record as its own batch, the baseline
+the batched evaluation is compared to.
+
+    python benchmarks/bench_select.py --rows 1000000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import s3select  # noqa: E402
+
+QUERIES = [
+    "SELECT * FROM S3Object s",
+    "SELECT s.name FROM S3Object s WHERE CAST(s.age AS INT) > 85",
+    "SELECT COUNT(*) FROM S3Object s WHERE s.age = '3' AND s.city = 'Paris'",
+]
+
+
+def make_object(rows):
+    cities = ["Paris", "Berlin", "Lisbon", "Oslo"]
+    return ("name,age,city\n" + "".join("user{},{},{}\n".format(i, i % 90, cities[i % 4]) for i in range(rows))).encode()
+
+
+class PerRowSelector(s3select.Selector):
+    def _evaluate(self, records):
+        return b"".join(super(PerRowSelector, self)._evaluate([record]) for record in records)
+
+
+def measure(sql, data, chunk_size, selector_class=s3select.Selector):
+    request = s3select.SelectRequest(s3select.parse_sql(sql), "CSV", {"FileHeaderInfo": "USE"}, "NONE", "CSV", {}, False)
+    selector = selector_class(request)
+    start = time.process_time()
+    for offset in range(0, len(data), chunk_size):
+        selector.feed(data[offset:offset + chunk_size])
+    selector.finish()
+    return time.process_time() - start, selector.returned
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--chunk-size", type=int, default=1024 * 1024)
+    args = parser.parse_args()
+
+    data = make_object(args.rows)
+    print("{:<72} {:<8} {:<12} {:<8} {}".format("query", "MB/s", "per-row MB/s", "speedup", "returned"))
+    for sql in QUERIES:
+        seconds, returned = measure(sql, data, args.chunk_size)
+        row_seconds, row_returned = measure(sql, data, args.chunk_size, PerRowSelector)
+        assert row_returned == returned
+        print("{:<72} {:<8.1f} {:<12.1f} {:<8.1f} {:.2%}".format(
+            sql, len(data) / seconds / 1e6, len(data) / row_seconds / 1e6, row_seconds / seconds, returned / len(data)))
+
+
+if __name__ == "__main__":
+    main()
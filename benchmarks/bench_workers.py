@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Measure PUT/GET throughput against a local pseudo-s3 started with an
+increasing number of uvicorn workers sharing one data root.
+
+    python benchmarks/bench_workers.py --workers 1 2 4 8 --duration 10
+"""
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+AUTH = "AWS4-HMAC-SHA256 Credential=pseudoS3AccessKey/20230101/us-east-1/s3/aws4_request, SignedHeaders=host, Signature=bench"
+
+
+def request(conn, method, path, body=None):
+    conn.request(method, path, body=body, headers={"Authorization": AUTH})
+    response = conn.getresponse()
+    response.read()
+    return response.status
+
+
+def client(port, client_id, duration, size, counter):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    body = os.urandom(size)
+    done = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        key = "/bench/c{}/{}".format(client_id, done % 100)
+        request(conn, "PUT", key, body)
+        request(conn, "GET", key)
+        done += 2
+    with counter.get_lock():
+        counter.value += done
+
+
+def wait_for_server(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            request(http.client.HTTPConnection("127.0.0.1", port), "GET", "/")
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+def run(workers, clients, duration, size, port):
+    data_root = tempfile.mkdtemp(prefix="pseudo-s3-bench-")
+    env = dict(os.environ, BUCKET_PATH=data_root, VALIDATE_SIGNATURE="false", LIFECYCLE_INTERVAL="0")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        env=env, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    try:
+        wait_for_server(port)
+        request(http.client.HTTPConnection("127.0.0.1", port), "PUT", "/bench")
+        counter = multiprocessing.Value("i", 0)
+        procs = [multiprocessing.Process(target=client, args=(port, i, duration, size, counter)) for i in range(clients)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        return counter.value / duration
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(data_root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=multiprocessing.cpu_count() * 2)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    baseline = None
+    print("workers  req/s     speedup")
+    for workers in args.workers:
+        rate = run(workers, args.clients, args.duration, args.size, args.port)
+        baseline = baseline or rate
+        print("{:<8} {:<9.0f} {:.2f}x".format(workers, rate, rate / baseline))
+
+
+if __name__ == "__main__":
+    main()
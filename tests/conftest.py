@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import uuid
+
+import pytest
+
+# Settings are read when app is imported, point them at a scratch data root.
+DATA_ROOT = tempfile.mkdtemp(prefix="pseudo-s3-tests-")
+os.environ["BUCKET_PATH"] = DATA_ROOT
+os.environ["VALIDATE_SIGNATURE"] = "false"
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.main import app  # noqa: E402
+
+AUTH = {"Authorization": "AWS4-HMAC-SHA256 Credential=pseudoS3AccessKey/20260101/us-east-1/s3/aws4_request, "
+                         "SignedHeaders=host, Signature=unchecked"}
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(DATA_ROOT, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def client():
+    return TestClient(app)
+
+
+@pytest.fixture
+def s3(client):
+    """Send a request as an authenticated client."""
+    def request(method, url, headers=None, **kwargs):
+        return client.request(method, url, headers=dict(AUTH, **(headers or {})), **kwargs)
+    return request
+
+
+@pytest.fixture
+def bucket(s3):
+    """Name of a new empty bucket."""
+    name = "test-" + uuid.uuid4().hex[:12]
+    assert s3("PUT", "/" + name).status_code == 200
+    return name
@@ -0,0 +1,89 @@
+import hashlib
+import io
+import os
+
+import pytest
+
+from app import compression
+from app.models.disk_storage import S3Bucket
+
+REGION = "us-east-1"
+FRAME = compression.FRAME_SIZE
+DATA = b"".join(b"%08d\n" % i for i in range(2 * FRAME // 9 + 1000))
+
+
+def compressed(algorithm, data, frame_size=FRAME):
+    fp = io.BytesIO()
+    writer = compression.FrameWriter(fp, algorithm, frame_size)
+    writer.write(data)
+    writer.close()
+    return fp.getvalue()
+
+
+def detect(tmp_path, content):
+    path = tmp_path / "object"
+    path.write_bytes(content)
+    with open(path, "rb") as fp:
+        return compression.detect(fp.fileno())
+
+
+@pytest.fixture(params=["gzip", "zstd"])
+def algorithm(request):
+    if not compression.available(request.param):
+        pytest.skip("{} is not available".format(request.param))
+    return request.param
+
+
+@pytest.fixture
+def compressed_object(s3, bucket, algorithm):
+    body = "<CompressionConfiguration><Algorithm>{}</Algorithm></CompressionConfiguration>".format(algorithm)
+    assert s3("PUT", "/{}?compression".format(bucket), content=body).status_code == 200
+    assert s3("PUT", "/{}/data".format(bucket), content=DATA).status_code == 200
+    return bucket
+
+
+def test_stored_compressed(s3, compressed_object, algorithm):
+    path = os.path.join(S3Bucket(compressed_object, REGION).path, "data")
+    assert os.path.getsize(path) < len(DATA) // 2
+    with open(path, "rb") as fp:
+        assert compression.detect(fp.fileno()) == algorithm
+    response = s3("HEAD", "/{}/data".format(compressed_object))
+    assert response.headers["content-length"] == str(len(DATA))
+    assert response.headers["etag"] == hashlib.md5(DATA).hexdigest()
+
+
+@pytest.mark.parametrize("start, end", [
+    (0, 10),
+    (FRAME - 5, FRAME + 5),
+    (FRAME, 2 * FRAME),
+    (10, 2 * FRAME + 100),
+    (len(DATA) - 7, len(DATA)),
+])
+def test_ranged_reads(s3, compressed_object, start, end):
+    response = s3("GET", "/{}/data".format(compressed_object), headers={"Range": "bytes={}-{}".format(start, end - 1)})
+    assert response.status_code == 206
+    assert response.content == DATA[start:end]
+    assert response.headers["content-range"] == "bytes {}-{}/{}".format(start, end - 1, len(DATA))
+
+
+def test_suffix_range_and_full_read(s3, compressed_object):
+    url = "/{}/data".format(compressed_object)
+    assert s3("GET", url, headers={"Range": "bytes=-3"}).content == DATA[-3:]
+    assert s3("GET", url).content == DATA
+
+
+def test_detect_written_files(tmp_path, algorithm):
+    assert detect(tmp_path, compressed(algorithm, DATA, 4096)) == algorithm
+    assert detect(tmp_path, compressed(algorithm, b"")) == algorithm
+
+
+def test_detect_ignores_footer_shaped_user_data(tmp_path):
+    footer = compression.FOOTER.pack(10, FRAME, 1, compression.ALGORITHMS["gzip"], compression.MAGIC)
+    assert detect(tmp_path, b"user data" + footer) is None
+    # A consistent frame table is not enough without a real frame in front.
+    table = compression.FRAME_LENGTH.pack(9)
+    assert detect(tmp_path, b"user data" + table + footer) is None
+    # Truncated or extended files no longer add up.
+    content = compressed("gzip", DATA)
+    assert detect(tmp_path, content[1:]) is None
+    assert detect(tmp_path, b"x" + content) is None
@@ -0,0 +1,83 @@
+import os
+import re
+import time
+
+import pytest
+
+from app.lifecycle import UnsupportedRule, parse_lifecycle_configuration
+from app.models.disk_storage import S3Bucket
+
+
+def configuration(rule):
+    return "<LifecycleConfiguration><Rule>{}</Rule></LifecycleConfiguration>".format(rule)
+
+
+EXPIRE = "<Status>Enabled</Status><Expiration><Days>3</Days></Expiration>"
+
+
+@pytest.mark.parametrize("rule, prefix", [
+    ("<ID>a</ID><Filter><Prefix>logs/</Prefix></Filter>" + EXPIRE, "logs/"),
+    ("<ID>a</ID><Filter></Filter>" + EXPIRE, ""),
+    ("<ID>a</ID><Filter/>" + EXPIRE, ""),
+    ("<ID>a</ID><Prefix>old/</Prefix>" + EXPIRE, "old/"),
+])
+def test_prefix_filters(rule, prefix):
+    rules = parse_lifecycle_configuration(configuration(rule))
+    assert rules == [{"ID": "a", "Status": "Enabled", "Prefix": prefix, "ExpirationDays": 3}]
+
+
+@pytest.mark.parametrize("rule_filter", [
+    "<Tag><Key>k</Key><Value>v</Value></Tag>",
+    "<And><Prefix>a/</Prefix><Tag><Key>k</Key><Value>v</Value></Tag></And>",
+    "<ObjectSizeGreaterThan>100</ObjectSizeGreaterThan>",
+])
+def test_other_filters_are_unsupported(rule_filter):
+    with pytest.raises(UnsupportedRule):
+        parse_lifecycle_configuration(configuration("<Filter>{}</Filter>{}".format(rule_filter, EXPIRE)))
+
+
+@pytest.mark.parametrize("body", [
+    "not xml",
+    "<LifecycleConfiguration>text</LifecycleConfiguration>",
+    "<LifecycleConfiguration><Rule>text</Rule></LifecycleConfiguration>",
+    configuration("<Status>Enabled</Status>"),
+    configuration("<Status>On</Status><Expiration><Days>3</Days></Expiration>"),
+    configuration("<Status>Enabled</Status><Expiration><Days>soon</Days></Expiration>"),
+    configuration("<Status>Enabled</Status><Expiration><Days><x/></Days></Expiration>"),
+])
+def test_malformed_configurations(body):
+    with pytest.raises(ValueError) as error:
+        parse_lifecycle_configuration(body)
+    assert not isinstance(error.value, UnsupportedRule)
+
+
+def test_put_lifecycle_responses(s3, bucket):
+    url = "/{}?lifecycle".format(bucket)
+    assert s3("PUT", url, content=configuration("<Filter><Prefix>a/</Prefix></Filter>" + EXPIRE)).status_code == 200
+    response = s3("PUT", url, content=configuration("<Filter><Tag><Key>k</Key><Value>v</Value></Tag></Filter>" + EXPIRE))
+    assert response.status_code == 501 and "<Code>NotImplemented</Code>" in response.text
+    response = s3("PUT", url, content="<LifecycleConfiguration>")
+    assert response.status_code == 400 and "<Code>MalformedXML</Code>" in response.text
+
+
+def start_upload(s3, bucket, key, **headers):
+    response = s3("POST", "/{}/{}?uploads=".format(bucket, key), headers=headers)
+    return re.search(r"<UploadId>(.*?)</UploadId>", response.text).group(1)
+
+
+def test_uploads_are_aborted_by_initiation_time(s3, bucket):
+    rule = "<Filter></Filter><Status>Enabled</Status><AbortIncompleteMultipartUpload>" \
+           "<DaysAfterInitiation>1</DaysAfterInitiation></AbortIncompleteMultipartUpload>"
+    s3("PUT", "/{}?lifecycle".format(bucket), content=configuration(rule))
+    empty = start_upload(s3, bucket, "empty", **{"x-amz-meta-color": "red"})
+    busy = start_upload(s3, bucket, "busy")
+    s3("PUT", "/{}/busy?uploadId={}&partNumber=1".format(bucket, busy), content=b"part")
+
+    s3_bucket = S3Bucket(bucket, "us-east-1")
+    assert s3_bucket.meta_manager.get(empty) == {"x-amz-meta-color": "red"}
+    now = time.time() + 86400
+    # A part written just now does not make an old upload any younger.
+    os.utime(s3_bucket.upload_dir(busy), (now, now))
+    assert s3_bucket.abort_incomplete_uploads(now) == 2
+    assert s3_bucket.upload_started(empty) is None and s3_bucket.upload_started(busy) is None
+    assert s3_bucket.meta_manager.get(empty) == {}
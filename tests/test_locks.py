@@ -0,0 +1,112 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.locks import LeaderLock, _lock_path, file_lock
+from app.models.disk_storage import S3Bucket
+
+REGION = "us-east-1"
+fork = multiprocessing.get_context("fork")
+
+
+def test_lock_file_is_removed_on_release():
+    with file_lock("test:remove"):
+        assert os.path.exists(_lock_path("test:remove"))
+        with file_lock("test:remove"):
+            pass
+        # Still held by the outer block.
+        assert os.path.exists(_lock_path("test:remove"))
+    assert not os.path.exists(_lock_path("test:remove"))
+
+
+def _hold(name, holding, release):
+    with file_lock(name):
+        holding.set()
+        release.wait(10)
+
+
+def test_lock_excludes_other_processes():
+    holding, release = fork.Event(), fork.Event()
+    holder = fork.Process(target=_hold, args=("test:exclusive", holding, release))
+    holder.start()
+    try:
+        assert holding.wait(10)
+        acquired = threading.Event()
+
+        def take():
+            with file_lock("test:exclusive"):
+                acquired.set()
+        thread = threading.Thread(target=take)
+        thread.start()
+        assert not acquired.wait(0.3)
+        # Other names are not held up.
+        with file_lock("test:other"):
+            pass
+        release.set()
+        assert acquired.wait(10)
+        thread.join()
+    finally:
+        release.set()
+        holder.join()
+
+
+def _count(path, times):
+    for _ in range(times):
+        with file_lock("test:counter"):
+            with open(path) as fp:
+                value = int(fp.read())
+            with open(path, "w") as fp:
+                fp.write(str(value + 1))
+
+
+def test_no_lost_updates_between_processes(tmp_path):
+    path = str(tmp_path / "counter")
+    with open(path, "w") as fp:
+        fp.write("0")
+    workers = [fork.Process(target=_count, args=(path, 50)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    with open(path) as fp:
+        assert fp.read() == "200"
+
+
+def _try_leader(result):
+    result.put(LeaderLock("test").acquire())
+
+
+def test_one_leader_per_data_root():
+    leader = LeaderLock("test")
+    assert leader.acquire()
+    try:
+        result = fork.Queue()
+        worker = fork.Process(target=_try_leader, args=(result,))
+        worker.start()
+        assert result.get(timeout=10) is False
+        worker.join()
+    finally:
+        leader.release()
+
+
+def test_concurrent_writes_keep_one_latest_version(s3, bucket):
+    s3("PUT", "/{}?versioning".format(bucket),
+       content="<VersioningConfiguration><Status>Enabled</Status></VersioningConfiguration>")
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        bodies = [str(i).encode() for i in range(32)]
+        statuses = list(pool.map(lambda body: s3("PUT", "/{}/key".format(bucket), content=body).status_code, bodies))
+    assert statuses == [200] * 32
+    records = S3Bucket(bucket, REGION).index.key_versions("key")
+    assert len(records) == 32
+    assert [i.is_latest for i in records] == [1] + [0] * 31
+    assert s3("GET", "/{}/key".format(bucket)).content in bodies
+
+
+def test_concurrent_metadata_updates(s3, bucket):
+    def put(i):
+        return s3("PUT", "/{}/k{}".format(bucket, i), content=b"v", headers={"x-amz-meta-n": str(i)}).status_code
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        assert list(pool.map(put, range(24))) == [200] * 24
+    manager = S3Bucket(bucket, REGION).meta_manager
+    assert [manager.get("k{}".format(i)) for i in range(24)] == [{"x-amz-meta-n": str(i)} for i in range(24)]
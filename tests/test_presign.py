@@ -0,0 +1,71 @@
+import base64
+import json
+
+import pytest
+
+from app import presign
+from app.settings import settings
+
+boto3 = pytest.importorskip("boto3")
+Config = pytest.importorskip("botocore.config").Config
+
+ACCESS_KEY = settings.valid_credentials[0]["access_key_id"]
+SECRET_KEY = settings.valid_credentials[0]["secret_key"]
+
+
+def presigner(signature_version):
+    return boto3.client("s3", endpoint_url="http://testserver", aws_access_key_id=ACCESS_KEY,
+                        aws_secret_access_key=SECRET_KEY, region_name="us-east-1",
+                        config=Config(signature_version=signature_version, s3={"addressing_style": "path"}))
+
+
+@pytest.fixture
+def listed_bucket(s3, bucket, monkeypatch):
+    s3("PUT", "/{}/dir/file.txt".format(bucket), content=b"data")
+    # Only presigned requests are sent from here on.
+    monkeypatch.setattr(settings, "validate_signature", True)
+    return bucket
+
+
+@pytest.mark.parametrize("signature_version", ["s3", "s3v4"])
+def test_presigned_bucket_listing(client, listed_bucket, signature_version):
+    url = presigner(signature_version).generate_presigned_url(
+        "list_objects", Params={"Bucket": listed_bucket, "Prefix": "dir/"})
+    response = client.get(url)
+    assert response.status_code == 200, response.text
+    assert "<Key>dir/file.txt</Key>" in response.text
+
+
+def test_sigv2_presigned_bucket_subresource(client, listed_bucket):
+    url = presigner("s3").generate_presigned_url("get_bucket_versioning", Params={"Bucket": listed_bucket})
+    assert client.get(url).status_code == 200
+
+
+def test_sigv2_presigned_object(client, listed_bucket):
+    url = presigner("s3").generate_presigned_url("get_object", Params={"Bucket": listed_bucket, "Key": "dir/file.txt"})
+    assert client.get(url).content == b"data"
+    response = client.get(url.replace("Signature=", "Signature=x"))
+    assert "<Code>SignatureDoesNotMatch</Code>" in response.text
+
+
+def test_sigv2_bucket_resource_keeps_trailing_slash():
+    assert presign.sigv2_string_to_sign("GET", "/b", 1, [], {}).endswith("\n/b/")
+    assert presign.sigv2_string_to_sign("GET", "/b", 1, [("versioning", "")], {}).endswith("\n/b/?versioning")
+    assert presign.sigv2_string_to_sign("GET", "/b/k ey", 1, [], {}).endswith("\n/b/k%20ey")
+    assert presign.sigv2_string_to_sign("GET", "/", 1, [], {}).endswith("\n/")
+
+
+@pytest.mark.parametrize("conditions", [
+    [{"key": 5}],
+    [["starts-with", "$key", None]],
+    [["eq", "$key", ["k"]]],
+    "not a list",
+])
+def test_malformed_post_policy(client, bucket, conditions, monkeypatch):
+    monkeypatch.setattr(settings, "validate_signature", True)
+    policy = base64.b64encode(json.dumps({"expiration": "2099-01-01T00:00:00Z", "conditions": conditions}).encode()).decode()
+    fields = {"key": "k", "policy": policy, "AWSAccessKeyId": ACCESS_KEY,
+              "signature": presign.get_signature(policy, SECRET_KEY, url_encoded=False)}
+    response = client.post("/" + bucket, data=fields, files={"file": ("f", b"data")})
+    assert response.status_code == 403
+    assert "Invalid Policy" in response.text
@@ -0,0 +1,153 @@
+import asyncio
+import http.server
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from app import replication
+from app.models.bucket_index import INDEX_FILE
+from app.models.disk_storage import S3, S3Bucket, S3Object
+from app.replication import ChangeLog, DirectoryTarget, HttpTarget, Replicator
+from app.settings import settings
+
+REGION = "us-east-1"
+
+
+def event(i):
+    return {"region": REGION, "bucket": "b", "key": "k{}".format(i), "version_id": None, "time": 0}
+
+
+def test_log_segments_are_sealed_and_dropped(tmp_path, monkeypatch):
+    monkeypatch.setattr(replication, "SEGMENT_SIZE", 200)
+    log = ChangeLog(str(tmp_path))
+    cursor, seen = log.load_cursor(), []
+    for i in range(40):
+        log.append(event(i))
+        if i % 3 == 0:
+            events, cursor = log.read(cursor, 2)
+            seen += [e["key"] for e in events]
+            log.save_cursor(cursor)
+            log.compact(cursor)
+    assert log.sealed(), "a steady stream of writes must still seal segments"
+    while True:
+        events, cursor = log.read(cursor, 5)
+        if not events:
+            break
+        seen += [e["key"] for e in events]
+        log.save_cursor(cursor)
+        log.compact(cursor)
+    assert seen == ["k{}".format(i) for i in range(40)]
+    assert log.lag(cursor) == 0
+    # Only segments the cursor has not moved past are kept.
+    assert all(number >= cursor[0] for number in log.sealed())
+    assert log.load_cursor() == cursor
+
+
+def test_cursor_written_before_segments(tmp_path):
+    log = ChangeLog(str(tmp_path))
+    log.append(event(0))
+    log.append(event(1))
+    with open(log.cursor_path, "w") as fp:
+        fp.write(str(log.size() // 2))
+    events, cursor = log.read(log.load_cursor(), 10)
+    assert [e["key"] for e in events] == ["k1"]
+    assert cursor == (1, log.size())
+
+
+@pytest.fixture
+def replicate(tmp_path, monkeypatch):
+    """Run one replication pass to a directory target, returns the target root."""
+    monkeypatch.setattr(settings, "replication_target", str(tmp_path / "standby"))
+    replicator = Replicator(S3, S3Bucket, S3Object, target=str(tmp_path / "standby"))
+    replicator.target = DirectoryTarget(str(tmp_path / "standby"), snapshot_interval=3600)
+
+    def run():
+        while asyncio.run(replicator.run_once()):
+            pass
+        return replicator
+    run.root = str(tmp_path / "standby")
+    return run
+
+
+def test_directory_target(s3, bucket, replicate):
+    s3("PUT", "/{}?versioning".format(bucket),
+       content="<VersioningConfiguration><Status>Enabled</Status></VersioningConfiguration>")
+    old = s3("PUT", "/{}/dir/a".format(bucket), content=b"one", headers={"x-amz-meta-color": "red"})
+    s3("PUT", "/{}/dir/a".format(bucket), content=b"two")
+    s3("PUT", "/{}/gone".format(bucket), content=b"x")
+    s3("DELETE", "/{}/gone".format(bucket))
+    replicator = replicate()
+    assert replicator.status()["lag_bytes"] == 0
+
+    copy = os.path.join(replicate.root, REGION, bucket)
+    with open(os.path.join(copy, "dir", "a"), "rb") as fp:
+        assert fp.read() == b"two"
+    assert not os.path.exists(os.path.join(copy, "gone"))
+    source = S3Bucket(bucket, REGION)
+    version_file = source.version_file("dir/a", old.headers["x-amz-version-id"])
+    with open(os.path.join(copy, os.path.relpath(version_file, source.path)), "rb") as fp:
+        assert fp.read() == b"one"
+    conn = sqlite3.connect(os.path.join(copy, INDEX_FILE))
+    assert conn.execute("SELECT COUNT(*) FROM versions WHERE key = 'dir/a'").fetchone() == (2,)
+    conn.close()
+
+
+def test_index_snapshots_are_periodic(s3, bucket, replicate):
+    s3("PUT", "/{}/a".format(bucket), content=b"a")
+    replicator = replicate()
+    index_path = os.path.join(replicate.root, REGION, bucket, INDEX_FILE)
+    snapshot = os.stat(index_path).st_mtime_ns
+
+    s3("PUT", "/{}/b".format(bucket), content=b"b")
+    replicate()
+    assert os.path.exists(os.path.join(replicate.root, REGION, bucket, "b"))
+    assert os.stat(index_path).st_mtime_ns == snapshot
+    replicator.target.flush(force=True)
+    conn = sqlite3.connect(index_path)
+    assert conn.execute("SELECT key FROM versions ORDER BY key").fetchall() == [("a",), ("b",)]
+    conn.close()
+
+
+class Recorder(http.server.BaseHTTPRequestHandler):
+    requests = []
+
+    def do_PUT(self):
+        length = self.headers.get("Content-Length")
+        body = self.rfile.read(int(length)) if length else b""
+        Recorder.requests.append((self.path, dict(self.headers), body))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_standby():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Recorder)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    Recorder.requests = []
+    yield "http://127.0.0.1:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_target_sends_compressed_objects_with_a_length(s3, bucket, http_standby):
+    s3("PUT", "/{}?compression".format(bucket),
+       content="<CompressionConfiguration><Algorithm>gzip</Algorithm></CompressionConfiguration>")
+    data = b"abc" * 500000
+    s3("PUT", "/{}/key".format(bucket), content=data)
+    s3_bucket = S3Bucket(bucket, REGION)
+    obj = S3Object("key", s3_bucket, REGION)
+    assert obj.encoding == "gzip"
+
+    HttpTarget(http_standby).sync_key(s3_bucket, obj, set())
+    (path, headers, body), = Recorder.requests
+    assert path.startswith("/{}/key?".format(bucket))
+    assert headers["Content-Length"] == str(len(data))
+    assert "Transfer-Encoding" not in headers
+    assert body == data
@@ -0,0 +1,149 @@
+import gzip
+import json
+import struct
+
+import pytest
+
+from app import s3select
+from app.s3select import SelectError
+
+CSV = 'name,age,city\nalice,34,Paris\nbob,27,"New\nYork"\ncarol,41,"Ber,""lin"""\n'
+JSONL = "".join(json.dumps({"name": "n{}".format(i), "age": i, "tags": {"a": i % 3}}) + "\n" for i in range(20))
+HEADER = "<CSV><FileHeaderInfo>USE</FileHeaderInfo></CSV>"
+
+
+def request(sql, input_format=HEADER, output_format="<CSV/>", extra=""):
+    return ("<SelectObjectContentRequest><Expression>{}</Expression><ExpressionType>SQL</ExpressionType>"
+            "<InputSerialization>{}</InputSerialization><OutputSerialization>{}</OutputSerialization>{}"
+            "</SelectObjectContentRequest>").format(sql.replace("&", "&amp;").replace("<", "&lt;"),
+                                                    input_format, output_format, extra).encode()
+
+
+def events(stream):
+    """(headers, payload) of every message of an event stream."""
+    messages = []
+    while stream:
+        total, headers_length = struct.unpack("!II", stream[:8])
+        headers, raw = {}, stream[12:12 + headers_length]
+        while raw:
+            name_length = raw[0]
+            name = raw[1:1 + name_length].decode()
+            value_length, = struct.unpack("!H", raw[2 + name_length:4 + name_length])
+            headers[name] = raw[4 + name_length:4 + name_length + value_length].decode()
+            raw = raw[4 + name_length + value_length:]
+        messages.append((headers, stream[12 + headers_length:total - 4]))
+        stream = stream[total:]
+    return messages
+
+
+def select(body, data, chunk_size=7):
+    """Records of running a request over data fed chunk_size bytes at a time."""
+    selector = s3select.Selector(s3select.parse_request(body))
+    messages = []
+    for start in range(0, len(data), chunk_size):
+        messages += selector.feed(data[start:start + chunk_size])
+        if selector.done:
+            break
+    messages += selector.finish()
+    parsed = events(b"".join(messages))
+    assert parsed[-1][0][":event-type"] == "End"
+    assert parsed[-2][0][":event-type"] == "Stats"
+    return b"".join(payload for headers, payload in parsed if headers[":event-type"] == "Records").decode()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 13, 1 << 20])
+def test_csv_records_across_chunks(chunk_size):
+    assert select(request("SELECT * FROM S3Object"), CSV.encode(), chunk_size) == \
+        'alice,34,Paris\nbob,27,"New\nYork"\ncarol,41,"Ber,""lin"""\n'
+    assert select(request("SELECT s.name FROM S3Object s WHERE s.city = 'New\nYork'"), CSV.encode(), chunk_size) == "bob\n"
+
+
+def test_multibyte_characters_split_over_chunks():
+    data = "name\nzoë\n日本\n".encode()
+    assert select(request("SELECT * FROM S3Object"), data, 1) == "zoë\n日本\n"
+
+
+def test_where_limit_and_functions():
+    sql = "SELECT UPPER(s.name), CAST(s.age AS INT) + 1 AS next FROM S3Object s WHERE s.age > 30 AND s.name LIKE '%l%'"
+    assert select(request(sql), CSV.encode()) == "ALICE,35\nCAROL,42\n"
+    assert select(request("SELECT _1 FROM S3Object LIMIT 2", "<CSV><FileHeaderInfo>IGNORE</FileHeaderInfo></CSV>"),
+                  CSV.encode()) == "alice\nbob\n"
+    assert select(request("SELECT _1 FROM S3Object WHERE _2 BETWEEN 40 AND 50", "<CSV/>"), CSV.encode()) == "carol\n"
+
+
+def test_json_output():
+    rows = select(request("SELECT s.name, s.age FROM S3Object s WHERE s.age < 30", output_format="<JSON/>"), CSV.encode())
+    assert [json.loads(line) for line in rows.splitlines()] == [{"name": "bob", "age": "27"}]
+
+
+def test_json_lines_input():
+    body = request("SELECT s.name, s.tags.a AS a FROM S3Object[*] s WHERE s.age IN (1, 2, 4) AND s.tags.a = 1",
+                   "<JSON><Type>LINES</Type></JSON>", "<JSON/>")
+    rows = select(body, JSONL.encode(), 11)
+    assert [json.loads(line) for line in rows.splitlines()] == [{"name": "n1", "a": 1}, {"name": "n4", "a": 1}]
+
+
+def test_aggregates():
+    body = request("SELECT COUNT(*), SUM(s.age), MIN(s.age), MAX(s.age), AVG(s.age) FROM S3Object[*] s WHERE s.age >= 10",
+                   "<JSON><Type>LINES</Type></JSON>", "<JSON/>")
+    result = json.loads(select(body, JSONL.encode()))
+    assert list(result.values()) == [10, 145, 10, 19, 14.5]
+    body = request("SELECT COUNT(*) FROM S3Object s WHERE s.age > 100", "<JSON><Type>LINES</Type></JSON>")
+    assert select(body, JSONL.encode()) == "0\n"
+
+
+def test_gzip_input():
+    body = request("SELECT COUNT(*) FROM S3Object").replace(
+        b"<InputSerialization>", b"<InputSerialization><CompressionType>GZIP</CompressionType>")
+    assert select(body, gzip.compress(CSV.encode()), 3) == "3\n"
+
+
+def test_progress_and_stats():
+    selector = s3select.Selector(s3select.parse_request(request(
+        "SELECT * FROM S3Object", extra="<RequestProgress><Enabled>TRUE</Enabled></RequestProgress>")))
+    messages = events(b"".join(selector.feed(CSV.encode()) + selector.finish()))
+    assert [headers[":event-type"] for headers, payload in messages] == ["Records", "Progress", "Stats", "End"]
+    assert "<BytesScanned>{}</BytesScanned>".format(len(CSV.encode())).encode() in messages[2][1]
+
+
+@pytest.mark.parametrize("sql, code", [
+    ("SELECT FROM S3Object", "ParseUnexpectedToken"),
+    ("SELECT * FROM other", "ParseUnsupportedSyntax"),
+    ("SELECT s.name, COUNT(*) FROM S3Object s", "ParseUnsupportedSyntax"),
+    ("SELECT * FROM S3Object LIMIT -1", "ParseUnexpectedToken"),
+    ("SELECT # FROM S3Object", "ParseInvalidTokenError"),
+])
+def test_parse_errors(sql, code):
+    with pytest.raises(SelectError) as error:
+        s3select.parse_request(request(sql))
+    assert error.value.code == code
+
+
+def test_request_errors():
+    with pytest.raises(SelectError) as error:
+        s3select.parse_request(b"<nope")
+    assert error.value.code == "MalformedXML"
+    with pytest.raises(SelectError) as error:
+        s3select.parse_request(request("SELECT * FROM S3Object", input_format="<Parquet/>"))
+    assert error.value.code == "InvalidRequestParameter"
+
+
+def test_select_over_http(s3, bucket):
+    s3("PUT", "/{}/people.csv".format(bucket), content=CSV.encode())
+    url = "/{}/people.csv?select&select-type=2".format(bucket)
+    response = s3("POST", url, content=request("SELECT s.name FROM S3Object s WHERE CAST(s.age AS INT) > 30"))
+    assert response.status_code == 200
+    messages = events(response.content)
+    assert messages[0] == ({":message-type": "event", ":event-type": "Records",
+                            ":content-type": "application/octet-stream"}, b"alice\ncarol\n")
+
+    # Errors found once the object is being read arrive as error events.
+    response = s3("POST", url, content=request("SELECT CAST(s.city AS INT) FROM S3Object s"))
+    headers, payload = events(response.content)[-1]
+    assert headers[":message-type"] == "error" and headers[":error-code"] == "CastFailed"
+
+    response = s3("POST", url, content=request("SELECT FROM S3Object"))
+    assert response.status_code == 400
+    assert "<Code>ParseUnexpectedToken</Code>" in response.text
+    assert s3("POST", "/{}/missing?select&select-type=2".format(bucket),
+              content=request("SELECT * FROM S3Object")).status_code == 404
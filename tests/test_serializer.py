@@ -0,0 +1,106 @@
+import xml.etree.ElementTree as ET
+
+import pytest
+import xmltodict
+
+from app import serializer
+from app.models.bucket_index import VersionRecord
+from app.models.disk_storage import ListingPage
+
+NS = "{http://s3.amazonaws.com/doc/2006-03-01}"
+MTIME = 1767225600.5  # 2026-01-01T00:00:00.500Z
+
+
+def record(key, version_id="null", size=3, etag="abc", delete_marker=0, is_latest=1):
+    return VersionRecord(key, version_id, 1, size, MTIME, etag, delete_marker, is_latest, None)
+
+
+def parse(document):
+    assert document.startswith(serializer.XML_HEADER)
+    return ET.fromstring(document.encode("utf-8"))
+
+
+def find(element, path):
+    """Text of the elements at a path of unqualified names."""
+    return [i.text for i in element.findall("/".join(NS + i for i in path.split("/")))]
+
+
+@pytest.mark.parametrize("data", [
+    {"R": {"a": [1, 2], "b": None, "c": {"d": "x&y <z>"}, "e": True, "f": False}},
+    {"ListAllMyBucketsResult": {"Buckets": {"Bucket": [{"Name": "a", "CreationDate": "2026"}]}}},
+    {"VersioningConfiguration": {"Status": "Enabled"}},
+])
+def test_to_xml_matches_xmltodict(data):
+    assert serializer.to_xml(data) == xmltodict.unparse(data)
+
+
+def test_error():
+    document = serializer.error("NoSuchKey", "Key <a&b> missing", {"Key": "a&b", "RequestId": "1"})
+    root = parse(document)
+    assert root.tag == "Error"
+    assert [(i.tag, i.text) for i in root] == [("Code", "NoSuchKey"), ("Message", "Key <a&b> missing"),
+                                               ("Key", "a&b"), ("RequestId", "1")]
+
+
+def test_list_objects():
+    page = ListingPage([record("a&b"), record("c<d>", size=10, etag="e")], ["dir/"], True, "c<d>", None)
+    root = parse(serializer.list_objects("bkt", page, prefix="", max_keys=2, delimiter="/"))
+    assert root.tag == NS + "ListBucketResult"
+    assert find(root, "Name") == ["bkt"]
+    assert find(root, "IsTruncated") == ["true"]
+    assert find(root, "NextMarker") == ["c<d>"]
+    assert find(root, "Delimiter") == ["/"]
+    assert find(root, "Contents/Key") == ["a&b", "c<d>"]
+    assert find(root, "Contents/ETag") == ['"abc"', '"e"']
+    assert find(root, "Contents/Size") == ["3", "10"]
+    assert find(root, "Contents/LastModified") == ["2026-01-01T00:00:00.000Z"] * 2
+    assert find(root, "Contents/Owner/DisplayName") != []
+    assert find(root, "CommonPrefixes/Prefix") == ["dir/"]
+    assert find(root, "EncodingType") == []
+
+
+def test_untruncated_listing_has_no_next_marker():
+    page = ListingPage([record("a")], [], False, None, None)
+    root = parse(serializer.list_objects("bkt", page))
+    assert find(root, "IsTruncated") == ["false"]
+    assert find(root, "NextMarker") == []
+
+
+def test_url_encoded_keys():
+    page = ListingPage([record("a b/ü&")], ["p q/"], True, "a b/ü&", None)
+    root = parse(serializer.list_objects_v2("bkt", page, encoding_type="url", delimiter="/"))
+    assert find(root, "EncodingType") == ["url"]
+    assert find(root, "Contents/Key") == ["a%20b/%C3%BC%26"]
+    assert find(root, "CommonPrefixes/Prefix") == ["p%20q/"]
+    # Continuation tokens are opaque and never url encoded.
+    assert find(root, "NextContinuationToken") == ["a b/ü&"]
+
+
+def test_list_objects_v2():
+    page = ListingPage([record("a")], ["b/"], False, None, None)
+    root = parse(serializer.list_objects_v2("bkt", page, start_after="0", delimiter="/"))
+    assert find(root, "KeyCount") == ["2"]
+    assert find(root, "StartAfter") == ["0"]
+    assert find(root, "ContinuationToken") == []
+    assert find(root, "Contents/Owner") == []
+
+
+def test_list_object_versions():
+    page = ListingPage([record("k", "v2", delete_marker=1), record("k", "v1", is_latest=0)], [], True, "k", "v1")
+    root = parse(serializer.list_object_versions("bkt", page, key_marker="", max_keys=2))
+    assert root.tag == NS + "ListVersionsResult"
+    assert find(root, "DeleteMarker/VersionId") == ["v2"]
+    assert find(root, "DeleteMarker/IsLatest") == ["true"]
+    assert find(root, "Version/VersionId") == ["v1"]
+    assert find(root, "Version/IsLatest") == ["false"]
+    assert find(root, "NextKeyMarker") == ["k"]
+    assert find(root, "NextVersionIdMarker") == ["v1"]
+    # Delete markers and versions keep their order.
+    assert [i.tag for i in root if i.tag in (NS + "Version", NS + "DeleteMarker")] == [NS + "DeleteMarker", NS + "Version"]
+
+
+def test_multipart_documents():
+    root = parse(serializer.initiate_multipart_upload("b&", "k<", "id"))
+    assert find(root, "Bucket") == ["b&"] and find(root, "Key") == ["k<"] and find(root, "UploadId") == ["id"]
+    root = parse(serializer.complete_multipart_upload("http://h/b/k", "b", "k", "abc"))
+    assert find(root, "ETag") == ['"abc"']
@@ -0,0 +1,78 @@
+import hashlib
+import re
+
+import pytest
+
+from app import aio
+
+DATA = bytes(range(256)) * (3 * aio.CHUNK_SIZE // 256 + 17)
+
+
+@pytest.fixture
+def stored(s3, bucket):
+    assert s3("PUT", "/{}/blob".format(bucket), content=DATA).status_code == 200
+    return "/{}/blob".format(bucket)
+
+
+def test_put_and_get_larger_than_a_chunk(s3, stored):
+    response = s3("GET", stored)
+    assert response.status_code == 200
+    assert response.content == DATA
+    assert response.headers["content-length"] == str(len(DATA))
+    assert response.headers["etag"] == '"{}"'.format(hashlib.md5(DATA).hexdigest())
+    assert response.headers["accept-ranges"] == "bytes"
+
+
+def test_head(s3, stored):
+    response = s3("HEAD", stored)
+    assert response.status_code == 200
+    assert response.headers["content-length"] == str(len(DATA))
+    assert response.headers["etag"] == hashlib.md5(DATA).hexdigest()
+
+
+@pytest.mark.parametrize("header, start, end", [
+    ("bytes=0-0", 0, 1),
+    ("bytes=10-19", 10, 20),
+    ("bytes=1048570-1048600", 1048570, 1048601),
+    ("bytes=2000000-", 2000000, len(DATA)),
+    ("bytes=-100", len(DATA) - 100, len(DATA)),
+    ("bytes=5-99999999", 5, len(DATA)),
+])
+def test_ranges(s3, stored, header, start, end):
+    response = s3("GET", stored, headers={"Range": header})
+    assert response.status_code == 206
+    assert response.content == DATA[start:end]
+    assert response.headers["content-length"] == str(end - start)
+    assert response.headers["content-range"] == "bytes {}-{}/{}".format(start, end - 1, len(DATA))
+
+
+@pytest.mark.parametrize("header", ["bytes={}-".format(len(DATA)), "bytes=20-10", "bytes=a-b"])
+def test_unsatisfiable_ranges(s3, stored, header):
+    response = s3("GET", stored, headers={"Range": header})
+    assert response.status_code == 416
+    assert "<Code>InvalidRange</Code>" in response.text
+
+
+def test_not_modified(s3, stored):
+    response = s3("GET", stored, headers={"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+    assert response.status_code == 304
+    assert s3("GET", stored, headers={"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"}).status_code == 200
+
+
+def test_missing_object(s3, bucket):
+    assert "<Code>NoSuchKey</Code>" in s3("GET", "/{}/missing".format(bucket)).text
+    assert s3("HEAD", "/{}/missing".format(bucket)).status_code == 404
+
+
+def test_multipart_upload(s3, bucket):
+    url = "/{}/parts".format(bucket)
+    upload_id = re.search(r"<UploadId>(.*?)</UploadId>", s3("POST", url + "?uploads=").text).group(1)
+    parts = [DATA[:aio.CHUNK_SIZE * 2], DATA[aio.CHUNK_SIZE * 2:]]
+    for number, part in enumerate(parts, 1):
+        response = s3("PUT", url, params={"uploadId": upload_id, "partNumber": str(number)}, content=part)
+        assert response.headers["etag"] == hashlib.md5(part).hexdigest()
+    body = "<CompleteMultipartUpload>{}</CompleteMultipartUpload>".format("".join(
+        "<Part><PartNumber>{}</PartNumber></Part>".format(i) for i in range(1, len(parts) + 1)))
+    assert s3("POST", url, params={"uploadId": upload_id}, content=body).status_code == 200
+    assert s3("GET", url).content == DATA
+    assert s3("GET", url, headers={"Range": "bytes=-3"}).content == DATA[-3:]
@@ -0,0 +1,107 @@
+import asyncio
+from collections import OrderedDict
+
+import pytest
+
+from app import main, throttle
+from app.throttle import AdmissionControl, AdmissionMiddleware
+
+CLAIMED = {"authorization": "AWS4-HMAC-SHA256 Credential=someone/20260101/us-east-1/s3/aws4_request, "
+                            "SignedHeaders=host, Signature=unchecked"}
+
+
+@pytest.mark.parametrize("method, path, query, expected", [
+    ("GET", "/b", {}, ("list", True)),
+    ("GET", "/b", {"versioning": ""}, ("read", False)),
+    ("GET", "/b/k", {}, ("read", False)),
+    ("HEAD", "/b", {}, ("read", False)),
+    ("PUT", "/b/k", {}, ("write", False)),
+    ("POST", "/b/k", {"uploadId": "1"}, ("write", True)),
+    ("POST", "/b", {"delete": ""}, ("write", True)),
+    ("POST", "/b/k", {"select": "", "select-type": "2"}, ("read", True)),
+    ("GET", "/_admin/usage", {}, (None, False)),
+])
+def test_classify(method, path, query, expected):
+    assert throttle.classify(method, path, query) == expected
+
+
+def test_access_key_needs_a_verified_signature():
+    assert throttle.access_key(CLAIMED, {}, "10.0.0.1", False) == "anonymous:10.0.0.1"
+    assert throttle.access_key(CLAIMED, {}, "10.0.0.1", True) == "someone"
+    assert throttle.access_key({}, {"X-Amz-Credential": "key/2026"}, "10.0.0.1", True) == "key"
+    assert throttle.access_key({"authorization": "AWS key:sig"}, {}, "10.0.0.1", True) == "key"
+
+
+def test_token_bucket():
+    admission = AdmissionControl(rates={"read": 2}, burst=1, concurrency=0)
+    assert admission.check_rate("a", "read", now=0) == 0
+    assert admission.check_rate("a", "read", now=0) == 0
+    assert admission.check_rate("a", "read", now=0) == 0.5
+    # Other clients and operation classes have their own buckets.
+    assert admission.check_rate("b", "read", now=0) == 0
+    assert admission.check_rate("a", "write", now=0) == 0
+    assert admission.check_rate("a", "read", now=0.5) == 0
+
+
+@pytest.fixture
+def admission(monkeypatch):
+    monkeypatch.setattr(main.admission, "buckets", OrderedDict())
+    return main.admission
+
+
+def test_listings_are_rate_limited_per_client(s3, bucket, admission, monkeypatch):
+    s3("PUT", "/{}/k".format(bucket), content=b"x")
+    monkeypatch.setattr(admission, "rates", {"list": 0.01})
+    assert s3("GET", "/" + bucket).status_code == 200
+    response = s3("GET", "/" + bucket)
+    assert response.status_code == 503
+    assert "<Code>SlowDown</Code>" in response.text
+    assert int(response.headers["retry-after"]) > 0
+    assert response.headers["x-amz-request-id"]
+    # Reads are budgeted separately.
+    assert s3("GET", "/{}/k".format(bucket)).status_code == 200
+    # An unverified credential is no way around the limit.
+    assert s3("GET", "/" + bucket, headers=CLAIMED).status_code == 503
+
+
+def test_expensive_requests_release_their_slot(s3, bucket, admission, monkeypatch):
+    monkeypatch.setattr(admission, "slots", asyncio.Semaphore(1))
+    monkeypatch.setattr(admission, "queue_timeout", 0.05)
+    for _ in range(3):
+        assert s3("GET", "/" + bucket).status_code == 200
+    assert s3("GET", "/missing-bucket-for-slots").status_code >= 400
+    assert not admission.slots.locked()
+
+
+def scope(path):
+    return {"type": "http", "method": "GET", "path": path, "query_string": b"", "headers": [],
+            "client": ("10.0.0.1", 1234), "state": {"authenticated": False, "request_id": "1"}}
+
+
+async def streaming_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"x", "more_body": True})
+    await asyncio.sleep(3600)
+
+
+def test_slot_released_when_the_client_goes_away():
+    async def run():
+        admission = AdmissionControl(rates={}, concurrency=1, queue_timeout=0.01)
+        middleware = AdmissionMiddleware(streaming_app, admission)
+
+        async def disconnected(message):
+            raise OSError("client went away")
+        with pytest.raises(OSError):
+            await middleware(scope("/b"), None, disconnected)
+        assert not admission.slots.locked()
+
+        async def send(message):
+            pass
+        task = asyncio.ensure_future(middleware(scope("/b"), None, send))
+        await asyncio.sleep(0.01)
+        assert admission.slots.locked()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert not admission.slots.locked()
+    asyncio.run(run())
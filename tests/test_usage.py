@@ -0,0 +1,94 @@
+import json
+import re
+
+import pytest
+
+from app import presign
+from app.models.disk_storage import S3Bucket
+from app.settings import settings
+
+REGION = "us-east-1"
+ACCESS_KEY = settings.valid_credentials[0]["access_key_id"]
+SECRET_KEY = settings.valid_credentials[0]["secret_key"]
+
+
+def usage(bucket):
+    return S3Bucket(bucket, REGION).usage
+
+
+def test_counters_follow_writes(s3, bucket):
+    s3("PUT", "/{}/a".format(bucket), content=b"12345")
+    s3("PUT", "/{}/b".format(bucket), content=b"12")
+    s3("PUT", "/{}/a".format(bucket), content=b"1")
+    s3("DELETE", "/{}/b".format(bucket))
+    assert usage(bucket) == {"objects": 1, "bytes": 1, "versions": 1, "version_bytes": 1, "multipart_bytes": 0}
+
+
+def test_counters_with_versions(s3, bucket):
+    s3("PUT", "/{}?versioning".format(bucket),
+       content="<VersioningConfiguration><Status>Enabled</Status></VersioningConfiguration>")
+    s3("PUT", "/{}/a".format(bucket), content=b"12345")
+    version = s3("PUT", "/{}/a".format(bucket), content=b"12").headers["x-amz-version-id"]
+    assert usage(bucket)["objects"] == 1 and usage(bucket)["bytes"] == 2
+    assert usage(bucket)["versions"] == 2 and usage(bucket)["version_bytes"] == 7
+
+    s3("DELETE", "/{}/a".format(bucket))
+    assert usage(bucket)["objects"] == 0 and usage(bucket)["versions"] == 2
+    s3("DELETE", "/{}/a".format(bucket), params={"versionId": version})
+    assert usage(bucket)["versions"] == 1 and usage(bucket)["version_bytes"] == 5
+
+
+def test_multipart_bytes(s3, bucket):
+    url = "/{}/big".format(bucket)
+    upload_id = re.search(r"<UploadId>(.*?)</UploadId>", s3("POST", url + "?uploads=").text).group(1)
+    s3("PUT", url, params={"uploadId": upload_id, "partNumber": "1"}, content=b"x" * 10)
+    s3("PUT", url, params={"uploadId": upload_id, "partNumber": "2"}, content=b"y" * 4)
+    assert usage(bucket)["multipart_bytes"] == 14
+    s3("POST", url, params={"uploadId": upload_id},
+       content="<CompleteMultipartUpload><Part><PartNumber>1</PartNumber></Part>"
+               "<Part><PartNumber>2</PartNumber></Part></CompleteMultipartUpload>")
+    assert usage(bucket) == {"objects": 1, "bytes": 14, "versions": 1, "version_bytes": 14, "multipart_bytes": 0}
+
+
+def test_reconcile_repairs_counters(s3, bucket):
+    s3("PUT", "/{}/a".format(bucket), content=b"123")
+    url = "/{}/big".format(bucket)
+    upload_id = re.search(r"<UploadId>(.*?)</UploadId>", s3("POST", url + "?uploads=").text).group(1)
+    s3("PUT", url, params={"uploadId": upload_id, "partNumber": "1"}, content=b"x" * 10)
+    expected = usage(bucket)
+
+    s3_bucket = S3Bucket(bucket, REGION)
+    s3_bucket.index.conn.execute("UPDATE usage SET objects = 40, bytes = -1, multipart_bytes = 0")
+    assert s3_bucket.usage != expected
+    assert s3_bucket.reconcile_usage() == expected
+
+
+@pytest.fixture
+def admin(monkeypatch):
+    monkeypatch.setattr(settings, "admin_api", True)
+
+
+def test_admin_api_is_off_by_default(client, s3):
+    assert s3("GET", "/_admin/usage").status_code == 404
+
+
+def test_admin_requires_a_verified_signature(client, s3, bucket, admin, monkeypatch):
+    # Neither the Host header nor an unchecked credential is a signature.
+    assert client.get("/_admin/usage", headers={"host": "s3.us-east-1.amazonaws.com"}).status_code == 403
+    assert s3("GET", "/_admin/usage").status_code == 403
+    url = presign.presign_url("GET", "http://testserver/_admin/usage?bucket=" + bucket, ACCESS_KEY, SECRET_KEY, REGION)
+    assert client.get(url).status_code == 403
+
+    monkeypatch.setattr(settings, "validate_signature", True)
+    response = client.get(url)
+    assert response.status_code == 200
+    assert json.loads(response.text) == {bucket: dict(usage(bucket), region=REGION)}
+    assert client.get(url.replace("X-Amz-Signature=", "X-Amz-Signature=0")).status_code != 200
+
+
+def test_metrics(client, bucket, s3, admin, monkeypatch):
+    s3("PUT", "/{}/a".format(bucket), content=b"123")
+    monkeypatch.setattr(settings, "validate_signature", True)
+    url = presign.presign_url("GET", "http://testserver/_admin/metrics", ACCESS_KEY, SECRET_KEY, REGION)
+    text = client.get(url).text
+    assert 'pseudo_s3_bucket_bytes{{bucket="{}",region="{}"}} 3'.format(bucket, REGION) in text
@@ -0,0 +1,105 @@
+import hashlib
+import os
+import re
+
+import pytest
+
+from app.models.disk_storage import S3Bucket
+
+REGION = "us-east-1"
+
+
+def versioning(s3, bucket, status):
+    body = "<VersioningConfiguration><Status>{}</Status></VersioningConfiguration>".format(status)
+    assert s3("PUT", "/{}?versioning".format(bucket), content=body).status_code == 200
+
+
+def versions(s3, bucket, **params):
+    response = s3("GET", "/" + bucket, params=dict(versions="", **params))
+    assert response.status_code == 200, response.text
+    return response.text
+
+
+@pytest.fixture
+def versioned(s3, bucket):
+    versioning(s3, bucket, "Enabled")
+    return bucket
+
+
+def test_versions_are_kept(s3, versioned):
+    url = "/{}/key".format(versioned)
+    first = s3("PUT", url, content=b"one").headers["x-amz-version-id"]
+    second = s3("PUT", url, content=b"two").headers["x-amz-version-id"]
+    assert first != second and "null" not in (first, second)
+    assert s3("GET", url).content == b"two"
+    assert s3("GET", url, params={"versionId": first}).content == b"one"
+    assert s3("GET", url, params={"versionId": second}).headers["x-amz-version-id"] == second
+
+
+def test_delete_marker_hides_the_key(s3, versioned):
+    url = "/{}/key".format(versioned)
+    version = s3("PUT", url, content=b"data").headers["x-amz-version-id"]
+    response = s3("DELETE", url)
+    assert response.headers["x-amz-delete-marker"] == "true"
+    marker = response.headers["x-amz-version-id"]
+    assert s3("GET", url).status_code == 404
+    assert "<Key>key</Key>" not in s3("GET", "/" + versioned).text
+    assert s3("GET", url, params={"versionId": version}).content == b"data"
+
+    # Removing the marker brings the previous version back.
+    assert s3("DELETE", url, params={"versionId": marker}).status_code == 204
+    assert s3("GET", url).content == b"data"
+
+
+def test_version_listing(s3, versioned):
+    ids = [s3("PUT", "/{}/a".format(versioned), content=str(i)).headers["x-amz-version-id"] for i in range(3)]
+    s3("PUT", "/{}/dir/b".format(versioned), content=b"b")
+    s3("DELETE", "/{}/dir/b".format(versioned))
+
+    text = versions(s3, versioned)
+    assert re.findall(r"<VersionId>(.*?)</VersionId>", text)[:3] == ids[::-1]
+    assert text.count("<Version>") == 4 and text.count("<DeleteMarker>") == 1
+    assert text.count("<IsLatest>true</IsLatest>") == 2
+
+    text = versions(s3, versioned, delimiter="/")
+    assert "<CommonPrefixes><Prefix>dir/</Prefix></CommonPrefixes>" in text
+    assert text.count("<Version>") == 3
+
+
+def test_version_listing_pages(s3, versioned):
+    ids = [s3("PUT", "/{}/a".format(versioned), content=str(i)).headers["x-amz-version-id"] for i in range(5)]
+    seen, params = [], {"max-keys": "2"}
+    while True:
+        text = versions(s3, versioned, **params)
+        seen += re.findall(r"<VersionId>(.*?)</VersionId>", text)
+        if "<IsTruncated>true</IsTruncated>" not in text:
+            break
+        params["key-marker"] = re.search(r"<NextKeyMarker>(.*?)</NextKeyMarker>", text).group(1)
+        params["version-id-marker"] = re.search(r"<NextVersionIdMarker>(.*?)</NextVersionIdMarker>", text).group(1)
+    assert seen == ids[::-1]
+
+
+def test_suspended_versioning_overwrites_null(s3, versioned):
+    url = "/{}/key".format(versioned)
+    kept = s3("PUT", url, content=b"kept").headers["x-amz-version-id"]
+    versioning(s3, versioned, "Suspended")
+    assert s3("PUT", url, content=b"one").headers["x-amz-version-id"] == "null"
+    assert s3("PUT", url, content=b"two").headers["x-amz-version-id"] == "null"
+    text = versions(s3, versioned)
+    assert re.findall(r"<VersionId>(.*?)</VersionId>", text) == ["null", kept]
+    assert s3("GET", url, params={"versionId": "null"}).content == b"two"
+
+
+def test_existing_files_are_indexed_without_hashing(s3):
+    name = "legacy-versioning"
+    path = S3Bucket(name, REGION).path
+    os.makedirs(os.path.join(path, "dir"))
+    for i in range(3):
+        with open(os.path.join(path, "dir", "f{}".format(i)), "wb") as fp:
+            fp.write(b"v%d" % i)
+
+    bucket = S3Bucket(name, REGION)
+    assert [i.etag for i in bucket.index.iter_objects()] == [None] * 3
+    text = s3("GET", "/" + name, params={"prefix": "dir/"}).text
+    assert "<ETag>&quot;{}&quot;</ETag>".format(hashlib.md5(b"v1").hexdigest()) in text
+    assert [i.etag for i in bucket.index.iter_objects()] == [hashlib.md5(b"v%d" % i).hexdigest() for i in range(3)]